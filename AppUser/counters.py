@@ -0,0 +1,30 @@
+from django.db.models import F
+from django.utils import timezone
+
+from .models import StatCounter
+
+USER_COUNTER = 'users'
+CONTACT_COUNTER = 'contacts'
+
+
+def set_counter(name, value):
+    StatCounter.objects.update_or_create(name=name, defaults={'value': value})
+
+
+def adjust_counter(name, delta):
+    """Add `delta` to a counter in one UPDATE.
+
+    A counter that doesn't exist yet is left alone: it is only ever
+    seeded from a complete count (see get_counter), never from a partial one.
+    """
+    if delta:
+        StatCounter.objects.filter(name=name).update(value=F('value') + delta, updated_at=timezone.now())
+
+
+def get_counter(name, seed):
+    """A counter's value; on first use `seed()` must store a complete count with set_counter."""
+    value = StatCounter.objects.filter(name=name).values_list('value', flat=True).first()
+    if value is None:
+        seed()
+        value = StatCounter.objects.filter(name=name).values_list('value', flat=True).first() or 0
+    return value
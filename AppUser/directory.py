@@ -0,0 +1,230 @@
+from django.utils import timezone
+
+from subscriptions.models import Subscription
+from utils.cache import LRUTTLCache
+from utils.supabase_client import get_supabase
+from .counters import USER_COUNTER, adjust_counter, get_counter, set_counter
+from .models import UserDirectoryEntry
+
+LIST_USERS_PAGE_SIZE = 1000
+# Unknown emails are remembered for a short time so repeated misses
+# don't keep going back to the database
+NEGATIVE_TTL = 30
+
+# Map plan_id to plan name
+PLAN_NAMES = {
+    1: "free",
+    2: "pro",
+    3: "business"
+}
+
+_USER_DATETIME_FIELDS = [
+    'created_at', 'updated_at', 'confirmed_at', 'email_confirmed_at', 'phone_confirmed_at',
+    'last_sign_in_at', 'confirmation_sent_at', 'recovery_sent_at', 'email_change_sent_at',
+]
+_SUBSCRIPTION_FIELDS = ['id', 'user_id', 'status', 'start_date', 'end_date', 'created_at', 'updated_at']
+
+_email_cache = LRUTTLCache(maxsize=10000, ttl=300)
+_NOT_FOUND = object()
+
+
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+def iter_auth_users(page_size=LIST_USERS_PAGE_SIZE):
+    """Yield every Supabase Auth user, one admin API page at a time."""
+    page = 1
+    while True:
+        users = get_supabase().auth.admin.list_users(page=page, per_page=page_size)
+        yield from users
+        if len(users) < page_size:
+            break
+        page += 1
+
+
+def serialize_auth_user(user):
+    """Auth user fields as returned by the admin user list, datetimes as ISO strings."""
+    data = {
+        "id": user.id,
+        "email": user.email,
+        "phone": user.phone,
+        "aud": user.aud,
+        "role": user.role,
+        "is_anonymous": user.is_anonymous,
+        "app_metadata": user.app_metadata,
+        "user_metadata": user.user_metadata,
+        "new_email": user.new_email,
+        "new_phone": user.new_phone,
+    }
+    for field in _USER_DATETIME_FIELDS:
+        value = getattr(user, field, None)
+        data[field] = value.isoformat() if value else None
+    return data
+
+
+def serialize_subscription(user_id, subscription=None):
+    """Subscription data for the admin user list; users without one are on the free plan."""
+    if subscription is None:
+        return {
+            "id": None,
+            "user_id": user_id,
+            "status": "active",
+            "start_date": None,
+            "end_date": None,
+            "created_at": None,
+            "updated_at": None,
+            "plan_id": 1,
+            "plan_name": "free"
+        }
+    data = {}
+    for field in _SUBSCRIPTION_FIELDS:
+        value = getattr(subscription, field)
+        data[field] = value.isoformat() if hasattr(value, 'isoformat') else value
+    data["plan_id"] = subscription.plan_id or 1
+    data["plan_name"] = PLAN_NAMES.get(subscription.plan_id, "free")
+    return data
+
+
+def _version(user, subscription):
+    return f"{user.updated_at.isoformat() if user.updated_at else ''}|{subscription.updated_at.isoformat() if subscription else ''}"
+
+
+def build_entry(user, subscription=None):
+    subscription_data = serialize_subscription(user.id, subscription)
+    return UserDirectoryEntry(
+        id=user.id,
+        email=user.email or '',
+        email_lower=normalize_email(user.email) or None,
+        plan_name=subscription_data["plan_name"],
+        last_sign_in_at=user.last_sign_in_at,
+        profile=serialize_auth_user(user),
+        subscription=subscription_data,
+        version=_version(user, subscription),
+    )
+
+
+def sync_user_directory(full=False):
+    """Bring the local directory in line with Supabase Auth and the subscriptions table.
+
+    Only users whose auth record or subscription changed since the last sync
+    are written (all of them with `full=True`), and users that no longer
+    exist in auth are removed. Returns the number of rows written.
+    """
+    known = dict(UserDirectoryEntry.objects.values_list('id', 'version'))
+    known = {str(user_id): version for user_id, version in known.items()}
+    subscriptions = {s.user_id: s for s in Subscription.objects.all()}
+
+    seen = set()
+    batch = []
+    written = 0
+    for user in iter_auth_users():
+        user_id = str(user.id)
+        seen.add(user_id)
+        subscription = subscriptions.get(user_id)
+        if not full and known.get(user_id) == _version(user, subscription):
+            continue
+        batch.append(build_entry(user, subscription))
+        if len(batch) >= LIST_USERS_PAGE_SIZE:
+            written += _upsert(batch)
+            batch = []
+    written += _upsert(batch)
+
+    # Users that disappeared from auth since the last sync
+    removed = [user_id for user_id in known if user_id not in seen]
+    for start in range(0, len(removed), LIST_USERS_PAGE_SIZE):
+        UserDirectoryEntry.objects.filter(id__in=removed[start:start + LIST_USERS_PAGE_SIZE]).delete()
+
+    # Every auth user was listed above, so the directory is complete
+    set_counter(USER_COUNTER, UserDirectoryEntry.objects.count())
+    _email_cache.clear()
+    return written
+
+
+def _upsert(entries):
+    if not entries:
+        return 0
+    # Free up emails that moved to another account before re-inserting
+    UserDirectoryEntry.objects.filter(
+        email_lower__in=[entry.email_lower for entry in entries if entry.email_lower]
+    ).exclude(id__in=[entry.id for entry in entries]).delete()
+    now = timezone.now()
+    for entry in entries:
+        entry.synced_at = now
+    UserDirectoryEntry.objects.bulk_create(
+        entries,
+        update_conflicts=True,
+        unique_fields=['id'],
+        update_fields=[
+            'email', 'email_lower', 'plan_name', 'last_sign_in_at',
+            'profile', 'subscription', 'version', 'synced_at',
+        ],
+    )
+    return len(entries)
+
+
+def resolve_user_id(email):
+    """Return the Supabase Auth user id for `email`, or None if there is no such user.
+
+    Lookups are served from the in-process cache, then the indexed local
+    mirror, and never reach the auth admin API: users who signed up since the
+    last sync arrive through the auth webhook (remember_user), and the
+    scheduled sync_user_directory run catches anything it missed.
+    """
+    key = normalize_email(email)
+    if not key:
+        return None
+
+    cached = _email_cache.get(key)
+    if cached is _NOT_FOUND:
+        return None
+    if cached is not None:
+        return cached
+
+    user_id = UserDirectoryEntry.objects.filter(email_lower=key).values_list('id', flat=True).first()
+    if user_id is None:
+        _email_cache.set(key, _NOT_FOUND, ttl=NEGATIVE_TTL)
+        return None
+
+    user_id = str(user_id)
+    _email_cache.set(key, user_id)
+    return user_id
+
+
+def remember_user(user):
+    """Add or refresh a single auth user in the directory (e.g. after an auth change event)."""
+    existing = list(UserDirectoryEntry.objects.filter(id=user.id).values_list('email_lower', flat=True))
+    # The new address may be cached as unknown from a lookup before the user signed up
+    for email_lower in {*existing, normalize_email(user.email)}:
+        if email_lower:
+            _email_cache.delete(email_lower)
+    subscription = Subscription.objects.filter(user_id=str(user.id)).first()
+    _upsert([build_entry(user, subscription)])
+    if not existing:
+        adjust_counter(USER_COUNTER, 1)
+
+
+def refresh_subscription(user_id):
+    """Re-read a user's subscription into their directory entry."""
+    subscription = Subscription.objects.filter(user_id=str(user_id)).first()
+    subscription_data = serialize_subscription(str(user_id), subscription)
+    UserDirectoryEntry.objects.filter(id=user_id).update(
+        plan_name=subscription_data["plan_name"],
+        subscription=subscription_data,
+        synced_at=timezone.now(),
+    )
+
+
+def forget_user(user_id):
+    """Drop a user from the directory and the cache."""
+    for email_lower in UserDirectoryEntry.objects.filter(id=user_id).values_list('email_lower', flat=True):
+        if email_lower:
+            _email_cache.delete(email_lower)
+    deleted, _ = UserDirectoryEntry.objects.filter(id=user_id).delete()
+    if deleted:
+        adjust_counter(USER_COUNTER, -1)
+
+
+def get_user_count():
+    """Total number of auth users from the maintained counter (seeded by one sync if it was never set)."""
+    return get_counter(USER_COUNTER, sync_user_directory)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from AppUser.directory import sync_user_directory
+
+
+class Command(BaseCommand):
+    help = "Mirror Supabase Auth users and their plans into the local user directory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Rewrite every user, not only changed ones")
+
+    def handle(self, *args, **options):
+        written = sync_user_directory(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(f"Synced {written} changed users"))
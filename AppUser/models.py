@@ -17,4 +17,42 @@ class AppUser(models.Model):
 
     def __str__(self):
         return self.email
-  
\ No newline at end of file
+  
+
+class UserDirectoryEntry(models.Model):
+    """Local snapshot of Supabase Auth users and their plan.
+
+    Used to resolve emails without the auth admin API and to serve the admin
+    user list without scanning auth and subscriptions on every page load.
+    """
+    id = models.UUIDField(primary_key=True)
+    email = models.EmailField(blank=True)
+    email_lower = models.CharField(max_length=254, unique=True, null=True)
+    plan_name = models.CharField(max_length=50, default='free')
+    last_sign_in_at = models.DateTimeField(null=True, blank=True)
+    # Serialized auth user and subscription, exactly as the admin API returns them
+    profile = models.JSONField(default=dict)
+    subscription = models.JSONField(default=dict)
+    # Auth and subscription updated_at, used to skip unchanged users when syncing
+    version = models.CharField(max_length=100, blank=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['plan_name', 'email_lower'], name='userdir_plan_idx'),
+            models.Index(fields=['last_sign_in_at'], name='userdir_last_sign_in_idx'),
+            models.Index(fields=['synced_at'], name='userdir_synced_idx'),
+        ]
+
+    def __str__(self):
+        return self.email
+
+
+class StatCounter(models.Model):
+    """Named counters maintained by sync jobs and change events, read in O(1) by the dashboard."""
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
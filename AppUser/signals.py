@@ -0,0 +1,12 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from subscriptions.models import Subscription
+from .directory import refresh_subscription
+
+
+@receiver([post_save, post_delete], sender=Subscription)
+def refresh_directory_plan(sender, instance, **kwargs):
+    # Keep the admin user list's plan column current without a full resync
+    transaction.on_commit(lambda: refresh_subscription(instance.user_id))
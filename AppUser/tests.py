@@ -1,3 +1,293 @@
-from django.test import TestCase
+import uuid
+import json
+from datetime import datetime, timezone as dt_timezone
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from files.models import StorageUsage
+from subscriptions.models import Subscription, SubscriptionPlan
+from . import directory
+from .counters import CONTACT_COUNTER, USER_COUNTER, get_counter, set_counter
+from .directory import get_user_count, remember_user, resolve_user_id, sync_user_directory
+from .models import UserDirectoryEntry
+from .views import _stats_cache
+
+
+def auth_user(email, user_id=None, updated_at=None, last_sign_in_at=None):
+    """Stand-in for a Supabase Auth user as the admin API returns it."""
+    user = SimpleNamespace(
+        id=user_id or str(uuid.uuid4()),
+        email=email,
+        phone='',
+        aud='authenticated',
+        role='authenticated',
+        is_anonymous=False,
+        app_metadata={},
+        user_metadata={},
+        new_email=None,
+        new_phone=None,
+    )
+    for field in directory._USER_DATETIME_FIELDS:
+        setattr(user, field, None)
+    user.updated_at = updated_at or datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+    user.last_sign_in_at = last_sign_in_at
+    return user
+
+
+class DirectoryTestCase(TestCase):
+
+    def setUp(self):
+        directory._email_cache.clear()
+        # Nothing here may reach the auth admin API unless a test says so
+        patcher = mock.patch('AppUser.directory.get_supabase', side_effect=AssertionError('auth admin API called'))
+        self.get_supabase = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sync(self, users, full=False):
+        with mock.patch('AppUser.directory.iter_auth_users', return_value=users):
+            return sync_user_directory(full=full)
+
+
+class ResolveUserIdTests(DirectoryTestCase):
+
+    def test_lookup_is_served_from_the_directory_then_the_cache(self):
+        user = auth_user('Someone@Example.com')
+        remember_user(user)
+        with self.assertNumQueries(1):
+            self.assertEqual(resolve_user_id(' someone@example.COM '), user.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_user_id('someone@example.com'), user.id)
+
+    def test_miss_is_not_found_without_a_sync(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(resolve_user_id('nobody@example.com'))
+        # remembered for a while
+        with self.assertNumQueries(0):
+            self.assertIsNone(resolve_user_id('nobody@example.com'))
+        self.get_supabase.assert_not_called()
+
+    def test_webhook_user_replaces_a_cached_miss(self):
+        self.assertIsNone(resolve_user_id('new@example.com'))
+        user = auth_user('new@example.com')
+        remember_user(user)
+        self.assertEqual(resolve_user_id('new@example.com'), user.id)
+        self.assertEqual(UserDirectoryEntry.objects.get().email_lower, 'new@example.com')
+
+
+class SyncUserDirectoryTests(DirectoryTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.pro = SubscriptionPlan.objects.create(id=2, name='Pro', tier='pro', price=199)
+
+    def test_sync_mirrors_users_and_their_plans(self):
+        alice, bob = auth_user('alice@example.com'), auth_user('Bob@Example.com')
+        Subscription.objects.create(user_id=bob.id, plan=self.pro)
+        self.assertEqual(self.sync([alice, bob]), 2)
+
+        entries = {str(entry.id): entry for entry in UserDirectoryEntry.objects.all()}
+        self.assertEqual(entries[alice.id].plan_name, 'free')
+        self.assertEqual(entries[bob.id].plan_name, 'pro')
+        self.assertEqual(entries[bob.id].email_lower, 'bob@example.com')
+        self.assertEqual(entries[bob.id].subscription['plan_id'], 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_user_count(), 2)
+
+    def test_incremental_sync_only_writes_changed_users(self):
+        alice, bob = auth_user('alice@example.com'), auth_user('bob@example.com')
+        self.sync([alice, bob])
+        self.assertEqual(self.sync([alice, bob]), 0)
+
+        bob.updated_at = datetime(2024, 2, 1, tzinfo=dt_timezone.utc)
+        bob.email = 'robert@example.com'
+        self.assertEqual(self.sync([alice, bob]), 1)
+        self.assertEqual(resolve_user_id('robert@example.com'), bob.id)
+        self.assertIsNone(resolve_user_id('bob@example.com'))
+
+        self.assertEqual(self.sync([alice, bob], full=True), 2)
+
+    def test_users_removed_from_auth_are_dropped(self):
+        alice, bob = auth_user('alice@example.com'), auth_user('bob@example.com')
+        self.sync([alice, bob])
+        self.assertEqual(resolve_user_id('bob@example.com'), bob.id)
+
+        self.sync([alice])
+        self.assertFalse(UserDirectoryEntry.objects.filter(id=bob.id).exists())
+        self.assertIsNone(resolve_user_id('bob@example.com'))
+        self.assertEqual(get_user_count(), 1)
+
+    def test_subscription_changes_refresh_the_plan(self):
+        alice = auth_user('alice@example.com')
+        self.sync([alice])
+        with self.captureOnCommitCallbacks(execute=True):
+            Subscription.objects.create(user_id=alice.id, plan=self.pro)
+        self.assertEqual(UserDirectoryEntry.objects.get(id=alice.id).plan_name, 'pro')
+
+
+class UserListTests(DirectoryTestCase):
+    url = '/api/users/get-users/'
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.carol = auth_user('carol@example.com', last_sign_in_at=datetime(2024, 3, 1, tzinfo=dt_timezone.utc))
+        self.alice = auth_user('alice@example.com', last_sign_in_at=datetime(2024, 1, 1, tzinfo=dt_timezone.utc))
+        self.bob = auth_user('bob@sample.org')
+        self.sync([self.carol, self.alice, self.bob])
+
+    def emails(self, response):
+        return [user['email'] for user in response.json()['results']]
+
+    def test_first_request_builds_the_snapshot(self):
+        UserDirectoryEntry.objects.all().delete()
+        with mock.patch('AppUser.directory.iter_auth_users', return_value=[self.alice]) as iter_auth_users:
+            response = self.client.get(self.url)
+            self.client.get(self.url)
+        self.assertEqual(iter_auth_users.call_count, 1)
+        self.assertEqual(self.emails(response), ['alice@example.com'])
+        self.assertEqual(response.json()['results'][0]['subscription']['plan_name'], 'free')
+
+    def test_search_sort_and_pages(self):
+        response = self.client.get(self.url, {'search': ' EXAMPLE.com'})
+        self.assertEqual(self.emails(response), ['alice@example.com', 'carol@example.com'])
+
+        response = self.client.get(self.url, {'sort': '-email'})
+        self.assertEqual(self.emails(response), ['carol@example.com', 'bob@sample.org', 'alice@example.com'])
+
+        # Users who never signed in come last either way
+        response = self.client.get(self.url, {'sort': 'last_sign_in'})
+        self.assertEqual(self.emails(response), ['alice@example.com', 'carol@example.com', 'bob@sample.org'])
+        response = self.client.get(self.url, {'sort': '-last_sign_in'})
+        self.assertEqual(self.emails(response), ['carol@example.com', 'alice@example.com', 'bob@sample.org'])
+
+        response = self.client.get(self.url, {'page_size': 2, 'page': 2})
+        self.assertEqual(response.json()['count'], 3)
+        self.assertEqual(response.json()['total_pages'], 2)
+        self.assertEqual(response.json()['page'], 2)
+        self.assertEqual(self.emails(response), ['carol@example.com'])
+
+    def test_bad_parameters_are_refused(self):
+        self.assertEqual(self.client.get(self.url, {'sort': 'password'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'page_size': 'many'}).status_code, 400)
+
+    def test_etag_changes_with_the_snapshot(self):
+        response = self.client.get(self.url, {'page_size': 2})
+        etag = response['ETag']
+        with self.assertNumQueries(2):
+            cached = self.client.get(self.url, {'page_size': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached.status_code, 304)
+
+        # Other parameters are another page
+        other = self.client.get(self.url, {'page_size': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(other.status_code, 200)
+
+        remember_user(auth_user('dave@example.com'))
+        response = self.client.get(self.url, {'page_size': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 4)
+
+
+@override_settings(SUPABASE_WEBHOOK_SECRET='hook-secret')
+class AuthWebhookTests(DirectoryTestCase):
+    url = '/api/users/auth-webhook/'
+
+    def setUp(self):
+        super().setUp()
+        _stats_cache.clear()
+        self.client = APIClient()
+        self.alice = auth_user('alice@example.com')
+        self.sync([self.alice])
+
+        self.admin = mock.Mock()
+        self.admin.get_user_by_id = mock.AsyncMock()
+        client = SimpleNamespace(auth=SimpleNamespace(admin=self.admin))
+        patcher = mock.patch('AppUser.views.get_async_supabase', mock.AsyncMock(return_value=client))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, payload, secret='hook-secret'):
+        headers = {'HTTP_X_WEBHOOK_SECRET': secret} if secret else {}
+        return self.client.post(self.url, json.dumps(payload), content_type='application/json', **headers)
+
+    def test_requests_without_the_secret_are_refused(self):
+        payload = {'type': 'DELETE', 'old_record': {'id': self.alice.id}}
+        self.assertEqual(self.send(payload, secret=None).status_code, 401)
+        self.assertEqual(self.send(payload, secret='guess').status_code, 401)
+        with self.settings(SUPABASE_WEBHOOK_SECRET=''):
+            self.assertEqual(self.send(payload, secret='').status_code, 401)
+        self.assertTrue(UserDirectoryEntry.objects.filter(id=self.alice.id).exists())
+
+    def test_insert_adds_the_user_and_counts_them(self):
+        self.assertEqual(self.client.get('/api/stats/').json()['total_users'], 1)
+        self.assertIsNone(resolve_user_id('new@example.com'))
+
+        user = auth_user('new@example.com')
+        self.admin.get_user_by_id.return_value = SimpleNamespace(user=user)
+        response = self.send({'type': 'INSERT', 'record': {'id': user.id}})
+
+        self.assertEqual(response.status_code, 200)
+        self.admin.get_user_by_id.assert_awaited_once_with(user.id)
+        self.assertEqual(resolve_user_id('new@example.com'), user.id)
+        # The dashboard sees the new user straight away
+        self.assertEqual(self.client.get('/api/stats/').json()['total_users'], 2)
+
+    def test_update_moves_the_email_without_counting_twice(self):
+        self.alice.email = 'alice@new.example.com'
+        self.admin.get_user_by_id.return_value = SimpleNamespace(user=self.alice)
+        self.assertEqual(resolve_user_id('alice@example.com'), self.alice.id)
+
+        response = self.send({'type': 'UPDATE', 'record': {'id': self.alice.id}})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(resolve_user_id('alice@example.com'))
+        self.assertEqual(resolve_user_id('alice@new.example.com'), self.alice.id)
+        self.assertEqual(get_user_count(), 1)
+
+    def test_delete_forgets_the_user(self):
+        self.assertEqual(resolve_user_id('alice@example.com'), self.alice.id)
+        response = self.send({'type': 'DELETE', 'old_record': {'id': self.alice.id}})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(resolve_user_id('alice@example.com'))
+        self.assertEqual(get_user_count(), 0)
+        self.admin.get_user_by_id.assert_not_awaited()
+
+    def test_malformed_events_are_refused(self):
+        self.assertEqual(self.send({'type': 'TRUNCATE'}).status_code, 400)
+        response = self.client.post(self.url, 'not json', content_type='application/json', HTTP_X_WEBHOOK_SECRET='hook-secret')
+        self.assertEqual(response.status_code, 400)
+
+
+class DashboardStatsTests(DirectoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        _stats_cache.clear()
+        self.client = APIClient()
+
+    def test_stats_are_read_from_counters_and_cached(self):
+        set_counter(USER_COUNTER, 7)
+        set_counter(CONTACT_COUNTER, 3)
+        StorageUsage.objects.create(user_id=uuid.uuid4(), file_count=4)
+        StorageUsage.objects.create(user_id=uuid.uuid4(), file_count=5)
+
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/stats/')
+        self.assertEqual(response.json(), {'success': True, 'total_users': 7, 'total_files': 9, 'total_contacts': 3})
+
+        with self.assertNumQueries(0):
+            self.client.get('/api/stats/')
+            response = self.client.get('/api/users/count-total-users/')
+        self.assertEqual(response.json()['total_users'], 7)
+
+    def test_user_counter_is_seeded_by_one_sync(self):
+        users = [auth_user(f'user{i}@example.com') for i in range(3)]
+        with mock.patch('AppUser.directory.iter_auth_users', return_value=users) as iter_auth_users:
+            self.assertEqual(self.client.get('/api/users/count-total-users/').json()['total_users'], 3)
+            _stats_cache.clear()
+            self.assertEqual(self.client.get('/api/users/count-total-users/').json()['total_users'], 3)
+        self.assertEqual(iter_auth_users.call_count, 1)
+        self.assertEqual(get_counter(USER_COUNTER, seed=None), 3)
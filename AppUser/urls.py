@@ -8,4 +8,5 @@ urlpatterns = [
     path('upload-profile-picture/<str:user_id>/', views.upload_profile_picture, name='upload_profile_picture'),
     path('delete/<str:user_id>/', views.delete_user, name='delete_user'), 
     path('count-total-users/', views.count_total_users, name='count_total_users'),
+    path('auth-webhook/', views.auth_webhook, name='auth_webhook'),
 ]
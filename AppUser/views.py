@@ -1,98 +1,94 @@
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db.models import Count, F, Max
+from django.http import HttpResponseNotModified, JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from utils.supabase_client import supabase
+from utils.supabase_client import get_async_supabase
+from utils.cache import LRUTTLCache
+from files.usage import count_all_files
+from contacts.signals import count_all_contacts
+from .directory import forget_user, get_user_count, normalize_email, remember_user, sync_user_directory
+from .models import UserDirectoryEntry
+import hashlib
+import hmac
 import json
 from datetime import datetime
 
+# Dashboard counters are allowed to be a few seconds stale
+_stats_cache = LRUTTLCache(maxsize=16, ttl=30)
+
+
+def _cached_count(name, compute):
+    value = _stats_cache.get(name)
+    if value is None:
+        value = compute()
+        _stats_cache.set(name, value)
+    return value
+
+
+USER_SORT_FIELDS = {
+    'email': 'email_lower',
+    'plan': 'plan_name',
+    'last_sign_in': 'last_sign_in_at',
+}
+
+
 @csrf_exempt
 @require_http_methods(["GET"])
 def get_all_users(request):
-    # Get users from Supabase Auth (using admin privileges)
+    """
+    Admin user list, served from the local user directory snapshot
+
+    Query params: page, page_size (max 200), search (email), sort
+    (email / plan / last_sign_in, prefix with - for descending).
+    Supports If-None-Match with the returned ETag.
+    """
     try:
-        # Get all users from auth
-        response = supabase.auth.admin.list_users()
-        
-        # Get all subscriptions from the subscriptions_subscription table
-        subscriptions_response = supabase.table('subscriptions_subscription').select('*').execute()
-        subscriptions = subscriptions_response.data if subscriptions_response.data else []
-        
-        # Create a mapping of user_id to subscription for easy lookup
-        subscription_map = {}
-        for subscription in subscriptions:
-            if subscription and isinstance(subscription, dict):  # Check if subscription is valid dictionary
-                user_id = subscription.get('user_id')
-                if user_id:
-                    subscription_map[user_id] = subscription
-        
-        # Map plan_id to plan name
-        plan_mapping = {
-            1: "free",
-            2: "pro", 
-            3: "business"
-        }
-        
-        def serialize_user(user):
-            """Helper function to serialize user object, including datetime objects"""
-            # Get subscription data for this user
-            user_subscription = subscription_map.get(user.id)
-            
-            # Default subscription data for free users
-            default_subscription = {
-                "id": None,
-                "user_id": user.id,
-                "status": "active",
-                "start_date": None,
-                "end_date": None,
-                "created_at": None,
-                "updated_at": None,
-                "plan_id": 1,
-                "plan_name": "free"
-            }
-            
-            # If user has a subscription, use it; otherwise use default free plan
-            if user_subscription:
-                subscription_data = {
-                    "id": user_subscription.get('id'),
-                    "user_id": user_subscription.get('user_id'),
-                    "status": user_subscription.get('status'),
-                    "start_date": user_subscription.get('start_date'),
-                    "end_date": user_subscription.get('end_date'),
-                    "created_at": user_subscription.get('created_at'),
-                    "updated_at": user_subscription.get('updated_at'),
-                    "plan_id": user_subscription.get('plan_id', 1),  # Default to free if missing
-                    "plan_name": plan_mapping.get(user_subscription.get('plan_id', 1), "free")
-                }
-            else:
-                subscription_data = default_subscription
-            
-            user_dict = {
-                "id": user.id,
-                "email": user.email,
-                "phone": user.phone,
-                "aud": user.aud,
-                "role": user.role,
-                "is_anonymous": user.is_anonymous,
-                "app_metadata": user.app_metadata,
-                "user_metadata": user.user_metadata,
-                "created_at": user.created_at.isoformat() if user.created_at else None,
-                "updated_at": user.updated_at.isoformat() if user.updated_at else None,
-                "confirmed_at": user.confirmed_at.isoformat() if user.confirmed_at else None,
-                "email_confirmed_at": user.email_confirmed_at.isoformat() if user.email_confirmed_at else None,
-                "phone_confirmed_at": user.phone_confirmed_at.isoformat() if user.phone_confirmed_at else None,
-                "last_sign_in_at": user.last_sign_in_at.isoformat() if user.last_sign_in_at else None,
-                "confirmation_sent_at": user.confirmation_sent_at.isoformat() if user.confirmation_sent_at else None,
-                "recovery_sent_at": user.recovery_sent_at.isoformat() if user.recovery_sent_at else None,
-                "email_change_sent_at": user.email_change_sent_at.isoformat() if user.email_change_sent_at else None,
-                "new_email": user.new_email,
-                "new_phone": user.new_phone,
-                # Subscription data
-                "subscription": subscription_data
-            }
-            return user_dict
-        
-        users = [serialize_user(user) for user in response]
-        return JsonResponse(users, safe=False, status=200)
+        # First load after deploy: build the snapshot once
+        if not UserDirectoryEntry.objects.exists():
+            sync_user_directory()
+
+        entries = UserDirectoryEntry.objects.all()
+
+        search = normalize_email(request.GET.get('search'))
+        if search:
+            entries = entries.filter(email_lower__contains=search)
+
+        sort = request.GET.get('sort', 'email')
+        field = USER_SORT_FIELDS.get(sort.lstrip('-'))
+        if not field:
+            return JsonResponse({"error": f"Invalid sort. Choose from: {', '.join(USER_SORT_FIELDS)}"}, status=400)
+        descending = sort.startswith('-')
+        order = F(field).desc(nulls_last=True) if descending else F(field).asc(nulls_last=True)
+        entries = entries.order_by(order, 'id')
+
+        # ETag changes whenever a user is added, removed or updated in the snapshot
+        snapshot = UserDirectoryEntry.objects.aggregate(total=Count('id'), latest=Max('synced_at'))
+        etag = '"%s"' % hashlib.md5(
+            f"{snapshot['total']}|{snapshot['latest']}|{request.GET.urlencode()}".encode()
+        ).hexdigest()
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        try:
+            page_size = max(1, min(int(request.GET.get('page_size', 50)), 200))
+        except ValueError:
+            return JsonResponse({"error": "page_size must be a number"}, status=400)
+        page = Paginator(entries.only('profile', 'subscription'), page_size).get_page(request.GET.get('page'))
+
+        users = [{**entry.profile, "subscription": entry.subscription} for entry in page]
+        response = JsonResponse({
+            "count": page.paginator.count,
+            "page": page.number,
+            "total_pages": page.paginator.num_pages,
+            "results": users
+        }, status=200)
+        response['ETag'] = etag
+        return response
         
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
@@ -100,7 +96,7 @@ def get_all_users(request):
     
 @csrf_exempt
 @require_http_methods(["POST"])
-def change_user_password(request):
+async def change_user_password(request):
     """
     API para magpalit ng password ng user sa Supabase Auth
     """
@@ -122,7 +118,8 @@ def change_user_password(request):
             return JsonResponse({"error": "Password ay dapat hindi bababa sa 6 na characters"}, status=400)
         
         # Gamitin ang Supabase admin API para palitan ang password
-        response = supabase.auth.admin.update_user_by_id(
+        client = await get_async_supabase()
+        response = await client.auth.admin.update_user_by_id(
             user_id,
             {"password": new_password}
         )
@@ -147,7 +144,7 @@ def change_user_password(request):
     
 @csrf_exempt
 @require_http_methods(["POST"])
-def upload_profile_picture(request, user_id):
+async def upload_profile_picture(request, user_id):
     """
     API para mag-upload ng profile picture at i-save sa user metadata
     user_id ay nasa URL parameter
@@ -157,7 +154,8 @@ def upload_profile_picture(request, user_id):
         if not user_id:
             return JsonResponse({"error": "User ID ay kailangan"}, status=400)
 
-        profile_picture = request.FILES.get('profile_picture')
+        client = await get_async_supabase()
+        profile_picture = await sync_to_async(lambda: request.FILES.get('profile_picture'))()
 
         if not profile_picture:
             return JsonResponse({"error": "Profile picture ay kailangan"}, status=400)
@@ -177,9 +175,9 @@ def upload_profile_picture(request, user_id):
         filename = f"profile_{user_id}_{timestamp}.{file_extension}"
 
         # I-upload ang file sa Supabase storage bucket
-        upload_response = supabase.storage.from_('uploads').upload(
+        upload_response = await client.storage.from_('uploads').upload(
             filename,
-            profile_picture.read(),
+            await sync_to_async(profile_picture.read)(),
             {"content-type": profile_picture.content_type}
         )
 
@@ -189,21 +187,21 @@ def upload_profile_picture(request, user_id):
         
         # Kunin ang public URL
         try:
-            public_url = supabase.storage.from_('uploads').get_public_url(filename)
+            public_url = await client.storage.from_('uploads').get_public_url(filename)
             
             if isinstance(public_url, str):
                 avatar_url = public_url
             else:
-                avatar_url = public_url.public_url if hasattr(public_url, 'public_url') else f"https://{supabase.supabase_url}/storage/v1/object/public/uploads/{filename}"
+                avatar_url = public_url.public_url if hasattr(public_url, 'public_url') else f"https://{client.supabase_url}/storage/v1/object/public/uploads/{filename}"
                 
         except Exception as upload_error:
             return JsonResponse({"error": f"Upload failed: {str(upload_error)}"}, status=400)
 
         # Kunin ang current user data
-        user_response = supabase.auth.admin.get_user_by_id(user_id)
+        user_response = await client.auth.admin.get_user_by_id(user_id)
         
         if not user_response.user:
-            supabase.storage.from_('uploads').remove([filename])
+            await client.storage.from_('uploads').remove([filename])
             return JsonResponse({"error": "User hindi matagpuan"}, status=404)
 
         current_user = user_response.user
@@ -213,12 +211,13 @@ def upload_profile_picture(request, user_id):
         updated_metadata = {**current_metadata, "avatar": avatar_url}
 
         # I-update ang user sa Supabase Auth
-        update_response = supabase.auth.admin.update_user_by_id(
+        update_response = await client.auth.admin.update_user_by_id(
             user_id,
             {"user_metadata": updated_metadata}
         )
 
         if hasattr(update_response, 'user') and update_response.user:
+            await sync_to_async(remember_user)(update_response.user)
             return JsonResponse({
                 "success": True,
                 "message": "Profile picture ay matagumpay na na-upload",
@@ -226,7 +225,7 @@ def upload_profile_picture(request, user_id):
             }, status=200)
         else:
             # Kung nabigo ang update, i-delete ang uploaded file
-            supabase.storage.from_('uploads').remove([filename])
+            await client.storage.from_('uploads').remove([filename])
             return JsonResponse({
                 "success": False,
                 "error": "Hindi matagumpay ang pag-update ng user metadata"
@@ -236,14 +235,14 @@ def upload_profile_picture(request, user_id):
         # Kung may anumang error, i-delete ang uploaded file kung mayroon
         try:
             if 'filename' in locals():
-                supabase.storage.from_('uploads').remove([filename])
+                await client.storage.from_('uploads').remove([filename])
         except:
             pass
         return JsonResponse({"error": str(e)}, status=500)
     
 @csrf_exempt
 @require_http_methods(["DELETE"])
-def delete_user(request, user_id):
+async def delete_user(request, user_id):
     """
     API para mag-delete ng user sa Supabase Auth lang
     """
@@ -253,7 +252,8 @@ def delete_user(request, user_id):
             return JsonResponse({"error": "User ID ay kailangan"}, status=400)
 
         # Diretso delete na sa Supabase Auth
-        delete_response = supabase.auth.admin.delete_user(user_id)
+        client = await get_async_supabase()
+        delete_response = await client.auth.admin.delete_user(user_id)
 
         # Check kung successful
         if hasattr(delete_response, 'error') and delete_response.error:
@@ -262,6 +262,9 @@ def delete_user(request, user_id):
                 "error": f"Hindi matagumpay ang pag-delete: {delete_response.error}"
             }, status=400)
 
+        await sync_to_async(forget_user)(user_id)
+        _stats_cache.delete('users')
+
         return JsonResponse({
             "success": True,
             "message": "User ay matagumpay na nai-delete sa Supabase Auth",
@@ -276,70 +279,73 @@ def delete_user(request, user_id):
 def count_total_users(request):
     """
     API para makuha ang total number ng mga user sa Supabase Auth
+    Galing sa maintained counter, hindi na nililista lahat ng user
     """
     try:
-        # Kunin ang listahan ng mga user mula sa Supabase
-        response = supabase.auth.admin.list_users()
-        
-        # Debug: Check the response structure
-        print(f"Response type: {type(response)}")
-        print(f"Response attributes: {dir(response)}")
-        
-        # Iba't ibang paraan para makuha ang users list
-        users = None
-        
-        # Try different ways to access the users data
-        if hasattr(response, 'users'):
-            users = response.users
-            print(f"Found users via response.users: {len(users)}")
-        elif hasattr(response, 'data'):
-            users = response.data
-            print(f"Found users via response.data: {len(users)}")
-        elif isinstance(response, list):
-            users = response
-            print(f"Response is a list: {len(users)}")
-        else:
-            # Try to access directly
-            try:
-                users = response
-                print(f"Using response directly: {len(users)}")
-            except:
-                pass
-        
-        # Bilangin ang total users
-        if users is not None:
-            total_users = len(users)
-            
-            return JsonResponse({
-                "success": True,
-                "total_users": total_users,
-                "message": f"May kabuuang {total_users} na user"
-            }, status=200)
-        else:
-            # Alternative: Gamitin ang get_all_users logic
-            print("Trying alternative approach...")
-            try:
-                auth_response = supabase.auth.admin.list_users()
-                # Assume same structure as get_all_users
-                if hasattr(auth_response, 'users'):
-                    total_users = len(auth_response.users)
-                    return JsonResponse({
-                        "success": True,
-                        "total_users": total_users,
-                        "message": f"May kabuuang {total_users} na user"
-                    }, status=200)
-            except Exception as alt_e:
-                print(f"Alternative approach failed: {alt_e}")
-            
-            return JsonResponse({
-                "success": False,
-                "error": "Hindi makuha ang listahan ng mga user",
-                "debug_info": f"Response type: {type(response)}"
-            }, status=400)
-            
+        total_users = _cached_count('users', get_user_count)
+        return JsonResponse({
+            "success": True,
+            "total_users": total_users,
+            "message": f"May kabuuang {total_users} na user"
+        }, status=200)
     except Exception as e:
-        print(f"Error in count_total_users: {str(e)}")
         return JsonResponse({
             "success": False,
             "error": str(e)
-        }, status=500)
\ No newline at end of file
+        }, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def dashboard_stats(request):
+    """
+    Lahat ng dashboard counters (users, files, contacts) sa isang request
+    """
+    try:
+        return JsonResponse({
+            "success": True,
+            "total_users": _cached_count('users', get_user_count),
+            "total_files": _cached_count('files', count_all_files),
+            "total_contacts": _cached_count('contacts', count_all_contacts),
+        }, status=200)
+    except Exception as e:
+        return JsonResponse({
+            "success": False,
+            "error": str(e)
+        }, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def auth_webhook(request):
+    """
+    Database webhook on auth.users (INSERT / UPDATE / DELETE) para
+    updated ang user directory at ang user counter nang walang full sync
+    """
+    secret = settings.SUPABASE_WEBHOOK_SECRET
+    if not secret or not hmac.compare_digest(request.headers.get('X-Webhook-Secret', ''), secret):
+        return JsonResponse({"error": "Unauthorized"}, status=401)
+
+    try:
+        payload = json.loads(request.body)
+        event = payload.get('type')
+        record = payload.get('record') or {}
+        old_record = payload.get('old_record') or {}
+
+        if event == 'DELETE':
+            await sync_to_async(forget_user)(old_record.get('id'))
+        elif event in ('INSERT', 'UPDATE') and record.get('id'):
+            client = await get_async_supabase()
+            user_response = await client.auth.admin.get_user_by_id(record['id'])
+            if user_response.user:
+                await sync_to_async(remember_user)(user_response.user)
+        else:
+            return JsonResponse({"error": "Unsupported event"}, status=400)
+
+        _stats_cache.delete('users')
+        return JsonResponse({"success": True}, status=200)
+
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON format"}, status=400)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
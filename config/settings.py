@@ -1,5 +1,7 @@
 from pathlib import Path
 import os
+import sys
+import dj_database_url
 from dotenv import load_dotenv
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -33,7 +35,8 @@ INSTALLED_APPS = [
     'AppUser',
     'files',
     'contacts',
-    'subscriptions'
+    'subscriptions',
+    'jobs'
 ]
 
 # ---------------------------------------------------------------------
@@ -69,6 +72,8 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+# Served by uvicorn workers; upload, download, share and user admin are async views
+ASGI_APPLICATION = 'config.asgi.application'
 
 # ---------------------------------------------------------------------
 # 🗄️ DATABASE (you’ll use Supabase via supabase-py, so keep sqlite for now)
@@ -84,6 +89,16 @@ DATABASES = {
         'OPTIONS': {'sslmode': 'require'},  # important for Supabase
     }
 }
+
+# Override with a single URL, e.g. a local Postgres or sqlite:///db.sqlite3
+# for tests and benchmarks
+if os.getenv('DATABASE_URL'):
+    DATABASES['default'] = dj_database_url.parse(os.getenv('DATABASE_URL'))
+
+# Migration files are not tracked in this repo, so test (and benchmark)
+# databases are built straight from the models
+if len(sys.argv) > 1 and sys.argv[1] in ('test', 'benchmark_files'):
+    MIGRATION_MODULES = {app: None for app in ['AppUser', 'files', 'contacts', 'subscriptions', 'jobs']}
 # ---------------------------------------------------------------------
 # 🔐 AUTHENTICATION
 # ---------------------------------------------------------------------
@@ -121,6 +136,8 @@ SUPABASE_DB_PASSWORD = os.getenv('SUPABASE_DB_PASSWORD', '')
 SUPABASE_DB_HOST = os.getenv('SUPABASE_DB_HOST', '')
 SUPABASE_PORT = os.getenv('SUPABASE_PORT', '5432')
 SUPABASE_PROJECT_URL = os.getenv("SUPABASE_PROJECT_URL", "https://xyzcompanyabc.supabase.co")
+# Shared secret sent by the auth.users database webhook (X-Webhook-Secret header)
+SUPABASE_WEBHOOK_SECRET = os.getenv('SUPABASE_WEBHOOK_SECRET', '')
 
 # ---------------------------------------------------------------------
 # 🪣 PAYPAL CONFIG
@@ -128,4 +145,63 @@ SUPABASE_PROJECT_URL = os.getenv("SUPABASE_PROJECT_URL", "https://xyzcompanyabc.
 PAYPAL_CLIENT_ID = os.getenv('PAYPAL_CLIENT_ID', '')
 PAYPAL_CLIENT_SECRET = os.getenv('PAYPAL_CLIENT_SECRET', '')
 PAYPAL_MODE = os.getenv('PAYPAL_MODE', 'sandbox') 
+# Overrides the sandbox/live API host (e.g. a local fake server in tests)
+PAYPAL_API_BASE = os.getenv('PAYPAL_API_BASE', '')
+# Background threads per web process that capture approved orders
+PAYPAL_CAPTURE_WORKERS = int(os.getenv('PAYPAL_CAPTURE_WORKERS', '2'))
 FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:5173')
+
+# ---------------------------------------------------------------------
+# 🗃️ OBJECT STORAGE
+# ---------------------------------------------------------------------
+# Where encrypted file content lives: "supabase", "local" (files under STORAGE_ROOT),
+# "memory" (per process; tests and benchmarks) or a dotted path to a StorageBackend
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'supabase')
+STORAGE_ROOT = os.getenv('STORAGE_ROOT', str(BASE_DIR / 'storage'))
+# Internal nginx location mapped to STORAGE_ROOT; when set, presigned reads of the local
+# backend are answered with X-Accel-Redirect and nginx sends the file itself
+STORAGE_ACCEL_REDIRECT_PREFIX = os.getenv('STORAGE_ACCEL_REDIRECT_PREFIX', '')
+# Open connections to Supabase Storage per ASGI worker process, shared by all async requests
+STORAGE_MAX_CONNECTIONS = int(os.getenv('STORAGE_MAX_CONNECTIONS', '200'))
+
+# ---------------------------------------------------------------------
+# 📂 FILE UPLOADS
+# ---------------------------------------------------------------------
+# Max files of one upload request encrypted and sent to storage in parallel
+FILE_UPLOAD_MAX_WORKERS = int(os.getenv('FILE_UPLOAD_MAX_WORKERS', '8'))
+# Seconds an upload may take to store new content before another upload can take it over
+BLOB_UPLOAD_LEASE = int(os.getenv('BLOB_UPLOAD_LEASE', '1800'))
+# Seconds an upload waits for identical content another upload is still storing
+BLOB_UPLOAD_WAIT = float(os.getenv('BLOB_UPLOAD_WAIT', '60'))
+# Processes per `run_jobs` worker rendering thumbnails/previews (needs Pillow, pypdfium2);
+# 0 renders inside the worker itself
+PREVIEW_MAX_WORKERS = int(os.getenv('PREVIEW_MAX_WORKERS', '2'))
+# Seconds one image or PDF may take to render before its process is killed
+PREVIEW_RENDER_TIMEOUT = float(os.getenv('PREVIEW_RENDER_TIMEOUT', '30'))
+# Larger uploads get no preview
+PREVIEW_MAX_SOURCE_BYTES = int(os.getenv('PREVIEW_MAX_SOURCE_BYTES', str(25 * 1024 * 1024)))
+# Hand encryption and the storage upload to `run_jobs` workers and answer with pending
+# files by default (clients can also ask per request with async=true)
+FILE_UPLOAD_ASYNC = os.getenv('FILE_UPLOAD_ASYNC', 'False') == 'True'
+# Where deferred uploads wait for a worker; must be shared by the web and worker processes
+FILE_UPLOAD_SPOOL_DIR = os.getenv('FILE_UPLOAD_SPOOL_DIR', str(BASE_DIR / 'upload_spool'))
+
+# ---------------------------------------------------------------------
+# ⏳ BACKGROUND JOBS
+# ---------------------------------------------------------------------
+# Seconds a worker holds a claimed job before another worker may take it over
+JOB_VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', '300'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+# Seconds before the first retry, doubled after every further failure
+JOB_RETRY_BACKOFF = int(os.getenv('JOB_RETRY_BACKOFF', '10'))
+
+# ---------------------------------------------------------------------
+# 🔐 FILE ENCRYPTION KEYS
+# ---------------------------------------------------------------------
+# Master keys that wrap the per-blob data keys, as "id:base64key,id:base64key".
+# Keep retired keys listed until rotate_file_keys has moved every blob off them.
+FILE_MASTER_KEYS = dict(
+    item.strip().split(':', 1) for item in os.getenv('FILE_MASTER_KEYS', '').split(',') if item.strip()
+)
+# Key id new data keys are wrapped with; "legacy" is the built-in key
+FILE_MASTER_KEY_ID = os.getenv('FILE_MASTER_KEY_ID', 'legacy')
@@ -1,10 +1,12 @@
 from django.contrib import admin
 from django.urls import path, include
+from AppUser.views import dashboard_stats
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/files/', include('files.urls')),
     path('api/contacts/', include('contacts.urls')),
     path("api/subscriptions/", include("subscriptions.urls")),
-    path("api/users/", include("AppUser.urls"))
+    path("api/users/", include("AppUser.urls")),
+    path("api/stats/", dashboard_stats, name="dashboard_stats"),
 ]
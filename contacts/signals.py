@@ -0,0 +1,21 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from AppUser.counters import CONTACT_COUNTER, adjust_counter, get_counter, set_counter
+from .models import Contact
+
+
+@receiver(post_save, sender=Contact)
+def count_contact_added(sender, instance, created, **kwargs):
+    if created:
+        adjust_counter(CONTACT_COUNTER, 1)
+
+
+@receiver(post_delete, sender=Contact)
+def count_contact_removed(sender, instance, **kwargs):
+    adjust_counter(CONTACT_COUNTER, -1)
+
+
+def count_all_contacts():
+    """Total contact messages from the maintained counter."""
+    return get_counter(CONTACT_COUNTER, lambda: set_counter(CONTACT_COUNTER, Contact.objects.count()))
@@ -0,0 +1,65 @@
+"""ASGI middleware for the upload endpoint.
+
+Django's ASGIHandler receives the whole request body before any view
+runs, so a view can only refuse an oversized upload after it has been
+transferred. This middleware sits in front of the handler and answers
+from the headers alone.
+"""
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.urls import reverse
+
+from .uploads import check_declared_size
+
+
+def _check_upload(user_id, content_length):
+    close_old_connections()
+    try:
+        return check_declared_size(user_id, content_length)
+    finally:
+        close_old_connections()
+
+
+class UploadQuotaMiddleware:
+    """Turn away uploads whose Content-Length can't fit the user's plan before the body is read.
+
+    Only requests that name the user in the query string
+    (POST /api/files/?user_id=...) can be checked this early; everything
+    else goes straight to the wrapped application, which checks again
+    once the body is parsed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == reverse('file-list'):
+            user_id = parse_qs(scope['query_string'].decode('latin-1')).get('user_id', [None])[0]
+            headers = dict(scope['headers'])
+            content_length = headers.get(b'content-length', b'').decode('latin-1')
+            if user_id and content_length:
+                try:
+                    exceeded = await sync_to_async(_check_upload)(user_id, content_length)
+                except Exception:
+                    # e.g. a malformed user_id; the view reports it
+                    exceeded = None
+                if exceeded:
+                    await self._reject(send, exceeded)
+                    return
+        await self.app(scope, receive, send)
+
+    async def _reject(self, send, exceeded):
+        body = json.dumps({'error': str(exceeded)}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': exceeded.status_code,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'connection', b'close'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,371 @@
+"""Async versions of the storage-bound file endpoints, for ASGI (uvicorn) workers.
+
+DRF views are synchronous, so upload, download and share are plain Django
+async views mounted in front of the FileViewSet routes. Storage requests
+go through the async side of the configured storage backend and only the ORM work runs in
+sync_to_async, so a worker holds many in-flight storage requests at once.
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from AppUser.directory import resolve_user_id
+from subscriptions.entitlements import PlanLimitExceeded, get_entitlements
+from utils.storage import StorageObjectExists, StorageObjectNotFound
+from utils.storage_backends import get_storage
+from utils.utils import (
+    STREAM_HEADER_SIZE,
+    STREAM_KEY,
+    adecrypt_frames,
+    adecrypt_range,
+    ciphertext_range,
+    decrypt_stream,
+    encrypt_stream,
+    encrypted_size,
+    is_stream_format,
+    parse_header,
+    plaintext_size,
+)
+from .blobs import (
+    BUCKET,
+    abandon_uploads,
+    blob_data_key,
+    claim_blobs,
+    finish_uploads,
+    hash_upload,
+    lease_uploads,
+    uploaded_blobs,
+)
+from .models import File, FileShare
+from .serializers import FileSerializer, FileShareSerializer
+from .uploads import check_declared_size, check_plan, create_deferred, save_uploads
+from .views import FileViewSet, _is_true
+
+_list_files = sync_to_async(FileViewSet.as_view({'get': 'list'}))
+
+RANGE_NOT_SATISFIABLE = object()
+
+
+def parse_range_header(range_header, size):
+    """Parse a single `bytes=` range into an inclusive (start, end) tuple.
+
+    Returns None when the header is absent, malformed or asks for several
+    ranges (the full body is sent instead) and RANGE_NOT_SATISFIABLE when
+    the range lies outside the file.
+    """
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    start, sep, end = range_header[len('bytes='):].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length <= 0 or size == 0:
+                return RANGE_NOT_SATISFIABLE
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return RANGE_NOT_SATISFIABLE
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def _range_not_satisfiable(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{size}'
+    return response
+
+
+def _request_data(request):
+    """Form or JSON body of a plain Django request."""
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+    return request.POST
+
+
+def _error(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+
+@csrf_exempt
+async def file_collection(request):
+    """POST uploads asynchronously; everything else is the FileViewSet listing."""
+    if request.method == 'POST':
+        return await upload_files(request)
+    return await _list_files(request)
+
+
+async def upload_files(request):
+    # With user_id in the query string a request that cannot fit the plan is
+    # turned away from its Content-Length before the multipart body is parsed.
+    # Django's ASGIHandler has already received the whole body by now; the
+    # UploadQuotaMiddleware in config.asgi answers before that happens.
+    early_user_id = request.GET.get('user_id')
+    if early_user_id:
+        exceeded = await sync_to_async(check_declared_size)(early_user_id, request.META.get('CONTENT_LENGTH'))
+        if exceeded:
+            return _error(str(exceeded), exceeded.status_code)
+
+    # Parsing spools large files to disk, so it stays off the event loop
+    uploaded_files = await sync_to_async(lambda: request.FILES.getlist('files'))()
+    user_id = early_user_id or request.POST.get('user_id')
+    is_private = request.POST.get('is_private', True)
+
+    if not uploaded_files:
+        return _error('No files provided.', 400)
+
+    if not user_id:
+        return _error('user_id is required.', 400)
+
+    # Exact sizes are known once the body is parsed; check them before encrypting anything
+    sizes = [uploaded_file.size for uploaded_file in uploaded_files]
+    exceeded = await sync_to_async(check_plan)(
+        user_id, lambda entitlements, used: entitlements.check_upload(sizes, used)
+    )
+    if exceeded:
+        return _error(str(exceeded), exceeded.status_code)
+
+    if _is_true(request.GET.get('async', request.POST.get('async', settings.FILE_UPLOAD_ASYNC))):
+        created_files, errors = await sync_to_async(create_deferred)(uploaded_files, user_id, is_private)
+        return _created_response(request, user_id, created_files, errors, 202)
+
+    # 1️⃣ Hash every upload so repeated content is stored only once
+    errors = []
+    hashed = []
+    results = await asyncio.gather(
+        *(asyncio.to_thread(hash_upload, uploaded_file) for uploaded_file in uploaded_files), return_exceptions=True
+    )
+    for uploaded_file, result in zip(uploaded_files, results):
+        if isinstance(result, Exception):
+            errors.append({'file_name': uploaded_file.name, 'error': str(result)})
+        else:
+            hashed.append((uploaded_file, result))
+
+    # 2️⃣ Reference the existing blobs and reserve the new ones
+    try:
+        blobs = await sync_to_async(claim_blobs)([(sha256, f.size) for f, sha256 in hashed]) if hashed else {}
+    except Exception as e:
+        errors.extend({'file_name': f.name, 'error': str(e)} for f, _ in hashed)
+        hashed, blobs = [], {}
+
+    # 3️⃣ Encrypt and upload content that isn't stored yet, once per blob, concurrently.
+    # Only leased blobs are written here; identical content another upload holds is waited for.
+    pending = {sha256 for _, sha256 in hashed if not blobs[sha256].uploaded}
+    try:
+        leased = await sync_to_async(lease_uploads)(pending)
+    except Exception as e:
+        leased, failed_blobs = set(), {sha256: str(e) for sha256 in pending}
+    else:
+        failed_blobs = {}
+    writes = {}
+    for uploaded_file, sha256 in hashed:
+        if sha256 in leased and sha256 not in writes:
+            writes[sha256] = uploaded_file
+    limit = asyncio.Semaphore(settings.FILE_UPLOAD_MAX_WORKERS)
+    results = await asyncio.gather(
+        *(_upload_blob(limit, uploaded_file, blobs[sha256]) for sha256, uploaded_file in writes.items()),
+        return_exceptions=True
+    )
+    failed_blobs.update(
+        (sha256, str(result)) for sha256, result in zip(writes, results) if isinstance(result, Exception)
+    )
+    written = set(writes) - set(failed_blobs)
+    # Settled before waiting on others, so two uploads waiting on each other's leases can't deadlock
+    await sync_to_async(_settle_leases)(written, set(writes) & set(failed_blobs))
+    failed_blobs.update(await _wait_for_blobs(pending - leased - set(failed_blobs)))
+
+    created_files, save_errors = await sync_to_async(save_uploads)(
+        user_id, is_private, hashed, blobs, written, failed_blobs
+    )
+    return _created_response(request, user_id, created_files, errors + save_errors, 201)
+
+
+def _settle_leases(written, failed):
+    finish_uploads(written)
+    abandon_uploads(failed)
+
+
+async def _wait_for_blobs(hashes):
+    """Wait up to BLOB_UPLOAD_WAIT seconds for other uploads to store `hashes`; returns {sha256: error} for the rest."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.BLOB_UPLOAD_WAIT
+    delay = 0.05
+    while hashes:
+        hashes = hashes - await sync_to_async(uploaded_blobs)(hashes)
+        if not hashes or loop.time() >= deadline:
+            break
+        await asyncio.sleep(min(delay, max(0, deadline - loop.time())))
+        delay = min(delay * 2, 1)
+    return {sha256: 'Identical content is still being stored by another upload, try again' for sha256 in hashes}
+
+
+async def _upload_blob(limit, uploaded_file, blob):
+    """Encrypt one upload under its blob's data key and stream it to object storage."""
+    async with limit:
+        try:
+            await get_storage().aupload_stream(
+                BUCKET,
+                blob.storage_key,
+                encrypt_stream(uploaded_file.chunks(), key=blob_data_key(blob)),
+                encrypted_size(uploaded_file.size),
+                'application/octet-stream'
+            )
+        except StorageObjectExists:
+            # Only the lease holder writes, and objects appear whole, so this is a
+            # complete copy left by an earlier holder whose lease ran out
+            pass
+
+
+def _created_response(request, user_id, created_files, errors, success_status):
+    if not created_files:
+        return JsonResponse({'success': False, 'errors': errors}, status=400)
+    serializer = FileSerializer(created_files, many=True, context={'request': request, 'user_id': user_id})
+    response_data = {
+        'success': True,
+        'created_files': serializer.data,
+        'total_created': len(created_files)
+    }
+    if errors:
+        response_data['errors'] = errors
+        response_data['partial_success'] = True
+    return JsonResponse(response_data, status=success_status)
+
+
+@require_http_methods(["GET"])
+async def download_file(request, pk):
+    file = await File.objects.select_related('blob').filter(pk=pk).afirst()
+    if file is None:
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    if file.status != File.Status.READY:
+        message = 'File is still being processed' if file.status == File.Status.PENDING else 'File could not be stored'
+        return JsonResponse({'error': message, 'status': file.status}, status=409)
+    range_header = request.META.get('HTTP_RANGE')
+    storage = get_storage()
+
+    try:
+        # Deduplicated content lives under its blob key with its own data key
+        object_path = file.blob.storage_key if file.blob else file.name
+        key = blob_data_key(file.blob) if file.blob else STREAM_KEY
+        # Read the header and total size in one ranged request
+        try:
+            header, object_size = await storage.aread_head(BUCKET, object_path, STREAM_HEADER_SIZE)
+        except StorageObjectNotFound:
+            return _error('File not found in storage', 404)
+
+        if not is_stream_format(header):
+            # Legacy Fernet file - has to be decrypted in one piece
+            encrypted_content = await storage.adownload(BUCKET, object_path)
+            decrypted_content = await asyncio.to_thread(lambda: b"".join(decrypt_stream([encrypted_content])))
+            return _legacy_response(file, decrypted_content, range_header)
+
+        chunk_size, _ = parse_header(header)
+        size = plaintext_size(object_size, chunk_size)
+        byte_range = parse_range_header(range_header, size)
+        if byte_range is RANGE_NOT_SATISFIABLE:
+            return _range_not_satisfiable(size)
+
+        if byte_range:
+            # 🔐 Fetch and decrypt only the frames covering the requested bytes
+            start, end = byte_range
+            cipher_start, cipher_end = ciphertext_range(start, end, chunk_size)
+            frames = storage.adownload_range(BUCKET, object_path, cipher_start, min(cipher_end, object_size - 1))
+            response = StreamingHttpResponse(
+                adecrypt_range(header, frames, start, end, object_size, key=key),
+                content_type='application/octet-stream',
+                status=206
+            )
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        else:
+            # 🔐 Stream the ciphertext in ranges and decrypt frame by frame
+            frames = storage.adownload_range(BUCKET, object_path, STREAM_HEADER_SIZE)
+            response = StreamingHttpResponse(adecrypt_frames(header, frames, key=key), content_type='application/octet-stream')
+            response['Content-Length'] = size
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = f'attachment; filename="{file.name}"'
+        return response
+
+    except Exception as e:
+        return _error(str(e), 500)
+
+
+def _legacy_response(file, content, range_header):
+    byte_range = parse_range_header(range_header, len(content))
+    if byte_range is RANGE_NOT_SATISFIABLE:
+        return _range_not_satisfiable(len(content))
+    if byte_range:
+        start, end = byte_range
+        response = HttpResponse(content[start:end + 1], content_type='application/octet-stream', status=206)
+        response['Content-Range'] = f'bytes {start}-{end}/{len(content)}'
+    else:
+        response = HttpResponse(content, content_type='application/octet-stream')
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = f'attachment; filename="{file.name}"'
+    return response
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def share_file(request, pk):
+    data = _request_data(request)
+    shared_with_email = data.get('shared_with_email')
+    owner_id = data.get('owner_id')
+
+    if not shared_with_email:
+        return _error('shared_with_email is required', 400)
+
+    if not owner_id:
+        return _error('owner_id is required', 400)
+
+    # Verify that the file exists and user owns it
+    file = await File.objects.filter(id=pk, user_id=owner_id).afirst()
+    if file is None:
+        return _error('File not found or you do not own this file', 404)
+
+    try:
+        # 🆕 Resolve the email through the cached local user directory
+        shared_with_uuid = await sync_to_async(resolve_user_id)(shared_with_email)
+
+        if not shared_with_uuid:
+            return _error('User with this email not found in Supabase Auth', 404)
+
+        # Check if already shared
+        if await FileShare.objects.filter(file=file, shared_with_id=shared_with_uuid).aexists():
+            return _error('File already shared with this user', 400)
+
+        entitlements = await sync_to_async(get_entitlements)(owner_id)
+        if entitlements.max_shares is not None:
+            try:
+                entitlements.check_share(await FileShare.objects.filter(owner_id=owner_id).acount())
+            except PlanLimitExceeded as e:
+                return _error(str(e), e.status_code)
+
+        # Create share record
+        share = await FileShare.objects.acreate(
+            file=file,
+            owner_id=owner_id,
+            shared_with_id=shared_with_uuid
+        )
+
+        return JsonResponse({
+            'success': True,
+            'message': f'File shared successfully with {shared_with_email}',
+            'share': FileShareSerializer(share).data
+        }, status=201)
+
+    except Exception as e:
+        return _error(f'Failed to find user: {str(e)}', 500)
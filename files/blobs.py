@@ -0,0 +1,171 @@
+import hashlib
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from utils.keyring import current_key_id, master_key, rewrap_data_key, unwrap_data_key, wrap_data_key
+from utils.storage_backends import get_storage
+from utils.utils import generate_data_key
+from .models import Blob
+
+BUCKET = "uploads"
+BLOB_PREFIX = "blobs/"
+
+
+class BlobUploadPending(Exception):
+    """Another upload holds the lease on a blob's content and hasn't finished storing it."""
+
+
+def hash_upload(uploaded_file):
+    """SHA-256 of an upload's plaintext, read in chunks."""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_storage_key(sha256):
+    return f"{BLOB_PREFIX}{sha256}"
+
+
+def blob_data_key(blob):
+    return unwrap_data_key(blob.key_id, blob.data_key)
+
+
+def _new_blob(sha256, size):
+    key_id, wrapped = wrap_data_key(generate_data_key())
+    return Blob(sha256=sha256, storage_key=blob_storage_key(sha256), size=size, data_key=wrapped, key_id=key_id)
+
+
+def _adjust_ref_counts(counts):
+    # One UPDATE per distinct delta, which is a single UPDATE in the usual case
+    by_delta = defaultdict(list)
+    for sha256, delta in counts.items():
+        by_delta[delta].append(sha256)
+    now = timezone.now()
+    for delta, hashes in by_delta.items():
+        changes = {'ref_count': F('ref_count') + delta}
+        if delta > 0:
+            changes['last_claimed_at'] = now
+        Blob.objects.filter(pk__in=hashes).update(**changes)
+
+
+def claim_blobs(uploads):
+    """Take a reference on the blob for each (sha256, size) in `uploads`, creating missing blobs.
+
+    Returns {sha256: Blob}. New blobs get a fresh data key and are not
+    uploaded yet; the content is written by whoever wins lease_uploads(). The
+    references are taken before any File row exists so a concurrent
+    collect_blobs() cannot delete a blob that is about to be used.
+    """
+    counts = Counter(sha256 for sha256, _ in uploads)
+    sizes = dict(uploads)
+    with transaction.atomic():
+        blobs = Blob.objects.select_for_update().in_bulk(list(counts))
+        missing = [sha256 for sha256 in counts if sha256 not in blobs]
+        if missing:
+            Blob.objects.bulk_create([_new_blob(sha256, sizes[sha256]) for sha256 in missing], ignore_conflicts=True)
+            blobs.update(Blob.objects.select_for_update().in_bulk(missing))
+        _adjust_ref_counts(counts)
+    return blobs
+
+
+def lease_uploads(hashes):
+    """Take the right to store the content of the blobs in `hashes` that aren't uploaded yet.
+
+    Returns the hashes leased to the caller, who must follow up with
+    finish_uploads() or abandon_uploads(). A blob leased to someone else is
+    left out until that lease runs out (BLOB_UPLOAD_LEASE seconds), so only
+    one writer stores a given content at a time.
+    """
+    if not hashes:
+        return set()
+    now = timezone.now()
+    with transaction.atomic():
+        leased = set(
+            Blob.objects.select_for_update()
+            .filter(Q(upload_lease_until__isnull=True) | Q(upload_lease_until__lte=now), pk__in=list(hashes), uploaded=False)
+            .values_list('pk', flat=True)
+        )
+        if leased:
+            Blob.objects.filter(pk__in=leased).update(
+                upload_lease_until=now + timedelta(seconds=settings.BLOB_UPLOAD_LEASE)
+            )
+    return leased
+
+
+def finish_uploads(hashes):
+    """Record that the leased content of `hashes` is stored."""
+    if hashes:
+        Blob.objects.filter(pk__in=list(hashes)).update(uploaded=True, upload_lease_until=None)
+
+
+def abandon_uploads(hashes):
+    """Give up leases without storing the content, so another upload can take them at once."""
+    if hashes:
+        Blob.objects.filter(pk__in=list(hashes), uploaded=False).update(upload_lease_until=None)
+
+
+def uploaded_blobs(hashes):
+    """The subset of `hashes` whose content is stored."""
+    if not hashes:
+        return set()
+    return set(Blob.objects.filter(pk__in=list(hashes), uploaded=True).values_list('pk', flat=True))
+
+
+def release_blobs(hashes):
+    """Drop one reference per entry in `hashes`; unreferenced blobs are collected after commit."""
+    counts = Counter(hashes)
+    if not counts:
+        return
+    _adjust_ref_counts({sha256: -count for sha256, count in counts.items()})
+    transaction.on_commit(lambda: collect_blobs(list(counts)))
+
+
+def collect_blobs(hashes):
+    """Delete blobs (rows and stored objects) that no file references any more."""
+    removed = 0
+    for sha256 in hashes:
+        with transaction.atomic():
+            # The row stays locked until the object is gone, so a concurrent
+            # claim waits and then starts a fresh blob
+            blob = Blob.objects.select_for_update().filter(pk=sha256, ref_count__lte=0).first()
+            if blob is None:
+                continue
+            keys = list(blob.derivatives.values_list('storage_key', flat=True))
+            # A leased upload may have stored the content without getting to finish_uploads()
+            if blob.uploaded or blob.upload_lease_until is not None:
+                keys.append(blob.storage_key)
+            if keys:
+                get_storage().delete(BUCKET, keys)
+            blob.delete()
+            removed += 1
+    return removed
+
+
+def rotate_blob_keys(new_key_id=None, batch_size=1000):
+    """Re-wrap every blob's data key under master key `new_key_id` (default: the current one).
+
+    Only the wrapped keys in the database change; stored content is not
+    touched. Walks the blobs in primary key order, one bulk UPDATE per
+    batch. Yields the number of keys re-wrapped after each batch.
+    """
+    new_key_id = new_key_id or current_key_id()
+    master_key(new_key_id)  # fail before touching anything if the key isn't configured
+    last = ''
+    while True:
+        batch = list(
+            Blob.objects.exclude(key_id=new_key_id).filter(sha256__gt=last)
+            .order_by('sha256').only('sha256', 'key_id', 'data_key')[:batch_size]
+        )
+        if not batch:
+            return
+        for blob in batch:
+            blob.key_id, blob.data_key = rewrap_data_key(blob.key_id, blob.data_key, new_key_id)
+        Blob.objects.bulk_update(batch, ['key_id', 'data_key'])
+        last = batch[-1].sha256
+        yield len(batch)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from files.models import File, extension_from_name
+
+
+class Command(BaseCommand):
+    help = "Fill in File.extension for rows uploaded before the column existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        updated = 0
+        last_id = 0
+        while True:
+            batch = list(
+                File.objects.filter(id__gt=last_id, extension='')
+                .order_by('id')
+                .only('id', 'name', 'extension')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+            changed = []
+            for file in batch:
+                file.extension = extension_from_name(file.name)
+                if file.extension:
+                    changed.append(file)
+            File.objects.bulk_update(changed, ['extension'])
+            updated += len(changed)
+        self.stdout.write(self.style.SUCCESS(f"Backfilled extensions for {updated} files"))
@@ -0,0 +1,308 @@
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import struct
+import subprocess
+import tempfile
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from AppUser.models import UserDirectoryEntry
+from files.models import File, StorageUsage
+from subscriptions.entitlements import invalidate_entitlements
+from subscriptions.models import Subscription, SubscriptionPlan
+
+UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+DEFAULT_SIZES = '1KB,64KB,1MB,16MB,128MB'
+IO_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_size(text):
+    """'64KB' -> 65536"""
+    text = text.strip().upper()
+    number = text.rstrip('KMGB')
+    unit = text[len(number):] or 'B'
+    if not number.isdigit() or unit not in UNITS:
+        raise CommandError(f"Invalid size: {text!r} (use e.g. 1KB, 16MB, 1GB)")
+    return int(number) * UNITS[unit]
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def read_rss():
+    """(current, peak) resident set size of this process in bytes, or (None, None) off Linux."""
+    values = {}
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    values[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return None, None
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+def reset_peak_rss():
+    """Restart the kernel's peak RSS count for this process; False where that isn't possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def read_body(response):
+    if not response.streaming:
+        return response.content
+    if response.is_async:
+        async def read():
+            return b''.join([chunk async for chunk in response.streaming_content])
+        return async_to_sync(read)()
+    return b''.join(response.streaming_content)
+
+
+def body_length(response):
+    """Consume a response body without holding on to it, returning its length in bytes."""
+    if not response.streaming:
+        return len(response.content)
+    if response.is_async:
+        async def count():
+            return sum([len(chunk) async for chunk in response.streaming_content])
+        return async_to_sync(count)()
+    return sum(len(chunk) for chunk in response.streaming_content)
+
+
+def write_random_file(path, size):
+    """Fill `path` with `size` random bytes, one IO_CHUNK_SIZE block at a time."""
+    with open(path, 'wb') as out:
+        for offset in range(0, size, IO_CHUNK_SIZE):
+            out.write(os.urandom(min(IO_CHUNK_SIZE, size - offset)))
+
+
+class ChainedStream(io.RawIOBase):
+    """Read several binary streams back to back, closing each as it runs out."""
+
+    def __init__(self, streams):
+        self.streams = list(streams)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.streams:
+            count = self.streams[0].readinto(buffer)
+            if count:
+                return count
+            self.streams.pop(0).close()
+        return 0
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+        self.streams = []
+        super().close()
+
+
+def multipart_upload(path, filename, fields):
+    """WSGI environ for a multipart POST of the file at `path`, read from disk as the request is parsed."""
+    boundary = f'BenchmarkBoundary{uuid.uuid4().hex}'
+    head = ''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in fields.items()
+    ) + (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    )
+    head, tail = head.encode(), f'\r\n--{boundary}--\r\n'.encode()
+    stream = ChainedStream([io.BytesIO(head), open(path, 'rb'), io.BytesIO(tail)])
+    return {
+        'CONTENT_TYPE': f'multipart/form-data; boundary={boundary}',
+        'CONTENT_LENGTH': str(len(head) + os.path.getsize(path) + len(tail)),
+        'wsgi.input': io.BufferedReader(stream, IO_CHUNK_SIZE),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Time upload, list, download, share and total-size end to end and print the results as JSON. "
+        "Needs a configured database: DATABASE_URL (e.g. sqlite:///bench.sqlite3) or the SUPABASE_DB_* settings"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                            help=f"Comma-separated file sizes, 1KB up to 1GB (default: {DEFAULT_SIZES})")
+        parser.add_argument('--iterations', type=int, default=20, help="Requests per operation and size")
+        parser.add_argument('--max-bytes', type=parse_size, default=parse_size('512MB'),
+                            help="Cap on bytes uploaded per size; large sizes run fewer iterations (default: 512MB)")
+        parser.add_argument('--backend', choices=['memory', 'local'], default='memory',
+                            help="Storage stand-in; 'local' keeps large runs out of memory")
+        parser.add_argument('--no-test-db', action='store_true',
+                            help="Use the configured database instead of a throwaway test database "
+                                 "(the benchmark's rows are removed afterwards)")
+        parser.add_argument('--output', help="Also write the JSON report to this file")
+
+    def handle(self, *args, **options):
+        sizes = sorted(parse_size(size) for size in options['sizes'].split(','))
+        if options['iterations'] < 1:
+            raise CommandError("--iterations must be at least 1")
+
+        if not connection.settings_dict.get('NAME'):
+            raise CommandError(
+                "No database configured. Set DATABASE_URL (e.g. DATABASE_URL=sqlite:///bench.sqlite3) "
+                "or the SUPABASE_DB_* settings."
+            )
+
+        storage_root = tempfile.mkdtemp(prefix='benchmark-storage-')
+        old_name = None
+        if not options['no_test_db']:
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(STORAGE_BACKEND=options['backend'], STORAGE_ROOT=storage_root, FILE_UPLOAD_ASYNC=False,
+                                   ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                report = self.run(sizes, options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(storage_root, ignore_errors=True)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                out.write(output + '\n')
+        self.stdout.write(output)
+
+    def run(self, sizes, options):
+        owner = uuid.uuid4()
+        friend = uuid.uuid4()
+        # Top tier, so plan limits never turn benchmark requests away
+        plan = SubscriptionPlan.objects.create(name='Benchmark', tier='premium', price=0)
+        Subscription.objects.create(user_id=str(owner), plan=plan)
+        friend_email = f'benchmark-{friend}@example.com'
+        UserDirectoryEntry.objects.create(id=friend, email=friend_email, email_lower=friend_email)
+        invalidate_entitlements(str(owner))
+        try:
+            results = [self.run_size(size, options, owner, friend_email) for size in sizes]
+        finally:
+            File.objects.filter(user_id=owner).delete()
+            StorageUsage.objects.filter(user_id=owner).delete()
+            UserDirectoryEntry.objects.filter(id=friend).delete()
+            plan.delete()
+            invalidate_entitlements(str(owner))
+
+        return {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'storage_backend': options['backend'],
+            'results': results,
+        }
+
+    def run_size(self, size, options, owner, friend_email):
+        client = Client()
+        # Downloads go through ASGI, which streams them; under WSGI the body would be buffered
+        async_client = AsyncClient()
+        iterations = max(1, min(options['iterations'], options['max_bytes'] // size))
+        self.stderr.write(f"{size} bytes x {iterations}...")
+        timings = {name: [] for name in ['upload', 'list', 'download', 'share', 'total_size']}
+        queries = {name: [] for name in timings}
+        rss_growth = {name: [] for name in timings}
+        peak_rss = {name: [] for name in timings}
+
+        def timed(name, check_status, send, read=read_body):
+            # Memory is measured around this one request: the kernel's peak is
+            # reset first where allowed, otherwise the RSS after it is used
+            peak_reset = reset_peak_rss()
+            rss_before, _ = read_rss()
+            with CaptureQueriesContext(connection) as ctx:
+                started = time.perf_counter()
+                response = send()
+                body = read(response)
+                timings[name].append(time.perf_counter() - started)
+            rss_after, peak = read_rss()
+            if rss_before is not None:
+                peak = peak if peak_reset else rss_after
+                peak_rss[name].append(peak)
+                rss_growth[name].append(peak - rss_before)
+            if response.status_code != check_status:
+                detail = b'' if response.streaming else response.content[:500]
+                raise CommandError(f"{name} answered {response.status_code}: {detail!r}")
+            queries[name].append(len(ctx.captured_queries))
+            return body
+
+        # The payload lives on disk and is streamed into each request, so the
+        # benchmark itself never holds a copy of the file in memory
+        fd, payload = tempfile.mkstemp(prefix='benchmark-upload-')
+        os.close(fd)
+        file_ids = []
+        try:
+            write_random_file(payload, size)
+            for i in range(iterations):
+                # Distinct content per upload, so every one is encrypted and stored instead of deduplicated
+                with open(payload, 'r+b') as out:
+                    out.write(struct.pack('>Q', i)[:size])
+                environ = multipart_upload(payload, f'benchmark {size} {i}.bin', {'user_id': owner})
+                body = timed('upload', 201, lambda: client.generic('POST', '/api/files/', **environ))
+                file_ids.append(json.loads(body)['created_files'][0]['id'])
+        finally:
+            os.remove(payload)
+
+        share = {'shared_with_email': friend_email, 'owner_id': str(owner)}
+        for file_id in file_ids:
+            timed('list', 200, lambda: client.get(f'/api/files/?user_id={owner}'))
+            length = timed('download', 200, lambda: async_to_sync(async_client.get)(f'/api/files/{file_id}/download/'), read=body_length)
+            if length != size:
+                raise CommandError(f"download returned {length} bytes, expected {size}")
+            timed('share', 201, lambda: client.post(f'/api/files/{file_id}/share/', data=share))
+            client.post(f'/api/files/{file_id}/unshare/', data=share)
+            timed('total_size', 200, lambda: client.post('/api/files/total-size/', data={'user_id': str(owner)}))
+
+        # Frees the stored objects before the next size
+        File.objects.filter(pk__in=file_ids).delete()
+
+        operations = {}
+        for name, samples in timings.items():
+            total = sum(samples)
+            operations[name] = {
+                'count': len(samples),
+                'p50_ms': round(percentile(samples, 50) * 1000, 3),
+                'p99_ms': round(percentile(samples, 99) * 1000, 3),
+                'mean_ms': round(statistics.mean(samples) * 1000, 3),
+                'requests_per_second': round(len(samples) / total, 2) if total else None,
+                'queries_per_request': round(statistics.mean(queries[name]), 2),
+                # Highest RSS during one request, and the most one request grew it by (Linux only)
+                'peak_rss_bytes': max(peak_rss[name]) if peak_rss[name] else None,
+                'max_rss_growth_bytes': max(rss_growth[name]) if rss_growth[name] else None,
+            }
+            if name in ('upload', 'download'):
+                operations[name]['bytes_per_second'] = round(size * len(samples) / total) if total else None
+        return {
+            'size': size,
+            'iterations': iterations,
+            'operations': operations,
+        }
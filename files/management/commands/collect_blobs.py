@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from files.blobs import collect_blobs
+from files.models import Blob, File
+
+
+class Command(BaseCommand):
+    help = "Reset blob reference counts from the files table and delete blobs no file uses"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=60,
+                            help="Only touch blobs nobody claimed in this many minutes, so in-flight uploads "
+                                 "keep their claims")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        cutoff = now - timedelta(minutes=options['min_age'])
+        file_counts = File.objects.filter(blob=OuterRef('pk')).order_by().values('blob').annotate(n=Count('id')).values('n')
+        # An upload's claim counts before its File row exists, so recently claimed
+        # blobs and blobs still being stored are left alone
+        blobs = Blob.objects.filter(
+            Q(last_claimed_at__lt=cutoff) | Q(last_claimed_at__isnull=True, created_at__lt=cutoff)
+        ).exclude(upload_lease_until__gt=now)
+        recounted = blobs.update(ref_count=Coalesce(Subquery(file_counts), 0))
+        removed = collect_blobs(list(blobs.filter(ref_count__lte=0).values_list('sha256', flat=True)))
+        self.stdout.write(self.style.SUCCESS(f"Recounted {recounted} blobs, removed {removed} unused"))
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from files.models import Blob
+from files.previews import mark_preview_failed, render_stored_blob, wants_derivatives
+from files.rendering import IMAGE_EXTENSIONS
+
+
+class Command(BaseCommand):
+    help = "Render missing thumbnails and previews for stored images and PDFs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=500, help="Stop after this many blobs")
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Also retry blobs whose previews failed before (skipped by default)")
+
+    def handle(self, *args, **options):
+        blobs = (
+            Blob.objects.filter(
+                uploaded=True,
+                derivatives__isnull=True,
+                size__lte=settings.PREVIEW_MAX_SOURCE_BYTES,
+                files__extension__in=IMAGE_EXTENSIONS | {'pdf'},
+            )
+            .distinct()
+            .order_by('sha256')
+        )
+        if not options['retry_failed']:
+            # Content that can't be rendered would otherwise fill every run's --limit
+            blobs = blobs.filter(preview_failed_at__isnull=True)
+        done = failed = 0
+        for blob in blobs[:options['limit']]:
+            extension = blob.files.filter(extension__in=IMAGE_EXTENSIONS | {'pdf'}).values_list('extension', flat=True).first()
+            if not wants_derivatives(extension, blob.size):
+                continue
+            try:
+                render_stored_blob(blob, extension)
+                done += 1
+            except Exception as e:
+                failed += 1
+                mark_preview_failed(blob.sha256)
+                self.stderr.write(f"{blob.sha256}: {str(e)}")
+        self.stdout.write(self.style.SUCCESS(f"Rendered previews for {done} blobs ({failed} failed)"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from files.usage import rebuild_usage
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-user storage usage counters from the files table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='user_ids', help="Only rebuild these user ids")
+
+    def handle(self, *args, **options):
+        total = rebuild_usage(options['user_ids'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt storage usage for {total} users"))
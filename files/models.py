@@ -1,13 +1,116 @@
-from django.db import models
+import os
+
+from django.db import models, transaction
+
+
+def extension_from_name(name):
+    """Lowercase extension of a file name without the dot, or '' if it has none."""
+    _, ext = os.path.splitext(name or '')
+    return ext.lower().lstrip('.')[:32]
+
+
+class Blob(models.Model):
+    """Encrypted content stored once in the uploads bucket and shared by every File with that content."""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    storage_key = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    # Random per-blob key the content is encrypted with, wrapped under master key `key_id`
+    data_key = models.BinaryField()
+    key_id = models.CharField(max_length=32, default='legacy')
+    # Files pointing at this blob, plus uploads that have claimed it but not saved their File yet
+    ref_count = models.IntegerField(default=0)
+    # Last time an upload took a reference; blob maintenance leaves recently claimed blobs alone
+    last_claimed_at = models.DateTimeField(null=True, blank=True)
+    uploaded = models.BooleanField(default=False)
+    # Set while one upload holds the right to write the content; others wait for `uploaded`
+    upload_lease_until = models.DateTimeField(null=True, blank=True)
+    # Thumbnails/previews couldn't be rendered; generate_previews skips the blob unless asked to retry
+    preview_failed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Key rotation walks the blobs still wrapped under a given master key
+            models.Index(fields=['key_id', 'sha256'], name='blob_key_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.storage_key} ({self.ref_count} refs)"
+
+
+class BlobDerivative(models.Model):
+    """Encrypted thumbnail or preview rendered from a blob, stored next to it under the same data key."""
+    blob = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name='derivatives')
+    kind = models.CharField(max_length=20)
+    storage_key = models.CharField(max_length=255, unique=True)
+    size = models.IntegerField()
+    width = models.IntegerField()
+    height = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['blob', 'kind'], name='blobderivative_blob_kind_uniq'),
+        ]
+
+    def __str__(self):
+        return self.storage_key
+
 
 class File(models.Model):
+
+    class Status(models.TextChoices):
+        # Accepted and spooled; a worker has yet to encrypt and store it
+        PENDING = 'pending', 'Pending'
+        READY = 'ready', 'Ready'
+        FAILED = 'failed', 'Failed'
+
     user_id = models.UUIDField()
+    # None for files uploaded before content-addressed storage; those live under `name`
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.PROTECT, related_name='files')
     name = models.CharField(max_length=255)
     file = models.URLField(blank=True, null=True)
     size = models.BigIntegerField(blank=True, null=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     isStarred = models.BooleanField(default=False)
     is_private = models.BooleanField(default=True)
+    extension = models.CharField(max_length=32, blank=True, default='')
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.READY)
+
+    class Meta:
+        indexes = [
+            # Owned-file listing and keyset pagination, total size per user
+            models.Index(fields=['user_id', 'uploaded_at', 'id'], name='file_user_uploaded_idx'),
+            # Starred filter
+            models.Index(fields=['user_id', 'isStarred'], name='file_user_starred_idx'),
+            # Listing without a user filter
+            models.Index(fields=['uploaded_at', 'id'], name='file_uploaded_idx'),
+            # File type breakdowns (GROUP BY extension), overall and per user
+            models.Index(fields=['extension'], name='file_extension_idx'),
+            models.Index(fields=['user_id', 'extension'], name='file_user_extension_idx'),
+            # Display-name collisions on upload
+            models.Index(fields=['user_id', 'name'], name='file_user_name_idx'),
+        ]
+
+    # Fields the per-user usage counters are derived from
+    USAGE_FIELDS = ('user_id', 'size', 'isStarred')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remembered so the usage counters can apply what a save changed
+        instance._loaded_usage = instance.usage_state()
+        return instance
+
+    def usage_state(self):
+        """Loaded values of USAGE_FIELDS (deferred fields are left out)."""
+        return {field: self.__dict__[field] for field in self.USAGE_FIELDS if field in self.__dict__}
+
+    def save(self, *args, **kwargs):
+        self.extension = extension_from_name(self.name)
+        # The post_save usage counter update commits or rolls back with the row
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.name} by {self.user_id}"
@@ -21,6 +124,23 @@ class FileShare(models.Model):
     
     class Meta:
         unique_together = ['file', 'shared_with_id']
+        indexes = [
+            # shared-with-me and the shared half of the file listing
+            models.Index(fields=['shared_with_id', 'shared_at'], name='fileshare_shared_with_idx'),
+            # share count checked against the owner's plan limit
+            models.Index(fields=['owner_id'], name='fileshare_owner_idx'),
+        ]
     
     def __str__(self):
-        return f"{self.file.name} shared by {self.owner_id} with {self.shared_with_id}"
\ No newline at end of file
+        return f"{self.file.name} shared by {self.owner_id} with {self.shared_with_id}"
+
+class StorageUsage(models.Model):
+    """Per-user storage counters, kept in step with File inserts and deletes."""
+    user_id = models.UUIDField(primary_key=True)
+    total_bytes = models.BigIntegerField(default=0)
+    file_count = models.IntegerField(default=0)
+    starred_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.total_bytes} bytes in {self.file_count} files"
@@ -0,0 +1,36 @@
+import os
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+
+from .models import File
+
+
+def _numbered(base, ext, n):
+    return f"{base} ({n}){ext}"
+
+
+def assign_display_names(user_id, names):
+    """Give each name a form that is free among the user's files: "report.pdf", "report (1).pdf", ...
+
+    All existing names that could collide are read in one query on
+    (user_id, name); duplicates within `names` are numbered in order.
+    """
+    if not names:
+        return []
+    split = [os.path.splitext(name) for name in names]
+    candidates = Q(name__in=set(names)) | reduce(or_, (
+        Q(name__startswith=f"{base} (", name__endswith=f"){ext}") for base, ext in set(split)
+    ))
+    taken = set(File.objects.filter(candidates, user_id=user_id).values_list('name', flat=True))
+
+    assigned = []
+    for name, (base, ext) in zip(names, split):
+        n = 0
+        while name in taken:
+            n += 1
+            name = _numbered(base, ext, n)
+        taken.add(name)
+        assigned.append(name)
+    return assigned
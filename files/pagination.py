@@ -0,0 +1,96 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class FileCursorPagination(BasePagination):
+    """Keyset pagination over files, newest first, ordered by (uploaded_at, id).
+
+    Every page is fetched with a range condition on the ordering columns
+    instead of an OFFSET, so the cost of a page does not grow with the size
+    of the library. Several querysets (e.g. owned files and files shared
+    with the user) can be paginated together as one UNION ALL.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    ordering = ('-uploaded_at', '-id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_querysets([queryset], request)
+
+    def paginate_querysets(self, querysets, request):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+
+        parts = []
+        for queryset in querysets:
+            if position:
+                uploaded_at, pk = position
+                queryset = queryset.filter(Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lt=pk))
+            parts.append(queryset.order_by())
+
+        combined = parts[0] if len(parts) == 1 else parts[0].union(*parts[1:], all=True)
+        rows = list(combined.order_by(*self.ordering)[:self.page_size + 1])
+
+        self.has_next = len(rows) > self.page_size
+        page = []
+        seen = set()
+        for row in rows[:self.page_size]:
+            # A file can come back from more than one part of the UNION ALL
+            if row.pk not in seen:
+                seen.add(row.pk)
+                page.append(row)
+        self.last = rows[self.page_size - 1] if self.has_next else None
+        return page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            uploaded_at, pk = base64.urlsafe_b64decode(encoded.encode()).decode().split('|')
+            return datetime.fromisoformat(uploaded_at), int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+
+    def encode_cursor(self, instance):
+        raw = f"{instance.uploaded_at.isoformat()}|{instance.pk}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,114 @@
+import multiprocessing
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+from utils.cache import LRUTTLCache
+from utils.storage import StorageObjectExists
+from utils.storage_backends import get_storage
+from utils.utils import decrypt_stream, encrypt_stream, encrypted_size
+from .blobs import BUCKET, blob_data_key
+from .models import Blob, BlobDerivative
+from .rendering import DERIVATIVE_SIZES, can_render, render_derivatives
+
+DERIVATIVE_CONTENT_TYPE = 'image/webp'
+
+# Decrypted derivatives are small and immutable, so hot thumbnails stay in memory
+_derivative_cache = LRUTTLCache(maxsize=512, ttl=600)
+
+
+_pool_lock = threading.Lock()
+_render_pool = None
+
+
+class PreviewRenderTimeout(Exception):
+    """Rendering took longer than PREVIEW_RENDER_TIMEOUT; the render processes were killed."""
+
+
+def _get_render_pool():
+    global _render_pool
+    with _pool_lock:
+        if _render_pool is None:
+            # spawn: the workers only import files.rendering, never the forked app state
+            _render_pool = multiprocessing.get_context('spawn').Pool(
+                processes=settings.PREVIEW_MAX_WORKERS,
+                maxtasksperchild=100,
+            )
+        return _render_pool
+
+
+def _kill_render_pool(pool):
+    global _render_pool
+    with _pool_lock:
+        pool.terminate()
+        if _render_pool is pool:
+            _render_pool = None
+
+
+def render_isolated(func, *args):
+    """Run `func(*args)` in the render process pool, killing it after PREVIEW_RENDER_TIMEOUT seconds.
+
+    Decoding untrusted images and PDFs can crash or hang; in a separate
+    process neither takes the job worker down with it. With
+    PREVIEW_MAX_WORKERS=0 the call runs inline.
+    """
+    if not settings.PREVIEW_MAX_WORKERS:
+        return func(*args)
+    pool = _get_render_pool()
+    try:
+        return pool.apply_async(func, args).get(timeout=settings.PREVIEW_RENDER_TIMEOUT)
+    except multiprocessing.TimeoutError:
+        _kill_render_pool(pool)
+        raise PreviewRenderTimeout(f"Rendering took longer than {settings.PREVIEW_RENDER_TIMEOUT}s")
+
+
+def wants_derivatives(extension, size):
+    return can_render(extension) and (size or 0) <= settings.PREVIEW_MAX_SOURCE_BYTES
+
+
+def derivative_storage_key(blob, kind):
+    return f"{blob.storage_key}.{kind}.webp"
+
+
+def build_derivatives(sha256, data, extension):
+    """Render, encrypt with the blob's data key, upload and record every derivative of a blob."""
+    blob = Blob.objects.get(pk=sha256)
+    key = blob_data_key(blob)
+    storage = get_storage()
+    rows = []
+    for kind, (image, width, height) in render_isolated(render_derivatives, data, extension).items():
+        storage_key = derivative_storage_key(blob, kind)
+        try:
+            storage.upload_stream(BUCKET, storage_key, encrypt_stream([image], key=key), encrypted_size(len(image)), 'application/octet-stream')
+        except StorageObjectExists:
+            pass
+        rows.append(BlobDerivative(blob=blob, kind=kind, storage_key=storage_key, size=len(image), width=width, height=height))
+    BlobDerivative.objects.bulk_create(rows, ignore_conflicts=True)
+    return rows
+
+
+def render_stored_blob(blob, extension):
+    """Build a blob's derivatives from its stored content."""
+    encrypted = get_storage().download(BUCKET, blob.storage_key)
+    data = b"".join(decrypt_stream([encrypted], key=blob_data_key(blob)))
+    return build_derivatives(blob.sha256, data, extension)
+
+
+def mark_preview_failed(sha256):
+    """Remember that a blob's derivatives couldn't be built, so generate_previews doesn't retry it every run."""
+    Blob.objects.filter(pk=sha256).update(preview_failed_at=timezone.now())
+
+
+def load_derivative(derivative):
+    """Decrypted image bytes of a derivative (its blob must be loaded with it)."""
+    content = _derivative_cache.get(derivative.storage_key)
+    if content is None:
+        encrypted = get_storage().download(BUCKET, derivative.storage_key)
+        content = b"".join(decrypt_stream([encrypted], key=blob_data_key(derivative.blob)))
+        _derivative_cache.set(derivative.storage_key, content)
+    return content
+
+
+def is_derivative_kind(kind):
+    return kind in DERIVATIVE_SIZES
@@ -0,0 +1,67 @@
+"""Thumbnail and preview rendering.
+
+Runs in worker processes, so this module must not import Django.
+Pillow and pypdfium2 are optional; without them nothing is rendered.
+"""
+import io
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# kind -> bounding box of the rendered image
+DERIVATIVE_SIZES = {
+    'thumbnail': (256, 256),
+    'preview': (1024, 1024),
+}
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff'}
+WEBP_QUALITY = 80
+
+
+def can_render(extension):
+    if Image is None:
+        return False
+    if extension == 'pdf':
+        return pdfium is not None
+    return extension in IMAGE_EXTENSIONS
+
+
+def _first_page(data):
+    pdf = pdfium.PdfDocument(data)
+    try:
+        page = pdf[0]
+        width, height = page.get_size()
+        # Render just large enough for the biggest derivative
+        scale = max(DERIVATIVE_SIZES['preview']) / max(width, height)
+        return page.render(scale=scale).to_pil()
+    finally:
+        pdf.close()
+
+
+def render_derivatives(data, extension):
+    """Render every derivative kind of an image or PDF as WebP.
+
+    Returns {kind: (webp_bytes, width, height)}.
+    """
+    if extension == 'pdf':
+        image = _first_page(data)
+    else:
+        image = Image.open(io.BytesIO(data))
+        # Decode at a reduced scale where the format allows it (JPEG)
+        image.draft('RGB', DERIVATIVE_SIZES['preview'])
+        image = ImageOps.exif_transpose(image)
+    image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+    derivatives = {}
+    for kind, size in sorted(DERIVATIVE_SIZES.items(), key=lambda item: -max(item[1])):
+        image.thumbnail(size)
+        buffer = io.BytesIO()
+        image.save(buffer, 'WEBP', quality=WEBP_QUALITY)
+        derivatives[kind] = (buffer.getvalue(), image.width, image.height)
+    return derivatives
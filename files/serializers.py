@@ -1,12 +1,23 @@
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 from .models import File, FileShare
+from .rendering import can_render
 
 class FileSerializer(serializers.ModelSerializer):
     is_owner = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
     
     class Meta:
         model = File
-        fields = ['id', 'user_id', 'name', 'file', 'size', 'uploaded_at', 'isStarred', 'is_private', 'is_owner']
+        fields = ['id', 'user_id', 'name', 'file', 'size', 'uploaded_at', 'isStarred', 'is_private', 'status', 'is_owner', 'preview_url']
+        # Set by the upload path only; the usage counters and stored content depend on them
+        read_only_fields = ['user_id', 'file', 'size', 'status']
+    
+    def get_preview_url(self, obj):
+        """Thumbnail endpoint for images and PDFs (404 until the thumbnail has been rendered)."""
+        if not can_render(obj.extension):
+            return None
+        return reverse('file-preview', args=[obj.pk], request=self.context.get('request'))
     
     def get_is_owner(self, obj):
         request = self.context.get('request')
@@ -0,0 +1,36 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .blobs import release_blobs
+from .models import File
+from .usage import apply_usage_delta
+
+
+@receiver(post_save, sender=File)
+def update_usage_on_save(sender, instance, created, **kwargs):
+    new = instance.usage_state()
+    if created:
+        apply_usage_delta(instance.user_id, instance.size or 0, 1, 1 if instance.isStarred else 0)
+    else:
+        old = getattr(instance, '_loaded_usage', None)
+        if old is not None:
+            _apply_change({**new, **old}, {**old, **new})
+    instance._loaded_usage = new
+
+
+def _apply_change(old, new):
+    """Move a saved file's contribution to the counters from its loaded values to its saved ones."""
+    old_size, new_size = old.get('size') or 0, new.get('size') or 0
+    old_starred, new_starred = (1 if old.get('isStarred') else 0), (1 if new.get('isStarred') else 0)
+    if str(old.get('user_id')) != str(new.get('user_id')):
+        apply_usage_delta(old.get('user_id'), -old_size, -1, -old_starred)
+        apply_usage_delta(new.get('user_id'), new_size, 1, new_starred)
+    else:
+        apply_usage_delta(new.get('user_id'), new_size - old_size, 0, new_starred - old_starred)
+
+
+@receiver(post_delete, sender=File)
+def update_usage_on_delete(sender, instance, **kwargs):
+    apply_usage_delta(instance.user_id, -(instance.size or 0), -1, -1 if instance.isStarred else 0)
+    if instance.blob_id:
+        release_blobs([instance.blob_id])
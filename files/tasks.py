@@ -0,0 +1,145 @@
+"""Background jobs of the files app, run by `manage.py run_jobs`."""
+import os
+import uuid
+
+from django.conf import settings
+from django.core.files import File as StoredFile
+from django.db import transaction
+
+from jobs.queue import enqueue_many, register
+from utils.storage import StorageObjectExists
+from utils.storage_backends import get_storage
+from utils.utils import encrypt_stream, encrypted_size
+from .blobs import (
+    BUCKET,
+    BlobUploadPending,
+    abandon_uploads,
+    blob_data_key,
+    claim_blobs,
+    finish_uploads,
+    hash_upload,
+    lease_uploads,
+    uploaded_blobs,
+)
+from .models import Blob, File, extension_from_name
+from .previews import build_derivatives, mark_preview_failed, render_stored_blob, wants_derivatives
+
+STORE_UPLOAD = 'files.store_upload'
+RENDER_PREVIEWS = 'files.render_previews'
+
+
+def spool_upload(uploaded_file):
+    """Copy an upload's plaintext to the spool directory. Returns the spooled path."""
+    os.makedirs(settings.FILE_UPLOAD_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(settings.FILE_UPLOAD_SPOOL_DIR, uuid.uuid4().hex)
+    with open(path, 'wb') as spooled:
+        for chunk in uploaded_file.chunks():
+            spooled.write(chunk)
+    return path
+
+
+def discard_spooled(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def queue_uploads(spooled_files):
+    """Queue storing each pending file from its spooled copy; [(File, path)] -> one INSERT."""
+    return enqueue_many(STORE_UPLOAD, [{'file_id': file.pk, 'spool_path': path} for file, path in spooled_files])
+
+
+def _upload_failed(error, file_id, spool_path):
+    # Deleting the pending file gives back its quota and blob reference through the File signals
+    for file in File.objects.filter(pk=file_id, status=File.Status.PENDING):
+        file.delete()
+    discard_spooled(spool_path)
+    print(f"💥 Storing upload {file_id} failed: {error}")
+
+
+@register(STORE_UPLOAD, on_failure=_upload_failed)
+def store_upload(file_id, spool_path):
+    """Encrypt and store a pending file's spooled content, then mark the file ready.
+
+    Every step can be repeated: the blob reference is taken together with
+    setting the file's blob, and content already stored is not written again.
+    """
+    file = File.objects.select_related('blob').filter(pk=file_id).first()
+    if file is None or file.status != File.Status.PENDING:
+        # Deleted while it waited, or stored by an earlier attempt
+        discard_spooled(spool_path)
+        return
+
+    with StoredFile(open(spool_path, 'rb')) as spooled:
+        _store_spooled(file, spooled)
+    discard_spooled(spool_path)
+
+
+def _store_spooled(file, spooled):
+    size = spooled.size
+    blob = file.blob
+    if blob is None:
+        sha256 = hash_upload(spooled)
+        with transaction.atomic():
+            if not File.objects.select_for_update().filter(pk=file.pk, status=File.Status.PENDING).exists():
+                return
+            blob = claim_blobs([(sha256, size)])[sha256]
+            File.objects.filter(pk=file.pk).update(blob=blob)
+
+    storage = get_storage()
+    stored = bool(not blob.uploaded and lease_uploads([blob.sha256]))
+    if stored:
+        spooled.seek(0)
+        try:
+            storage.upload_stream(
+                BUCKET,
+                blob.storage_key,
+                encrypt_stream(spooled.chunks(), key=blob_data_key(blob)),
+                encrypted_size(size),
+                'application/octet-stream'
+            )
+        except StorageObjectExists:
+            # A complete copy left by an earlier lease holder
+            pass
+        except Exception:
+            abandon_uploads([blob.sha256])
+            raise
+        finish_uploads([blob.sha256])
+    elif not uploaded_blobs([blob.sha256]):
+        # Another upload is storing the same content; the retry picks it up once it's done
+        raise BlobUploadPending(blob.sha256)
+
+    File.objects.filter(pk=file.pk, status=File.Status.PENDING).update(
+        status=File.Status.READY,
+        file=storage.public_url(BUCKET, blob.storage_key),
+    )
+
+    # The worker is already off the request path, so previews are rendered here
+    extension = extension_from_name(file.name)
+    if stored and wants_derivatives(extension, size):
+        spooled.seek(0)
+        try:
+            build_derivatives(blob.sha256, spooled.read(), extension)
+        except Exception as e:
+            print(f"💥 Preview generation failed for {blob.sha256}: {str(e)}")
+            mark_preview_failed(blob.sha256)
+
+
+def queue_previews(blobs):
+    """Queue rendering thumbnails and previews of stored blobs; [(sha256, extension)] -> one INSERT."""
+    return enqueue_many(RENDER_PREVIEWS, [{'sha256': sha256, 'extension': extension} for sha256, extension in blobs])
+
+
+def _previews_failed(error, sha256, extension):
+    mark_preview_failed(sha256)
+
+
+@register(RENDER_PREVIEWS, on_failure=_previews_failed)
+def render_previews(sha256, extension):
+    """Render a blob's derivatives from its stored content, off the request path."""
+    blob = Blob.objects.filter(pk=sha256, uploaded=True).first()
+    if blob is None or blob.derivatives.exists():
+        # Collected while it waited, or rendered by an earlier attempt
+        return
+    render_stored_blob(blob, extension)
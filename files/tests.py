@@ -1,3 +1,929 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import httpx
+from asgiref.sync import async_to_sync
+from cryptography.exceptions import InvalidTag
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from AppUser.models import UserDirectoryEntry
+from jobs.models import Job
+from jobs.queue import run_due_jobs
+from subscriptions.entitlements import TIER_LIMITS, invalidate_entitlements
+from subscriptions.models import Subscription, SubscriptionPlan
+from utils import storage as supabase_storage
+from utils.cache import LRUTTLCache
+from utils.storage import StorageObjectExists, StorageObjectNotFound
+from utils.storage_backends import LocalStorageBackend, StorageBackend, get_storage
+from utils.utils import (
+    STREAM_HEADER_SIZE, STREAM_TAG_SIZE, adecrypt_frames, adecrypt_range, ciphertext_range, decrypt_range,
+    decrypt_stream, encrypt_stream, encrypted_size, fernet, is_stream_format, plaintext_size,
+)
+from .asgi import UploadQuotaMiddleware
+from .blobs import BUCKET, blob_data_key, claim_blobs, finish_uploads, lease_uploads
+from . import previews, uploads
+from .models import Blob, File, FileShare, StorageUsage
+from .previews import PreviewRenderTimeout, render_isolated
+from .rendering import Image, pdfium, render_derivatives
+from .usage import apply_usage_delta, count_all_files, rebuild_usage
+
+
+def read_streaming(response):
+    """Body of a streaming response from an async view."""
+    async def read():
+        return b''.join([chunk async for chunk in response.streaming_content])
+    return async_to_sync(read)()
+
+
+class StreamFormatTests(TestCase):
+    """The chunked encryption format in utils.utils, with small frames so files span several."""
+    chunk_size = 16
+
+    def setUp(self):
+        self.plain = os.urandom(self.chunk_size * 3 + 5)
+        self.encrypted = b''.join(encrypt_stream([self.plain], chunk_size=self.chunk_size))
+
+    def split(self, encrypted):
+        frame_size = self.chunk_size + STREAM_TAG_SIZE
+        body = encrypted[STREAM_HEADER_SIZE:]
+        return encrypted[:STREAM_HEADER_SIZE], [body[i:i + frame_size] for i in range(0, len(body), frame_size)]
+
+    def decrypt(self, encrypted):
+        # Deliberately uneven reads
+        return b''.join(decrypt_stream(encrypted[i:i + 7] for i in range(0, len(encrypted), 7)))
+
+    def test_round_trip_and_sizes(self):
+        self.assertTrue(is_stream_format(self.encrypted))
+        self.assertEqual(self.decrypt(self.encrypted), self.plain)
+        self.assertEqual(len(self.encrypted), encrypted_size(len(self.plain), self.chunk_size))
+        self.assertEqual(plaintext_size(len(self.encrypted), self.chunk_size), len(self.plain))
+
+        empty = b''.join(encrypt_stream([], chunk_size=self.chunk_size))
+        self.assertEqual(len(empty), encrypted_size(0, self.chunk_size))
+        self.assertEqual(self.decrypt(empty), b'')
+
+    def test_tampered_frame_fails(self):
+        tampered = bytearray(self.encrypted)
+        tampered[STREAM_HEADER_SIZE + self.chunk_size + STREAM_TAG_SIZE + 3] ^= 1
+        with self.assertRaises(InvalidTag):
+            self.decrypt(bytes(tampered))
+
+    def test_tampered_header_fails(self):
+        header, frames = self.split(self.encrypted)
+        header = header[:-1] + bytes([header[-1] ^ 1])
+        with self.assertRaises(InvalidTag):
+            self.decrypt(header + b''.join(frames))
+
+    def test_truncated_stream_fails(self):
+        with self.assertRaises(InvalidTag):
+            self.decrypt(self.encrypted[:-3])
+        with self.assertRaises(ValueError):
+            self.decrypt(self.encrypted[:STREAM_HEADER_SIZE])
+
+    def test_dropped_final_frame_fails(self):
+        header, frames = self.split(self.encrypted)
+        with self.assertRaises(InvalidTag):
+            self.decrypt(header + b''.join(frames[:-1]))
+
+    def test_reordered_frames_fail(self):
+        header, frames = self.split(self.encrypted)
+        frames[0], frames[1] = frames[1], frames[0]
+        with self.assertRaises(InvalidTag):
+            self.decrypt(header + b''.join(frames))
+
+    def test_range_decrypts_only_the_covering_frames(self):
+        header = self.encrypted[:STREAM_HEADER_SIZE]
+        for start, end in [(0, 0), (5, 20), (15, 16), (40, len(self.plain) - 1)]:
+            first, last = ciphertext_range(start, end, self.chunk_size)
+            frames = self.encrypted[first:last + 1]
+            self.assertEqual(
+                b''.join(decrypt_range(header, [frames], start, end, len(self.encrypted))),
+                self.plain[start:end + 1],
+            )
+
+    def test_range_checks_the_final_frame(self):
+        # The last frame must still be the last frame of the file
+        header, frames = self.split(self.encrypted)
+        shortened = header + b''.join(frames[:-1])
+        first, last = ciphertext_range(32, 47, self.chunk_size)
+        with self.assertRaises(InvalidTag):
+            b''.join(decrypt_range(header, [shortened[first:last + 1]], 32, 47, len(shortened)))
+
+    def test_async_helpers_match(self):
+        async def chunks(data):
+            for i in range(0, len(data), 7):
+                yield data[i:i + 7]
+
+        async def read(stream):
+            return b''.join([chunk async for chunk in stream])
+
+        header, frames = self.split(self.encrypted)
+        body = b''.join(frames)
+        self.assertEqual(async_to_sync(read)(adecrypt_frames(header, chunks(body))), self.plain)
+        first, last = ciphertext_range(5, 40, self.chunk_size)
+        self.assertEqual(
+            async_to_sync(read)(adecrypt_range(header, chunks(self.encrypted[first:last + 1]), 5, 40, len(self.encrypted))),
+            self.plain[5:41],
+        )
+        with self.assertRaises(InvalidTag):
+            async_to_sync(read)(adecrypt_frames(header, chunks(b''.join(frames[:-1]))))
+
+    def test_legacy_fernet_files_are_detected(self):
+        token = fernet.encrypt(self.plain)
+        self.assertFalse(is_stream_format(token))
+        self.assertEqual(self.decrypt(token), self.plain)
+
+
+@override_settings(STORAGE_BACKEND='memory')
+class FilesTestCase(TestCase):
+    """Seeded files, shares and usage shared by the files API tests, on the in-memory storage backend."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = uuid.uuid4()
+        cls.friend = uuid.uuid4()
+        cls.other = uuid.uuid4()
+        File.objects.bulk_create(
+            [File(user_id=cls.owner, name=f"report {i}.pdf", extension='pdf', size=1000 + i, isStarred=i % 5 == 0)
+             for i in range(120)]
+            + [File(user_id=cls.other, name=f"photo {i}.jpg", extension='jpg', size=2000 + i) for i in range(120)]
+            + [File(user_id=cls.other, name=f"notes {i}", size=10) for i in range(10)]
+        )
+        cls.file = File.objects.filter(user_id=cls.owner).first()
+        FileShare.objects.bulk_create([
+            FileShare(file=f, owner_id=cls.other, shared_with_id=cls.owner)
+            for f in File.objects.filter(user_id=cls.other)[:40]
+        ])
+        UserDirectoryEntry.objects.create(id=cls.friend, email='friend@example.com', email_lower='friend@example.com')
+        rebuild_usage()
+
+    def setUp(self):
+        self.client = APIClient()
+        from AppUser import directory
+        directory._email_cache.clear()
+        invalidate_entitlements()
+        self.storage = get_storage()
+        self.storage.clear()
+
+    # -----------------------------------------------------------------
+    # helpers
+    # -----------------------------------------------------------------
+    def spy(self, method, **kwargs):
+        """Patch a method of the in-memory storage, calling through unless told otherwise."""
+        return mock.patch.object(self.storage, method, **(kwargs or {'wraps': getattr(self.storage, method)}))
+
+    def capture(self, method, url, expected_queries, **kwargs):
+        """Run a request and assert its query count, not counting savepoint bookkeeping."""
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 300, getattr(response, 'data', response))
+        queries = [q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql'].upper()]
+        self.assertEqual(len(queries), expected_queries, '\n'.join(q['sql'] for q in queries))
+        return response, queries
+
+    def upload(self, user_id, *contents, extension='txt'):
+        uploads = [SimpleUploadedFile(f'copy {i}.{extension}', content) for i, content in enumerate(contents)]
+        with self.spy('aupload_stream') as upload:
+            response = self.client.post('/api/files/', data={'user_id': str(user_id), 'files': uploads})
+        self.assertEqual(response.status_code, 201, response.content)
+        return response, upload
+
+
+class FileViewSetQueryTests(FilesTestCase):
+    """Query counts and index usage for every FileViewSet action.
+
+    Runs against whatever DATABASE_URL points at (SQLite or a local
+    Postgres), e.g. DATABASE_URL=sqlite:///test.sqlite3 python manage.py test
+    """
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # The seeded tables are tiny; make the planner show whether an index *can* be used
+                cursor.execute('SET enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}')
+                return '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queries, *index_names):
+        """Assert that one of the captured SELECTs is planned with one of `index_names`."""
+        plans = [self.explain(q['sql']) for q in queries if q['sql'].lstrip().upper().startswith(('SELECT', '('))]
+        for plan in plans:
+            if any(name in plan for name in index_names):
+                return
+        self.fail(f"None of {index_names} used in:\n" + '\n---\n'.join(plans))
+
+    # -----------------------------------------------------------------
+    # listing
+    # -----------------------------------------------------------------
+    def test_list_owned_and_shared_is_one_query(self):
+        response, queries = self.capture('get', f'/api/files/?user_id={self.owner}&page_size=20', 1)
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertUsesIndex(queries, 'file_user_uploaded_idx')
+        self.assertUsesIndex(queries, 'fileshare_shared_with_idx')
+
+    def test_list_next_page_is_one_query(self):
+        first = self.client.get(f'/api/files/?user_id={self.owner}&page_size=50').data
+        response, queries = self.capture('get', first['next'], 1)
+        self.assertEqual(len(response.data['results']), 50)
+        self.assertUsesIndex(queries, 'file_user_uploaded_idx')
+
+    def test_list_starred(self):
+        _, queries = self.capture('get', f'/api/files/?user_id={self.owner}&starred=true', 1)
+        self.assertUsesIndex(queries, 'file_user_starred_idx', 'file_user_uploaded_idx')
+
+    def test_list_shared_only(self):
+        response, queries = self.capture('get', f'/api/files/?user_id={self.owner}&shared_only=true', 1)
+        self.assertEqual(len(response.data['results']), 40)
+        self.assertUsesIndex(queries, 'fileshare_shared_with_idx')
+
+    def test_retrieve(self):
+        self.capture('get', f'/api/files/{self.file.pk}/?user_id={self.owner}', 1)
+
+    # -----------------------------------------------------------------
+    # actions
+    # -----------------------------------------------------------------
+    def test_shared_with_me(self):
+        _, queries = self.capture('get', f'/api/files/shared-with-me/?user_id={self.owner}', 1)
+        self.assertUsesIndex(queries, 'fileshare_shared_with_idx')
+
+    def test_total_size(self):
+        response, queries = self.capture('post', '/api/files/total-size/', 1, data={'user_id': str(self.owner)})
+        self.assertEqual(response.data['total_size'], sum(1000 + i for i in range(120)))
+        self.assertUsesIndex(queries, 'files_storageusage_pkey', 'sqlite_autoindex_files_storageusage_1')
+
+    def test_count_all(self):
+        response, queries = self.capture('get', '/api/files/count-all/', 1)
+        self.assertEqual(response.data, {'total_files': 250})
+        self.assertNotIn('files_file', queries[0]['sql'])
+
+    def test_top_file_types(self):
+        response, queries = self.capture('get', '/api/files/top-file-types/', 1)
+        self.assertEqual(response.data, {'pdf': 120, 'jpg': 120, 'no_extension': 10})
+        self.assertUsesIndex(queries, 'file_extension_idx')
+
+    def test_top_file_types_for_user(self):
+        response, queries = self.capture('get', f'/api/files/top-file-types/?user_id={self.other}&limit=1', 1)
+        self.assertEqual(response.data, {'jpg': 120})
+        self.assertUsesIndex(queries, 'file_user_extension_idx')
+
+    def test_top_file_types_date_range(self):
+        today = timezone.localdate()
+        response, queries = self.capture('get', f'/api/files/top-file-types/?date_from={today}&date_to={today}', 1)
+        self.assertEqual(response.data, {'pdf': 120, 'jpg': 120, 'no_extension': 10})
+        self.assertNotIn('django_datetime_cast_date', queries[0]['sql'])
+        self.assertNotIn('::date', queries[0]['sql'])
+        tomorrow = today + timedelta(days=1)
+        self.assertEqual(self.client.get(f'/api/files/top-file-types/?date_from={tomorrow}').data, {})
+        self.assertEqual(self.client.get('/api/files/top-file-types/?user_id=nope').status_code, 400)
+
+    def test_toggle_star(self):
+        # file + update + starred counter
+        self.capture('post', f'/api/files/{self.file.pk}/toggle-star/', 3)
+
+    def test_set_privacy(self):
+        self.capture('post', f'/api/files/{self.file.pk}/set-privacy/', 2,
+                     data={'is_private': False, 'user_id': str(self.owner)}, format='json')
+
+    def test_share_and_unshare(self):
+        data = {'shared_with_email': 'Friend@Example.com', 'owner_id': str(self.owner)}
+        # file + directory lookup + duplicate check + plan + share count + insert
+        self.capture('post', f'/api/files/{self.file.pk}/share/', 6, data=data)
+        # file + (cached directory lookup) + share lookup + delete
+        self.capture('post', f'/api/files/{self.file.pk}/unshare/', 3, data=data)
+
+    def test_download(self):
+        ciphertext = b''.join(encrypt_stream([b'hello world']))
+        # Files stored before deduplication live under their name
+        self.storage.upload_stream(BUCKET, self.file.name, [ciphertext], len(ciphertext))
+        response, _ = self.capture('get', f'/api/files/{self.file.pk}/download/', 1)
+        self.assertEqual(read_streaming(response), b'hello world')
+
+    def test_create_is_one_insert(self):
+        uploads = [SimpleUploadedFile(f'note {i}.txt', b'x' * (100 + i)) for i in range(5)]
+        # plan + usage, blob lookup + insert + re-read + refcount, upload lease + finish, name
+        # collisions, then the locked usage re-check, one INSERT for all rows + the counter UPDATE
+        response, queries = self.capture('post', '/api/files/', 13, data={'user_id': str(self.owner), 'files': uploads})
+        self.assertEqual(response.json()['total_created'], 5)
+        self.assertUsesIndex(queries, 'file_user_name_idx')
+
+    def test_clashing_names_are_numbered(self):
+        File.objects.bulk_create([
+            File(user_id=self.owner, name='report 3.pdf'),
+            File(user_id=self.owner, name='report 3 (1).pdf'),
+            File(user_id=self.other, name='summary.txt'),
+        ])
+        uploads = [SimpleUploadedFile(name, name.encode()) for name in ['report 3.pdf', 'report 3.pdf', 'summary.txt', 'summary.txt']]
+        with self.spy('aupload_stream') as upload:
+            response = self.client.post('/api/files/', data={'user_id': str(self.owner), 'files': uploads})
+        self.assertEqual(
+            [f['name'] for f in response.json()['created_files']],
+            ['report 3 (2).pdf', 'report 3 (3).pdf', 'summary.txt', 'summary (1).txt']
+        )
+        # one write per distinct content, never a retry on a name clash
+        self.assertEqual(upload.call_count, 2)
+
+
+class BlobTests(FilesTestCase):
+    """Content-addressed storage: deduplicated blobs, upload leases and collection."""
+
+    def test_repeated_content_is_stored_once(self):
+        _, upload = self.upload(self.owner, b'same bytes', b'same bytes')
+        self.assertEqual(upload.call_count, 1)
+        _, upload = self.upload(self.other, b'same bytes')
+        upload.assert_not_called()
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 3)
+        self.assertEqual(set(File.objects.filter(blob=blob).values_list('user_id', flat=True)), {self.owner, self.other})
+
+    def test_blob_collected_with_last_file(self):
+        self.upload(self.owner, b'short lived', b'short lived')
+        blob = Blob.objects.get()
+        with self.spy('delete') as delete, self.captureOnCommitCallbacks(execute=True):
+            File.objects.filter(blob=blob).first().delete()
+        delete.assert_not_called()
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+        with self.spy('delete') as delete, self.captureOnCommitCallbacks(execute=True):
+            File.objects.get(blob=blob).delete()
+        delete.assert_called_once_with(BUCKET, [blob.storage_key])
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(self.storage.objects, {})
+
+    def test_content_leased_by_another_upload_is_not_written(self):
+        content = b'stored elsewhere'
+        sha256 = hashlib.sha256(content).hexdigest()
+        claim_blobs([(sha256, len(content))])
+        self.assertEqual(lease_uploads([sha256]), {sha256})
+        # a second writer can't take the lease while it is held
+        self.assertEqual(lease_uploads([sha256]), set())
+
+        with override_settings(BLOB_UPLOAD_WAIT=0), self.spy('aupload_stream') as upload, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/files/', data={
+                'user_id': str(self.owner), 'files': [SimpleUploadedFile('late.txt', content)]
+            })
+        upload.assert_not_called()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('still being stored', response.json()['errors'][0]['error'])
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertFalse(blob.uploaded)
+
+        # once the holder is done, the same upload goes through without a second write
+        finish_uploads([sha256])
+        with self.spy('aupload_stream') as upload:
+            response = self.client.post('/api/files/', data={
+                'user_id': str(self.owner), 'files': [SimpleUploadedFile('late.txt', content)]
+            })
+        upload.assert_not_called()
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+    def test_collect_blobs_keeps_recent_claims(self):
+        content = b'claimed a while ago'
+        sha256 = hashlib.sha256(content).hexdigest()
+        claim_blobs([(sha256, len(content))])
+        long_ago = timezone.now() - timedelta(hours=2)
+        Blob.objects.update(created_at=long_ago)
+
+        # an upload took its reference a moment ago and has no File row yet
+        call_command('collect_blobs', stdout=io.StringIO())
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+        Blob.objects.update(last_claimed_at=long_ago)
+        call_command('collect_blobs', stdout=io.StringIO())
+        self.assertFalse(Blob.objects.exists())
+
+    def test_download_blob(self):
+        self.upload(self.owner, b'blob content')
+        file = File.objects.get(blob__isnull=False)
+        self.assertNotIn(b'blob content', self.storage.download(BUCKET, file.blob.storage_key))
+        with self.spy('aread_head') as head:
+            response, _ = self.capture('get', f'/api/files/{file.pk}/download/', 1)
+        self.assertEqual(head.call_args.args[1], file.blob.storage_key)
+        self.assertEqual(read_streaming(response), b'blob content')
+
+
+class PlanLimitTests(FilesTestCase):
+    """Plan quotas on uploads and shares, and the usage counters they are checked against."""
+
+    def test_upload_over_quota_rejected_from_content_length(self):
+        limit = TIER_LIMITS['free']['max_storage_bytes']
+        with self.spy('aupload_stream') as upload, \
+                mock.patch('django.http.HttpRequest._load_post_and_files') as parse:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.post(f'/api/files/?user_id={self.owner}', data=b'',
+                                            content_type='multipart/form-data; boundary=x',
+                                            CONTENT_LENGTH=str(limit))
+        self.assertEqual(response.status_code, 413)
+        parse.assert_not_called()
+        upload.assert_not_called()
+        # plan + usage
+        self.assertEqual(len(ctx.captured_queries), 2)
+
+    async def test_upload_quota_middleware_answers_before_the_body(self):
+        limit = TIER_LIMITS['free']['max_storage_bytes']
+        inner = mock.AsyncMock()
+        receive = mock.AsyncMock()
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': '/api/files/',
+            'query_string': f'user_id={self.owner}'.encode(),
+            'headers': [(b'content-length', str(limit).encode())],
+        }
+        await UploadQuotaMiddleware(inner)(scope, receive, send)
+        self.assertEqual(sent[0]['status'], 413)
+        inner.assert_not_called()
+        receive.assert_not_called()
+
+        # small enough, or no user to check: passed through untouched
+        for query, length in [(f'user_id={self.owner}', b'100'), ('', str(limit).encode())]:
+            scope = {**scope, 'query_string': query.encode(), 'headers': [(b'content-length', length)]}
+            await UploadQuotaMiddleware(inner)(scope, receive, send)
+        self.assertEqual(inner.call_count, 2)
+
+    def test_upload_over_file_size_limit(self):
+        pro = SubscriptionPlan.objects.create(name='Pro', tier='pro', price=199)
+        Subscription.objects.create(user_id=str(self.owner), plan=pro)
+        with mock.patch.dict(TIER_LIMITS['pro'], max_file_size=50), self.spy('aupload_stream') as upload:
+            response = self.client.post('/api/files/', data={
+                'user_id': str(self.owner), 'files': [SimpleUploadedFile('big.bin', b'x' * 51)]
+            })
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('pro plan', response.json()['error'])
+        upload.assert_not_called()
+
+    def test_quota_rechecked_when_the_files_are_saved(self):
+        used = StorageUsage.objects.get(user_id=self.owner).total_bytes
+        real_save = uploads.save_uploads
+
+        def save_after_another_upload(user_id, *args):
+            # another upload by the same user is counted after this one passed the early checks
+            apply_usage_delta(user_id, total_bytes=40)
+            return real_save(user_id, *args)
+
+        with mock.patch.dict(TIER_LIMITS['free'], max_storage_bytes=used + 50), \
+                mock.patch('files.async_views.save_uploads', side_effect=save_after_another_upload), \
+                self.spy('aupload_stream') as upload:
+            response = self.client.post('/api/files/', data={
+                'user_id': str(self.owner), 'files': [SimpleUploadedFile('late.bin', b'x' * 20)]
+            })
+        upload.assert_called_once()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('storage limit', response.json()['errors'][0]['error'])
+        self.assertFalse(File.objects.filter(name='late.bin').exists())
+        self.assertEqual(StorageUsage.objects.get(user_id=self.owner).total_bytes, used + 40)
+        # the claim is dropped, so the stored content is collected like any unreferenced blob
+        self.assertEqual(Blob.objects.get().ref_count, 0)
+
+    def test_share_limit(self):
+        # `other` already owns 40 shares, over the free plan's limit
+        file = File.objects.filter(user_id=self.other).first()
+        response = self.client.post(f'/api/files/{file.pk}/share/', data={
+            'shared_with_email': 'friend@example.com', 'owner_id': str(self.other)
+        })
+        self.assertEqual(response.status_code, 403)
+
+    def test_usage_counters_match_rebuild(self):
+        self.client.post(f'/api/files/{self.file.pk}/toggle-star/')
+        File.objects.create(user_id=self.owner, name='extra.txt', size=77, isStarred=True)
+        for file in File.objects.filter(user_id=self.owner).order_by('id')[:3]:
+            file.delete()
+        # size and owner are read-only through the API; saved directly, the counters follow
+        moved = File.objects.filter(user_id=self.owner).order_by('id').last()
+        self.client.patch(f'/api/files/{moved.pk}/', data={'size': 10 ** 9, 'user_id': str(self.friend)}, format='json')
+        self.assertEqual(File.objects.get(pk=moved.pk).size, moved.size)
+        moved.size += 5
+        moved.user_id = self.friend
+        moved.save()
+
+        counters = {u.user_id: (u.total_bytes, u.file_count, u.starred_count) for u in StorageUsage.objects.all()}
+        rebuild_usage()
+        rebuilt = {u.user_id: (u.total_bytes, u.file_count, u.starred_count) for u in StorageUsage.objects.all()}
+        self.assertEqual(counters, rebuilt)
+
+    def test_file_total_is_summed_from_usage_counters(self):
+        self.assertEqual(count_all_files(), 250)
+        with CaptureQueriesContext(connection) as ctx:
+            File.objects.create(user_id=self.owner, name='one more.txt', size=1)
+            self.file.delete()
+        # only the owner's usage row is written, no site-wide one
+        self.assertFalse([q for q in ctx.captured_queries if 'appuser_statcounter' in q['sql'].lower()])
+        expected = File.objects.count()
+        with self.assertNumQueries(1):
+            self.assertEqual(count_all_files(), expected)
+
+
+class DeferredUploadTests(FilesTestCase):
+    """Uploads spooled to disk and stored by the job worker."""
+
+    def deferred_upload(self, spool_dir, *contents):
+        uploads = [SimpleUploadedFile(f'later {i}.txt', content) for i, content in enumerate(contents)]
+        with override_settings(FILE_UPLOAD_SPOOL_DIR=spool_dir), self.spy('aupload_stream') as upload:
+            response = self.client.post('/api/files/', data={'user_id': str(self.owner), 'async': 'true', 'files': uploads})
+        upload.assert_not_called()
+        self.assertEqual(response.status_code, 202, response.content)
+        return response
+
+    def test_deferred_upload_is_stored_by_worker(self):
+        spool_dir = self.enterContext(tempfile.TemporaryDirectory())
+        usage_before = StorageUsage.objects.get(user_id=self.owner).total_bytes
+        response = self.deferred_upload(spool_dir, b'stored later', b'stored later')
+        self.assertEqual({f['status'] for f in response.json()['created_files']}, {'pending'})
+        self.assertEqual(len(os.listdir(spool_dir)), 2)
+        # counted against the plan while still pending
+        self.assertEqual(StorageUsage.objects.get(user_id=self.owner).total_bytes, usage_before + 24)
+
+        file_id = response.json()['created_files'][0]['id']
+        self.assertEqual(self.client.get(f'/api/files/{file_id}/download/').status_code, 409)
+
+        with self.spy('upload_stream') as upload:
+            results = run_due_jobs()
+        self.assertEqual([job_status for _, job_status in results], ['done', 'done'])
+        upload.assert_called_once()
+        self.assertEqual(os.listdir(spool_dir), [])
+        self.assertFalse(Job.objects.exists())
+
+        blob = Blob.objects.get()
+        self.assertTrue(blob.uploaded)
+        self.assertIn((BUCKET, blob.storage_key), self.storage.objects)
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(set(File.objects.filter(blob=blob).values_list('status', flat=True)), {'ready'})
+
+    def test_deferred_upload_retried_then_failed(self):
+        spool_dir = self.enterContext(tempfile.TemporaryDirectory())
+        usage_before = StorageUsage.objects.get(user_id=self.owner).total_bytes
+        file_id = self.deferred_upload(spool_dir, b'never stored').json()['created_files'][0]['id']
+        Job.objects.update(max_attempts=2)
+
+        with self.spy('upload_stream', side_effect=ConnectionError('storage down')):
+            self.assertEqual(run_due_jobs(), [(Job.objects.get().pk, 'queued')])
+            # backing off, so not due yet
+            self.assertEqual(run_due_jobs(), [])
+            Job.objects.update(run_at=timezone.now())
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(run_due_jobs()[0][1], 'failed')
+
+        job = Job.objects.get()
+        self.assertEqual(job.attempts, 2)
+        self.assertIn('storage down', job.last_error)
+        self.assertEqual(os.listdir(spool_dir), [])
+        # the file is dropped along with its quota and blob reference
+        self.assertFalse(File.objects.filter(pk=file_id).exists())
+        self.assertEqual(StorageUsage.objects.get(user_id=self.owner).total_bytes, usage_before)
+        self.assertFalse(Blob.objects.exists())
+
+
+class KeyRotationTests(FilesTestCase):
+    """Re-wrapping blob data keys under a new master key."""
+
+    def test_rotate_keys_rewraps_without_touching_content(self):
+        self.upload(self.owner, b'one', b'two', b'three')
+        before = {blob.sha256: blob_data_key(blob) for blob in Blob.objects.all()}
+        stored = dict(self.storage.objects)
+        new_key = base64.urlsafe_b64encode(os.urandom(32)).decode()
+        with override_settings(FILE_MASTER_KEYS={'k2': new_key}):
+            call_command('rotate_file_keys', '--to', 'k2', '--batch-size', '2', stdout=io.StringIO())
+            blobs = list(Blob.objects.all())
+            self.assertEqual({blob.key_id for blob in blobs}, {'k2'})
+            self.assertEqual({blob.sha256: blob_data_key(blob) for blob in blobs}, before)
+        self.assertEqual(self.storage.objects, stored)
+
+    def test_rotate_keys_benchmark(self):
+        out = io.StringIO()
+        call_command('rotate_file_keys', '--benchmark', '50', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['keys'], 50)
+        self.assertGreater(report['rewrap_keys_per_second'], 0)
+
+
+class BenchmarkCommandTests(FilesTestCase):
+    """The benchmark_files management command."""
+
+    def test_benchmark_files(self):
+        out = io.StringIO()
+        files_before = File.objects.count()
+        call_command('benchmark_files', '--sizes', '1KB,2KB', '--iterations', '3', '--no-test-db',
+                     stdout=out, stderr=io.StringIO())
+        report = json.loads(out.getvalue())
+        self.assertEqual([result['size'] for result in report['results']], [1024, 2048])
+        operations = report['results'][0]['operations']
+        self.assertEqual(set(operations), {'upload', 'list', 'download', 'share', 'total_size'})
+        self.assertEqual(operations['download']['count'], 3)
+        self.assertEqual(operations['download']['queries_per_request'], 1)
+        if os.path.exists('/proc/self/status'):
+            self.assertGreater(operations['upload']['peak_rss_bytes'], 0)
+            self.assertIn('max_rss_growth_bytes', operations['upload'])
+        self.assertNotIn('peak_rss_bytes', report['results'][0])
+        # the benchmark cleans up after itself
+        self.assertEqual(File.objects.count(), files_before)
+        self.assertFalse(Blob.objects.filter(ref_count__gt=0).exists())
+
+        with mock.patch.dict(connection.settings_dict, NAME=''), self.assertRaisesMessage(CommandError, 'DATABASE_URL'):
+            call_command('benchmark_files', stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class PreviewTests(FilesTestCase):
+    """Thumbnails and previews rendered by the job worker."""
+
+    def png(self, width, height):
+        buffer = io.BytesIO()
+        Image.new('RGB', (width, height), 'teal').save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    @skipUnless(Image, "Pillow is not installed")
+    def test_render_image_derivatives(self):
+        derivatives = render_derivatives(self.png(2000, 1000), 'png')
+        self.assertEqual({kind: size for kind, (_, *size) in derivatives.items()},
+                         {'thumbnail': [256, 128], 'preview': [1024, 512]})
+        self.assertEqual(Image.open(io.BytesIO(derivatives['thumbnail'][0])).format, 'WEBP')
+
+    @skipUnless(Image and pdfium, "Pillow and pypdfium2 are not installed")
+    def test_render_pdf_first_page(self):
+        pdf = pdfium.PdfDocument.new()
+        pdf.new_page(612, 792)
+        buffer = io.BytesIO()
+        pdf.save(buffer)
+        derivatives = render_derivatives(buffer.getvalue(), 'pdf')
+        self.assertEqual(max(derivatives['preview'][1:]), 1024)
+
+    @skipUnless(Image, "Pillow is not installed")
+    def test_preview_endpoint(self):
+        content = self.png(600, 400)
+        response, _ = self.upload(self.owner, content, extension='png')
+        file_id = response.json()['created_files'][0]['id']
+        self.assertTrue(response.json()['created_files'][0]['preview_url'].endswith(f'/api/files/{file_id}/preview/'))
+        job = Job.objects.get()
+        self.assertEqual(job.payload, {'sha256': hashlib.sha256(content).hexdigest(), 'extension': 'png'})
+
+        # rendered by a worker from the stored content
+        self.assertEqual(run_due_jobs(), [(job.pk, 'done')])
+        stored = [content for (_, key), content in self.storage.objects.items() if key.endswith('.webp')]
+        self.assertEqual(len(stored), 2)
+        self.assertNotIn(b'WEBP', b''.join(stored))
+
+        with mock.patch('files.previews._derivative_cache', LRUTTLCache()):
+            # file and blob + derivative
+            response, queries = self.capture('get', f'/api/files/{file_id}/preview/', 2)
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            self.assertIn('immutable', response['Cache-Control'])
+            self.assertEqual(Image.open(io.BytesIO(response.content)).size, (256, 171))
+
+            cached = self.client.get(f'/api/files/{file_id}/preview/?kind=preview', HTTP_IF_NONE_MATCH=response['ETag'].replace('thumbnail', 'preview'))
+            self.assertEqual(cached.status_code, 304)
+
+        missing = self.client.get(f'/api/files/{self.file.pk}/preview/')
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(self.client.get('/api/files/nope/preview/').status_code, 404)
+
+    def test_render_isolated_kills_a_hung_render(self):
+        with override_settings(PREVIEW_MAX_WORKERS=1, PREVIEW_RENDER_TIMEOUT=1):
+            self.addCleanup(lambda: previews._render_pool and previews._kill_render_pool(previews._render_pool))
+            self.assertEqual(render_isolated(abs, -3), 3)
+            hung = previews._render_pool
+            with self.assertRaises(PreviewRenderTimeout):
+                render_isolated(time.sleep, 60)
+            # a fresh pool takes over
+            self.assertEqual(render_isolated(abs, -4), 4)
+            self.assertIsNot(previews._render_pool, hung)
+
+    def test_generate_previews_skips_failed_blobs(self):
+        self.upload(self.owner, b'not really a png', extension='png')
+        with mock.patch('files.management.commands.generate_previews.render_stored_blob',
+                        side_effect=ValueError('cannot identify image')) as build:
+            call_command('generate_previews', stdout=io.StringIO(), stderr=io.StringIO())
+            self.assertIsNotNone(Blob.objects.get().preview_failed_at)
+            call_command('generate_previews', stdout=io.StringIO(), stderr=io.StringIO())
+            self.assertEqual(build.call_count, 1)
+            call_command('generate_previews', '--retry-failed', stdout=io.StringIO(), stderr=io.StringIO())
+            self.assertEqual(build.call_count, 2)
+
+
+@override_settings(STORAGE_BACKEND='memory')
+class DownloadRangeTests(TestCase):
+    """Streaming and Range requests on /download/, for chunked and legacy Fernet files."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.storage = get_storage()
+        self.storage.clear()
+        # Two full 64 KiB frames and a short last one
+        self.plain = os.urandom(2 * 64 * 1024 + 100)
+        self.file = File.objects.create(user_id=uuid.uuid4(), name='big.bin', size=len(self.plain))
+        self.storage.objects[(BUCKET, self.file.name)] = b''.join(encrypt_stream([self.plain]))
+        self.legacy = File.objects.create(user_id=uuid.uuid4(), name='old.txt', size=len(self.plain))
+        self.storage.objects[(BUCKET, self.legacy.name)] = fernet.encrypt(self.plain)
+
+    def get(self, file, byte_range):
+        response = self.client.get(f'/api/files/{file.pk}/download/', HTTP_RANGE=byte_range)
+        body = read_streaming(response) if response.streaming else response.content
+        return response, body
+
+    def assertPartial(self, file, byte_range, start, end):
+        response, body = self.get(file, byte_range)
+        self.assertEqual(response.status_code, 206, byte_range)
+        self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/{len(self.plain)}')
+        self.assertEqual(body, self.plain[start:end + 1])
+        if response.streaming:
+            self.assertEqual(int(response['Content-Length']), end - start + 1)
+
+    def test_range_across_a_frame_boundary_reads_only_its_frames(self):
+        with mock.patch.object(self.storage, 'adownload_range', wraps=self.storage.adownload_range) as download:
+            self.assertPartial(self.file, 'bytes=65530-65545', 65530, 65545)
+        first, last = download.call_args.args[2:4]
+        self.assertEqual((first, last), ciphertext_range(65530, 65545))
+        self.assertLess(last - first, 2 * (64 * 1024 + STREAM_TAG_SIZE))
+
+    def test_single_byte_ranges(self):
+        size = len(self.plain)
+        for offset in [0, 64 * 1024 - 1, 64 * 1024, size - 1]:
+            self.assertPartial(self.file, f'bytes={offset}-{offset}', offset, offset)
+
+    def test_suffix_and_open_ended_ranges(self):
+        size = len(self.plain)
+        self.assertPartial(self.file, 'bytes=-100', size - 100, size - 1)
+        self.assertPartial(self.file, 'bytes=-200', size - 200, size - 1)
+        self.assertPartial(self.file, f'bytes=-{size + 10}', 0, size - 1)
+        self.assertPartial(self.file, 'bytes=70000-', 70000, size - 1)
+        self.assertPartial(self.file, f'bytes=100-{size + 500}', 100, size - 1)
+
+    def test_unsatisfiable_range(self):
+        for byte_range in [f'bytes={len(self.plain)}-', 'bytes=-0']:
+            response, _ = self.get(self.file, byte_range)
+            self.assertEqual(response.status_code, 416, byte_range)
+            self.assertEqual(response['Content-Range'], f'bytes */{len(self.plain)}')
+
+    def test_unsupported_ranges_send_the_whole_file(self):
+        for byte_range in ['bytes=10-5', 'bytes=0-1,5-6', 'items=0-1', 'bytes=a-b']:
+            response, body = self.get(self.file, byte_range)
+            self.assertEqual(response.status_code, 200, byte_range)
+            self.assertEqual(body, self.plain)
+
+    def test_ranges_on_legacy_fernet_files(self):
+        size = len(self.plain)
+        self.assertPartial(self.legacy, 'bytes=65530-65545', 65530, 65545)
+        self.assertPartial(self.legacy, 'bytes=0-0', 0, 0)
+        self.assertPartial(self.legacy, 'bytes=-100', size - 100, size - 1)
+        response, _ = self.get(self.legacy, f'bytes={size}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+        response, body = self.get(self.legacy, '')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.plain)
+
+    async def test_concurrent_downloads_overlap_on_one_event_loop(self):
+        plaintext = os.urandom(200 * 1024)
+        ciphertext = b''.join(encrypt_stream([plaintext]))
+        latency = 0.2
+
+        async def slow_storage(request):
+            # Ranged reads only, like Supabase Storage
+            await asyncio.sleep(latency)
+            start, end = (int(n) for n in request.headers['range'][len('bytes='):].split('-'))
+            end = min(end, len(ciphertext) - 1)
+            return httpx.Response(206, content=ciphertext[start:end + 1],
+                                  headers={'content-range': f'bytes {start}-{end}/{len(ciphertext)}'})
+
+        storage = httpx.AsyncClient(base_url='http://storage/storage/v1/', transport=httpx.MockTransport(slow_storage))
+
+        async def download():
+            response = await self.async_client.get(f'/api/files/{self.file.pk}/download/', headers={'range': 'bytes=70000-'})
+            return response.status_code, b''.join([chunk async for chunk in response.streaming_content])
+
+        with override_settings(STORAGE_BACKEND='supabase'), mock.patch('utils.storage.async_storage_http', return_value=storage):
+            started = time.monotonic()
+            results = await asyncio.gather(*(download() for _ in range(20)))
+            elapsed = time.monotonic() - started
+        await storage.aclose()
+
+        self.assertEqual(set(results), {(206, plaintext[70000:])})
+        # Header read + one ranged read each; run one after another this would take 20x as long
+        self.assertLess(elapsed, 20 * 2 * latency / 4)
+
+
+class StorageBackendTests(TestCase):
+    """The local and in-memory backends behave alike, including presigned reads."""
+
+    def backends(self):
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        with override_settings(STORAGE_BACKEND='memory'):
+            memory = get_storage()
+        return [LocalStorageBackend(root), memory]
+
+    def test_round_trip(self):
+        content = os.urandom(3 * 1024 * 1024 + 5)
+        for storage in self.backends():
+            with self.subTest(storage=type(storage).__name__):
+                storage.upload_stream(BUCKET, 'blobs/a', [content[:1000], content[1000:]], len(content))
+                self.assertEqual(storage.stat(BUCKET, 'blobs/a'), len(content))
+                self.assertEqual(storage.download(BUCKET, 'blobs/a'), content)
+                self.assertEqual(b''.join(storage.download_range(BUCKET, 'blobs/a', 10, 2 * 1024 * 1024)),
+                                 content[10:2 * 1024 * 1024 + 1])
+                self.assertEqual(storage.read_head(BUCKET, 'blobs/a', 8), (content[:8], len(content)))
+                self.assertEqual(async_to_sync(storage.adownload)(BUCKET, 'blobs/a'), content)
+                with self.assertRaises(StorageObjectExists):
+                    storage.upload_stream(BUCKET, 'blobs/a', [b'other'], 5)
+
+                storage.delete(BUCKET, ['blobs/a', 'blobs/missing'])
+                with self.assertRaises(StorageObjectNotFound):
+                    storage.stat(BUCKET, 'blobs/a')
+
+    def test_local_paths_stay_inside_bucket(self):
+        storage = self.backends()[0]
+        with self.assertRaises(ValueError):
+            storage.upload_stream(BUCKET, '../escape', [b'x'], 1)
+
+    def test_presigned_url(self):
+        for backend, storage in zip(['local', 'memory'], self.backends()):
+            with self.subTest(backend=backend), \
+                    override_settings(STORAGE_BACKEND=backend, STORAGE_ROOT=getattr(storage, 'root', '')):
+                storage = get_storage()
+                storage.upload_stream(BUCKET, 'blobs/b', [b'ciphertext'], 10)
+                url = storage.presign(BUCKET, 'blobs/b', expires_in=60)
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(b''.join(response.streaming_content), b'ciphertext')
+
+                self.assertEqual(self.client.get(url.replace('blobs/b', 'blobs/c')).status_code, 403)
+                self.assertEqual(self.client.get(storage.presign(BUCKET, 'blobs/b', expires_in=-1)).status_code, 403)
+
+    def test_accel_redirect(self):
+        storage = self.backends()[0]
+        storage.upload_stream(BUCKET, 'blobs/d', [b'ciphertext'], 10)
+        with override_settings(STORAGE_BACKEND='local', STORAGE_ROOT=storage.root,
+                               STORAGE_ACCEL_REDIRECT_PREFIX='/protected/'):
+            response = self.client.get(get_storage().presign(BUCKET, 'blobs/d'))
+            self.assertEqual(response['X-Accel-Redirect'], f'/protected/{BUCKET}/blobs/d')
+            self.assertEqual(response.content, b'')
+            self.assertEqual(self.client.get(get_storage().presign(BUCKET, 'blobs/e')).status_code, 404)
+
+    def test_backends_without_public_urls(self):
+        for storage in self.backends():
+            self.assertIsNone(storage.public_url(BUCKET, 'blobs/a'))
+
+        class Partial(StorageBackend):
+            def stat(self, bucket, path):
+                return 0
+        with self.assertRaises(TypeError):
+            Partial()
+
+    def test_supabase_resumable_upload_resumes_sync_and_async(self):
+        content = os.urandom(10)
+
+        def tus_server():
+            stored = bytearray()
+            failed = []
+
+            def handle(request):
+                if request.method == 'POST':
+                    return httpx.Response(201, headers={'location': 'http://storage/upload/resumable/1'})
+                if request.method == 'HEAD':
+                    return httpx.Response(200, headers={'upload-offset': str(len(stored))})
+                body = request.read()
+                self.assertEqual(int(request.headers['upload-offset']), len(stored))
+                if not failed:
+                    # the first PATCH only gets half of its chunk through
+                    failed.append(True)
+                    stored.extend(body[:len(body) // 2])
+                    return httpx.Response(500)
+                stored.extend(body)
+                return httpx.Response(204, headers={'upload-offset': str(len(stored))})
+            return stored, httpx.MockTransport(handle)
+
+        stored, transport = tus_server()
+        client = httpx.Client(base_url='http://storage/storage/v1/', transport=transport)
+        with mock.patch('utils.storage.RESUMABLE_CHUNK_SIZE', 4), mock.patch('utils.storage.storage_http', return_value=client):
+            supabase_storage.upload_stream(BUCKET, 'blobs/r', [content[:3], content[3:]], len(content))
+        self.assertEqual(bytes(stored), content)
+
+        stored, transport = tus_server()
+
+        async def upload():
+            async with httpx.AsyncClient(base_url='http://storage/storage/v1/', transport=transport) as client:
+                with mock.patch('utils.storage.async_storage_http', return_value=client):
+                    await supabase_storage.aupload_stream(BUCKET, 'blobs/r', [content[:3], content[3:]], len(content))
+        with mock.patch('utils.storage.RESUMABLE_CHUNK_SIZE', 4):
+            async_to_sync(upload)()
+        self.assertEqual(bytes(stored), content)
@@ -0,0 +1,166 @@
+"""Database side of the upload endpoint.
+
+The upload view hashes and stores content on the event loop; everything
+that touches the database is in these sync functions, run through
+sync_to_async.
+"""
+from django.db import transaction
+
+from subscriptions.entitlements import PlanLimitExceeded, get_entitlements
+from utils.storage_backends import get_storage
+from .blobs import BUCKET, release_blobs
+from .models import File, StorageUsage, extension_from_name
+from .naming import assign_display_names
+from .previews import wants_derivatives
+from .tasks import discard_spooled, queue_previews, queue_uploads, spool_upload
+from .usage import get_usage, record_files_added
+
+# Bytes of a multipart upload that are boundaries and form fields, not file data
+MULTIPART_OVERHEAD_ALLOWANCE = 64 * 1024
+
+
+def check_plan(user_id, check):
+    """Run `check(entitlements, used_bytes)`; returns the PlanLimitExceeded it raised, if any."""
+    try:
+        check(get_entitlements(user_id), get_usage(user_id).total_bytes)
+    except PlanLimitExceeded as e:
+        return e
+    return None
+
+
+def check_declared_size(user_id, content_length):
+    """check_plan() against an upload's Content-Length, less an allowance for multipart framing."""
+    try:
+        declared = max(int(content_length or 0) - MULTIPART_OVERHEAD_ALLOWANCE, 0)
+    except ValueError:
+        declared = 0
+    return check_plan(user_id, lambda entitlements, used: entitlements.check_storage(declared, used))
+
+
+def check_upload_locked(user_id, sizes):
+    """Check files of `sizes` bytes against the plan, holding the user's usage row until the transaction ends.
+
+    Must run inside transaction.atomic(), before the files are counted, so
+    that concurrent uploads by the same user can't each pass the earlier
+    unlocked checks and overrun the plan together. Raises PlanLimitExceeded.
+    """
+    usage = StorageUsage.objects.select_for_update().filter(user_id=user_id).first()
+    if usage is None:
+        # Nothing to lock yet: create the row, then take it like any other
+        StorageUsage.objects.get_or_create(user_id=user_id)
+        usage = StorageUsage.objects.select_for_update().get(user_id=user_id)
+    get_entitlements(user_id).check_upload(sizes, usage.total_bytes)
+
+
+def build_file(uploaded_file, name, blob, user_id, is_private):
+    """Unsaved File named `name` for an upload whose content is stored as `blob`."""
+    return File(
+        user_id=user_id,
+        blob=blob,
+        name=name,
+        file=get_storage().public_url(BUCKET, blob.storage_key),
+        size=uploaded_file.size,
+        is_private=is_private,
+        extension=extension_from_name(name)
+    )
+
+
+def save_uploads(user_id, is_private, hashed, blobs, written, failed_blobs):
+    """Create the File rows for stored uploads and drop the references of the rest.
+
+    `hashed` is [(uploaded_file, sha256)] for every upload that claimed a
+    blob, `written` the hashes this request stored (and finished the
+    leases of) and `failed_blobs` {sha256: error} for content that isn't
+    stored, written here or waited for. Returns
+    (created_files, errors).
+    """
+    errors = []
+    released = []
+    stored = []
+    for uploaded_file, sha256 in hashed:
+        if sha256 in failed_blobs:
+            errors.append({'file_name': uploaded_file.name, 'error': failed_blobs[sha256]})
+            released.append(sha256)
+        else:
+            stored.append((uploaded_file, sha256))
+
+    # Storage keys don't depend on names, so clashing names are numbered with one query
+    names = assign_display_names(user_id, [uploaded_file.name for uploaded_file, _ in stored])
+    pending_files = [
+        build_file(uploaded_file, name, blobs[sha256], user_id, is_private)
+        for name, (uploaded_file, sha256) in zip(names, stored)
+    ]
+
+    # 4️⃣ Create all DB records in one query
+    created_files = []
+    if pending_files:
+        try:
+            with transaction.atomic():
+                check_upload_locked(user_id, [f.size for f in pending_files])
+                created_files = File.objects.bulk_create(pending_files)
+                # bulk_create skips model signals, so update the usage counters here
+                record_files_added(created_files)
+        except Exception as e:
+            # Over the plan by now, or the insert failed: the blob claims go too
+            released.extend(f.blob_id for f in pending_files)
+            errors.extend({'file_name': f.name, 'error': str(e)} for f in pending_files)
+    release_blobs(released)
+
+    # 5️⃣ Thumbnails and previews of newly stored images and PDFs render in the background
+    if created_files:
+        schedule_previews(stored, written)
+    return created_files, errors
+
+
+def schedule_previews(stored, new_blobs):
+    """Queue previews of the images and PDFs among newly stored blobs; `run_jobs` workers render them."""
+    blobs = {}
+    for uploaded_file, sha256 in stored:
+        extension = extension_from_name(uploaded_file.name)
+        if sha256 in new_blobs and sha256 not in blobs and wants_derivatives(extension, uploaded_file.size):
+            blobs[sha256] = extension
+    if blobs:
+        queue_previews(blobs.items())
+
+
+def create_deferred(uploaded_files, user_id, is_private):
+    """Spool the uploads and create pending files; `run_jobs` workers encrypt and store them.
+
+    Returns (created_files, errors).
+    """
+    errors = []
+    spooled = []
+    for uploaded_file in uploaded_files:
+        try:
+            spooled.append((uploaded_file, spool_upload(uploaded_file)))
+        except Exception as e:
+            errors.append({'file_name': uploaded_file.name, 'error': str(e)})
+
+    names = assign_display_names(user_id, [uploaded_file.name for uploaded_file, _ in spooled])
+    pending_files = [
+        File(
+            user_id=user_id,
+            name=name,
+            size=uploaded_file.size,
+            is_private=is_private,
+            extension=extension_from_name(name),
+            status=File.Status.PENDING
+        )
+        for name, (uploaded_file, _) in zip(names, spooled)
+    ]
+
+    created_files = []
+    if pending_files:
+        try:
+            with transaction.atomic():
+                check_upload_locked(user_id, [f.size for f in pending_files])
+                created_files = File.objects.bulk_create(pending_files)
+                # Counted right away so further uploads can't overrun the plan while these wait
+                record_files_added(created_files)
+                queue_uploads(zip(created_files, [path for _, path in spooled]))
+        except Exception as e:
+            created_files = []
+            for _, path in spooled:
+                discard_spooled(path)
+            errors.extend({'file_name': f.name, 'error': str(e)} for f in pending_files)
+    return created_files, errors
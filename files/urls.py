@@ -1,10 +1,17 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import FileViewSet
+from . import async_views
+from .views import FileViewSet, storage_object
 
 router = DefaultRouter()
 router.register(r'', FileViewSet, basename='file')
 
 urlpatterns = [
+    # Storage-bound endpoints are async views; they take precedence over the router's routes
+    path('', async_views.file_collection, name='file-list'),
+    path('<int:pk>/download/', async_views.download_file, name='file-download'),
+    path('<int:pk>/share/', async_views.share_file, name='file-share'),
+    # Presigned reads of the local and in-memory storage backends
+    path('storage/<str:bucket>/<path:path>', storage_object, name='storage-object'),
     path('', include(router.urls)),
 ]
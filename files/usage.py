@@ -0,0 +1,93 @@
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .models import File, StorageUsage
+
+
+def apply_usage_delta(user_id, total_bytes=0, file_count=0, starred_count=0):
+    """Add the given deltas to a user's counters with a single UPDATE (INSERT on first use)."""
+    if not (total_bytes or file_count or starred_count):
+        return
+    updated = StorageUsage.objects.filter(user_id=user_id).update(
+        total_bytes=F('total_bytes') + total_bytes,
+        file_count=F('file_count') + file_count,
+        starred_count=F('starred_count') + starred_count,
+        updated_at=timezone.now(),
+    )
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            StorageUsage.objects.create(
+                user_id=user_id,
+                total_bytes=total_bytes,
+                file_count=file_count,
+                starred_count=starred_count,
+            )
+    except IntegrityError:
+        # Another request created the row first
+        apply_usage_delta(user_id, total_bytes, file_count, starred_count)
+
+
+def record_files_added(files, sign=1):
+    """Apply the counters for a batch of files (e.g. after bulk_create), one UPDATE per user."""
+    deltas = defaultdict(lambda: [0, 0, 0])
+    for file in files:
+        delta = deltas[str(file.user_id)]
+        delta[0] += file.size or 0
+        delta[1] += 1
+        delta[2] += 1 if file.isStarred else 0
+    for user_id, (total_bytes, file_count, starred_count) in deltas.items():
+        apply_usage_delta(user_id, sign * total_bytes, sign * file_count, sign * starred_count)
+
+
+def count_all_files():
+    """Site-wide file total, summed from the per-user counters.
+
+    Read-time aggregation keeps uploads and deletes from contending on a
+    single site-wide row; there is one StorageUsage row per user, not per file.
+    """
+    return StorageUsage.objects.aggregate(total=Sum('file_count'))['total'] or 0
+
+
+def get_usage(user_id):
+    """Return the user's counters as a single-row read; an unsaved zero row if they have none."""
+    return StorageUsage.objects.filter(user_id=user_id).first() or StorageUsage(user_id=user_id)
+
+
+def rebuild_usage(user_ids=None):
+    """Recompute the counters from the files table in bulk. Returns the number of users written."""
+    files = File.objects.all()
+    usage = StorageUsage.objects.all()
+    if user_ids is not None:
+        files = files.filter(user_id__in=user_ids)
+        usage = usage.filter(user_id__in=user_ids)
+
+    now = timezone.now()
+    rows = [
+        StorageUsage(
+            user_id=row['user_id'],
+            total_bytes=row['total_bytes'] or 0,
+            file_count=row['file_count'],
+            starred_count=row['starred_count'],
+            updated_at=now,
+        )
+        for row in files.order_by().values('user_id').annotate(
+            total_bytes=Sum('size'),
+            file_count=Count('id'),
+            starred_count=Count('id', filter=Q(isStarred=True)),
+        )
+    ]
+    with transaction.atomic():
+        usage.exclude(user_id__in=[row.user_id for row in rows]).delete()
+        StorageUsage.objects.bulk_create(
+            rows,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['user_id'],
+            update_fields=['total_bytes', 'file_count', 'starred_count', 'updated_at'],
+        )
+    return len(rows)
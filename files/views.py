@@ -1,21 +1,44 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+
 from rest_framework import viewsets, permissions, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from django.conf import settings
-from utils.supabase_client import supabase
-from utils.utils import encrypt_file, decrypt_file
-from .models import File, FileShare
+from rest_framework.generics import get_object_or_404
+from AppUser.directory import resolve_user_id
+from .models import BlobDerivative, File, FileShare
+from .previews import (
+    DERIVATIVE_CONTENT_TYPE,
+    is_derivative_kind,
+    load_derivative,
+)
 from .serializers import FileSerializer, FileShareSerializer
-import tempfile, os
-from django.db.models import Sum, Q
-from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from .pagination import FileCursorPagination
+from .usage import count_all_files, get_usage
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_http_methods
+from utils.storage import StorageObjectNotFound
+from utils.storage_backends import check_presigned, get_storage
+
+
+def _is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def _start_of_day(day):
+    """Midnight of `day` in the current time zone, the boundary a __date lookup would use."""
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
 
-from collections import Counter
 
 class FileViewSet(viewsets.ModelViewSet):
     serializer_class = FileSerializer
     permission_classes = [permissions.AllowAny]
+    pagination_class = FileCursorPagination
 
     def get_queryset(self):
         user_id = self.request.query_params.get('user_id')
@@ -27,102 +50,36 @@ class FileViewSet(viewsets.ModelViewSet):
             ).distinct()
         return File.objects.all()
 
-    def get_serializer_context(self):
-        context = super().get_serializer_context()
-        context['user_id'] = self.request.query_params.get('user_id') or self.request.data.get('user_id')
-        return context
-
-    def create(self, request, *args, **kwargs):
-        uploaded_files = request.FILES.getlist('files')
-        user_id = request.data.get('user_id')
-        is_private = request.data.get('is_private', True)
-        
-        if not uploaded_files:
-            return Response({'error': 'No files provided.'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        if not user_id:
-            return Response({'error': 'user_id is required.'}, status=status.HTTP_400_BAD_REQUEST)
-
-        created_files = []
-        errors = []
-
-        for uploaded_file in uploaded_files:
-            temp_path = None
-            try:
-                # 1️⃣ Create temp file
-                with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as temp_file:
-                    for chunk in uploaded_file.chunks():
-                        temp_file.write(chunk)
-                    temp_path = temp_file.name
-
-                # 2️⃣ Encrypt the file
-                encrypt_file(temp_path)
-
-                # 3️⃣ Upload to Supabase with conflict handling
-                bucket_name = "uploads"
-                file_name = uploaded_file.name
-
-                def upload_with_retry(name, attempt=1):
-                    try:
-                        supabase.storage.from_(bucket_name).upload(
-                            path=name,
-                            file=temp_path,
-                            file_options={"content-type": uploaded_file.content_type}
-                        )
-                        return name
-                    except Exception as e:
-                        if "409" in str(e) or "Resource already exists" in str(e):
-                            base, ext = os.path.splitext(name)
-                            new_name = f"{base} ({attempt}){ext}"
-                            return upload_with_retry(new_name, attempt + 1)
-                        raise e
+    def get_list_querysets(self):
+        """Querysets that make up the file listing, paginated together as one UNION ALL."""
+        params = self.request.query_params
+        user_id = params.get('user_id')
 
-                final_name = upload_with_retry(file_name)
+        filters = {}
+        if _is_true(params.get('starred')):
+            filters['isStarred'] = True
+        if params.get('private') is not None:
+            filters['is_private'] = _is_true(params.get('private'))
 
-                # 4️⃣ Get public URL
-                file_url = supabase.storage.from_(bucket_name).get_public_url(final_name)
-
-                # 5️⃣ Create DB record with is_private field
-                file_instance = File.objects.create(
-                    user_id=user_id,
-                    name=final_name,
-                    file=file_url,
-                    size=uploaded_file.size,
-                    is_private=is_private
-                )
+        if not user_id:
+            return [File.objects.filter(**filters)]
 
-                created_files.append(file_instance)
+        # Owned files and files shared with the user are two separate
+        # indexed lookups instead of one OR across a join
+        shared = File.objects.filter(shares__shared_with_id=user_id, **filters)
+        if _is_true(params.get('shared_only')):
+            return [shared]
+        return [File.objects.filter(user_id=user_id, **filters), shared]
 
-            except Exception as e:
-                errors.append({
-                    'file_name': uploaded_file.name,
-                    'error': str(e)
-                })
-            
-            finally:
-                # 6️⃣ Cleanup
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                    except Exception:
-                        pass
+    def list(self, request, *args, **kwargs):
+        page = self.paginator.paginate_querysets(self.get_list_querysets(), request)
+        serializer = self.get_serializer(page, many=True)
+        return self.paginator.get_paginated_response(serializer.data)
 
-        if created_files:
-            serializer = FileSerializer(created_files, many=True)
-            response_data = {
-                'success': True,
-                'created_files': serializer.data,
-                'total_created': len(created_files)
-            }
-            if errors:
-                response_data['errors'] = errors
-                response_data['partial_success'] = True
-            return Response(response_data, status=status.HTTP_201_CREATED)
-        else:
-            return Response({
-                'success': False,
-                'errors': errors
-            }, status=status.HTTP_400_BAD_REQUEST)
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['user_id'] = self.request.query_params.get('user_id') or self.request.data.get('user_id')
+        return context
 
     # 🆕 Toggle Star/Unstar file
     @action(detail=True, methods=['post'], url_path='toggle-star', permission_classes=[permissions.AllowAny])
@@ -138,65 +95,6 @@ class FileViewSet(viewsets.ModelViewSet):
             'isStarred': file.isStarred
         }, status=status.HTTP_200_OK)
 
-    @action(detail=True, methods=['post'], url_path='share', permission_classes=[permissions.AllowAny])
-    def share_file(self, request, pk=None):
-        shared_with_email = request.data.get('shared_with_email')
-        owner_id = request.data.get('owner_id')
-        
-        if not shared_with_email:
-            return Response({'error': 'shared_with_email is required'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        if not owner_id:
-            return Response({'error': 'owner_id is required'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Verify that the file exists and user owns it
-        try:
-            file = File.objects.get(id=pk, user_id=owner_id)
-        except File.DoesNotExist:
-            return Response({'error': 'File not found or you do not own this file'}, status=status.HTTP_404_NOT_FOUND)
-        
-        try:
-            # 🆕 List users - it returns a list directly
-            users_list = supabase.auth.admin.list_users()
-            
-            print(f"Found {len(users_list)} users")  # Debug
-            print("Users:", users_list)  # Debug
-            
-            target_user = None
-            for user in users_list:  # Directly iterate over the list
-                print(f"Checking user: {user.email}")  # Debug
-                if user.email == shared_with_email:
-                    target_user = user
-                    break
-            
-            if not target_user:
-                return Response({'error': 'User with this email not found in Supabase Auth'}, status=status.HTTP_404_NOT_FOUND)
-            
-            shared_with_uuid = target_user.id
-            print(f"Found user ID: {shared_with_uuid}")  # Debug
-            
-            # Check if already shared
-            if FileShare.objects.filter(file=file, shared_with_id=shared_with_uuid).exists():
-                return Response({'error': 'File already shared with this user'}, status=status.HTTP_400_BAD_REQUEST)
-            
-            # Create share record
-            share = FileShare.objects.create(
-                file=file,
-                owner_id=owner_id,
-                shared_with_id=shared_with_uuid
-            )
-            
-            serializer = FileShareSerializer(share)
-            return Response({
-                'success': True,
-                'message': f'File shared successfully with {shared_with_email}',
-                'share': serializer.data
-            }, status=status.HTTP_201_CREATED)
-            
-        except Exception as e:
-            print(f"Error details: {str(e)}")  # Debug
-            return Response({'error': f'Failed to find user: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        
     # 🆕 Get shared files for a user
     @action(detail=False, methods=['get'], url_path='shared-with-me', permission_classes=[permissions.AllowAny])
     def shared_with_me(self, request):
@@ -231,20 +129,12 @@ class FileViewSet(viewsets.ModelViewSet):
             return Response({'error': 'File not found or you do not own this file'}, status=status.HTTP_404_NOT_FOUND)
         
         try:
-            # 🆕 Get user UUID from Supabase Auth by email
-            users_list = supabase.auth.admin.list_users()
-            
-            target_user = None
-            for user in users_list:  # Direct iteration over the list
-                if user.email == shared_with_email:
-                    target_user = user
-                    break
+            # 🆕 Get user UUID from the cached local user directory
+            shared_with_uuid = resolve_user_id(shared_with_email)
             
-            if not target_user:
+            if not shared_with_uuid:
                 return Response({'error': 'User with this email not found in Supabase Auth'}, status=status.HTTP_404_NOT_FOUND)
             
-            shared_with_uuid = target_user.id
-            
             # Delete share record
             share = get_object_or_404(FileShare, file=file, shared_with_id=shared_with_uuid)
             share.delete()
@@ -285,9 +175,8 @@ class FileViewSet(viewsets.ModelViewSet):
         }, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['get'], url_path='count-all', permission_classes=[permissions.AllowAny])
-    def count_all_files(self, request):
-        count = File.objects.count()
-        return Response({'total_files': count}, status=status.HTTP_200_OK)
+    def count_all(self, request):
+        return Response({'total_files': count_all_files()}, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=['post'], url_path='total-size', permission_classes=[permissions.AllowAny])
     def total_size_by_user(self, request):
@@ -296,76 +185,110 @@ class FileViewSet(viewsets.ModelViewSet):
             return Response({'error': 'user_id is required'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            total_size = File.objects.filter(user_id=user_id).aggregate(total=Sum('size'))['total'] or 0
-            return Response({'user_id': user_id, 'total_size': total_size}, status=status.HTTP_200_OK)
+            # Single-row read of the maintained counters instead of a SUM over all files
+            usage = get_usage(user_id)
+            return Response({
+                'user_id': user_id,
+                'total_size': usage.total_bytes,
+                'file_count': usage.file_count,
+                'starred_count': usage.starred_count
+            }, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
     
-    @action(detail=True, methods=['get'], url_path='download', permission_classes=[permissions.AllowAny])
-    def download_file(self, request, pk=None):
-            file = get_object_or_404(File, pk=pk)
-            
+    # 🖼️ Thumbnail / first-page preview of an image or PDF
+    @action(detail=True, methods=['get'], url_path='preview', permission_classes=[permissions.AllowAny])
+    def preview(self, request, pk=None):
+        kind = request.query_params.get('kind', 'thumbnail')
+        if not is_derivative_kind(kind):
+            return Response({'error': 'kind must be thumbnail or preview'}, status=status.HTTP_400_BAD_REQUEST)
+
+        file = get_object_or_404(File.objects.select_related('blob'), pk=pk)
+        derivative = BlobDerivative.objects.filter(blob=file.blob, kind=kind).first() if file.blob else None
+        if derivative is None:
+            return Response({'error': 'No preview available for this file'}, status=status.HTTP_404_NOT_FOUND)
+        derivative.blob = file.blob
+
+        # Derivatives are content-addressed, so they never change under a given ETag
+        etag = f'"{derivative.blob_id}-{kind}"'
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
             try:
-                # Download from Supabase
-                bucket_name = "uploads"
-                encrypted_content = supabase.storage.from_(bucket_name).download(file.name)
-                
-                if not encrypted_content:
-                    return Response({'error': 'File not found in storage'}, status=status.HTTP_404_NOT_FOUND)
-                
-                # Create a temporary file to use with your decrypt_file function
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    temp_file.write(encrypted_content)
-                    temp_path = temp_file.name
-                
-                try:
-                    # 🔐 DECRYPT THE FILE CONTENT using your existing function
-                    decrypted_content = decrypt_file(temp_path)
-                    
-                    # Create response with decrypted file
-                    response = HttpResponse(decrypted_content, content_type='application/octet-stream')
-                    response['Content-Disposition'] = f'attachment; filename="{file.name}"'
-                    return response
-                    
-                finally:
-                    # Clean up temporary file
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
-                
+                response = HttpResponse(load_derivative(derivative), content_type=DERIVATIVE_CONTENT_TYPE)
             except Exception as e:
                 return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            
-  # 🆕 Get top 5 file types by extracting from filename
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+
+    # 🆕 Get top file types, counted in the database
     @action(detail=False, methods=['get'], url_path='top-file-types', permission_classes=[permissions.AllowAny])
     def top_file_types(self, request):
+        params = request.query_params
         try:
-            # Get all files
-            files = File.objects.all()
-            
-            # Extract file extensions from names
-            extensions = []
-            for file in files:
-                if file.name:
-                    # Get file extension using os.path.splitext
-                    _, ext = os.path.splitext(file.name)
-                    if ext:
-                        # Remove the dot and convert to lowercase
-                        ext = ext.lower().lstrip('.')
-                        extensions.append(ext if ext else 'no_extension')
-                    else:
-                        extensions.append('no_extension')
-                else:
-                    extensions.append('unknown')
-            
-            # Count occurrences and get top 5
-            extension_counter = Counter(extensions)
-            top_5 = dict(extension_counter.most_common(5))
+            limit = max(1, min(int(params.get('limit', 5)), 50))
+        except ValueError:
+            return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+
+        date_from = parse_date(params['date_from']) if params.get('date_from') else None
+        date_to = parse_date(params['date_to']) if params.get('date_to') else None
+        if (params.get('date_from') and not date_from) or (params.get('date_to') and not date_to):
+            return Response({'error': 'Dates must be in YYYY-MM-DD format'}, status=status.HTTP_400_BAD_REQUEST)
+
+        files = File.objects.all()
+        if params.get('user_id'):
+            try:
+                files = files.filter(user_id=uuid.UUID(params['user_id']))
+            except ValueError:
+                return Response({'error': 'user_id must be a UUID'}, status=status.HTTP_400_BAD_REQUEST)
+        # Bare column comparisons against local midnights, so the uploaded_at indexes serve the range
+        if date_from:
+            files = files.filter(uploaded_at__gte=_start_of_day(date_from))
+        if date_to:
+            files = files.filter(uploaded_at__lt=_start_of_day(date_to + timedelta(days=1)))
+
+        try:
+
+            # GROUP BY extension ORDER BY count DESC LIMIT n
+            rows = (
+                files.order_by()
+                .values('extension')
+                .annotate(count=Count('id'))
+                .order_by('-count', 'extension')[:limit]
+            )
+            top = {row['extension'] or 'no_extension': row['count'] for row in rows}
             
-            return Response(top_5, status=status.HTTP_200_OK)
+            return Response(top, status=status.HTTP_200_OK)
             
         except Exception as e:
             return Response(
                 {'error': f'Failed to fetch top file types: {str(e)}'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
\ No newline at end of file
+            )
+
+
+@require_http_methods(["GET"])
+def storage_object(request, bucket, path):
+    """Stored (still encrypted) object behind a presigned URL of the local or in-memory backend."""
+    if not check_presigned(bucket, path, request.GET.get('token')):
+        return JsonResponse({'error': 'Invalid or expired link'}, status=403)
+    storage = get_storage()
+    try:
+        local_path = storage.local_path(bucket, path)
+        if local_path and settings.STORAGE_ACCEL_REDIRECT_PREFIX:
+            if not os.path.exists(local_path):
+                raise FileNotFoundError(local_path)
+            # nginx serves the file from its internal location; the worker only checked the token
+            response = HttpResponse(content_type='application/octet-stream')
+            response['X-Accel-Redirect'] = f"{settings.STORAGE_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{bucket}/{path}"
+            return response
+        if local_path:
+            return FileResponse(open(local_path, 'rb'), content_type='application/octet-stream')
+        size = storage.stat(bucket, path)
+    except (FileNotFoundError, StorageObjectNotFound, ValueError):
+        return JsonResponse({'error': 'Not found'}, status=404)
+    response = StreamingHttpResponse(storage.download_range(bucket, path), content_type='application/octet-stream')
+    response['Content-Length'] = size
+    return response
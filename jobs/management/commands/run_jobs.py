@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from jobs.queue import run_due_jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs (file uploads, ...); start as many workers as needed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once no job is due instead of polling")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to wait between polls while the queue is empty")
+        parser.add_argument('--batch', type=int, default=10,
+                            help="Jobs fetched per poll")
+        parser.add_argument('--name', action='append', dest='names',
+                            help="Only run jobs with this name (repeatable)")
+        parser.add_argument('--visibility-timeout', type=int, default=None,
+                            help="Seconds a claimed job is hidden from other workers (default JOB_VISIBILITY_TIMEOUT)")
+
+    def handle(self, *args, **options):
+        # Handlers are registered when their apps load
+        while True:
+            results = run_due_jobs(options['batch'], options['names'], options['visibility_timeout'])
+            for job_id, job_status in results:
+                self.stdout.write(f"job {job_id}: {job_status}")
+            close_old_connections()
+            if not results:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
@@ -0,0 +1,117 @@
+"""Database-backed job queue.
+
+Jobs are rows in the Job table. `manage.py run_jobs` workers poll for due
+jobs, claim one with a conditional UPDATE and run its handler. A claim
+holds the job for the visibility timeout; a worker that dies mid-job
+leaves it to be claimed again once that runs out, so handlers must be
+safe to run more than once. Failed attempts are retried with exponential
+backoff until the job's max_attempts is used up.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+# name -> (handler, on_failure)
+_handlers = {}
+
+
+def register(name, on_failure=None):
+    """Register the decorated function as the handler for jobs called `name`.
+
+    The handler is called with the job's payload as keyword arguments.
+    `on_failure(error, **payload)` runs once the job has failed for good.
+    """
+    def decorator(func):
+        _handlers[name] = (func, on_failure)
+        return func
+    return decorator
+
+
+def _new_job(name, payload, delay, max_attempts):
+    return Job(
+        name=name,
+        payload=payload or {},
+        run_at=timezone.now() + timedelta(seconds=delay),
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+    )
+
+
+def enqueue(name, payload=None, delay=0, max_attempts=None):
+    """Queue a job. Workers see it once the caller's transaction commits."""
+    job = _new_job(name, payload, delay, max_attempts)
+    job.save()
+    return job
+
+
+def enqueue_many(name, payloads, delay=0, max_attempts=None):
+    """Queue one job per payload with a single INSERT."""
+    return Job.objects.bulk_create([_new_job(name, payload, delay, max_attempts) for payload in payloads])
+
+
+def _claimable(now):
+    return Q(status=Job.Status.QUEUED, run_at__lte=now) | Q(status=Job.Status.RUNNING, locked_until__lt=now)
+
+
+def due_jobs(limit=10, names=None):
+    """Ids of jobs that are due, or whose worker's visibility timeout ran out."""
+    jobs = Job.objects.filter(_claimable(timezone.now()))
+    if names:
+        jobs = jobs.filter(name__in=names)
+    return list(jobs.order_by('run_at').values_list('pk', flat=True)[:limit])
+
+
+def claim(job_id, visibility_timeout=None):
+    """Atomically take a job, hiding it from other workers for `visibility_timeout` seconds."""
+    now = timezone.now()
+    timeout = visibility_timeout or settings.JOB_VISIBILITY_TIMEOUT
+    return Job.objects.filter(_claimable(now), pk=job_id).update(
+        status=Job.Status.RUNNING,
+        attempts=F('attempts') + 1,
+        locked_until=now + timedelta(seconds=timeout),
+        updated_at=now,
+    )
+
+
+def run_job(job_id, visibility_timeout=None):
+    """Claim and run one job. Returns its resulting status, or None if another worker has it."""
+    if not claim(job_id, visibility_timeout):
+        return None
+    job = Job.objects.get(pk=job_id)
+    handler, on_failure = _handlers.get(job.name, (None, None))
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for job {job.name!r}")
+        handler(**job.payload)
+    except Exception as e:
+        return _job_failed(job, f"{type(e).__name__}: {e}", retry=handler is not None, on_failure=on_failure)
+    # Finished jobs are not kept; the table only holds outstanding and failed work
+    job.delete()
+    return Job.Status.DONE
+
+
+def _job_failed(job, error, retry, on_failure):
+    if retry and job.attempts < job.max_attempts:
+        job.status = Job.Status.QUEUED
+        job.run_at = timezone.now() + timedelta(seconds=settings.JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+    else:
+        job.status = Job.Status.FAILED
+    job.locked_until = None
+    job.last_error = error
+    job.save(update_fields=['status', 'run_at', 'locked_until', 'last_error', 'updated_at'])
+    if job.status == Job.Status.FAILED and on_failure is not None:
+        on_failure(error, **job.payload)
+    return job.status
+
+
+def run_due_jobs(limit=10, names=None, visibility_timeout=None):
+    """Run up to `limit` due jobs in this process. Returns [(job_id, status)] for the ones it ran."""
+    results = []
+    for job_id in due_jobs(limit, names):
+        job_status = run_job(job_id, visibility_timeout)
+        if job_status is not None:
+            results.append((job_id, job_status))
+    return results
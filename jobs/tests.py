@@ -0,0 +1,76 @@
+import io
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import Job
+from .queue import _handlers, claim, enqueue, register, run_due_jobs, run_job
+
+
+@override_settings(JOB_RETRY_BACKOFF=10, JOB_VISIBILITY_TIMEOUT=60)
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.failures = []
+        register('test.record', on_failure=lambda error, **payload: self.failures.append((error, payload)))(self.record)
+        self.addCleanup(_handlers.pop, 'test.record', None)
+
+    def record(self, value, fail=False):
+        self.calls.append(value)
+        if fail:
+            raise ValueError(f"bad {value}")
+
+    def test_job_runs_once_and_is_removed(self):
+        job = enqueue('test.record', {'value': 1})
+        self.assertEqual(run_due_jobs(), [(job.pk, 'done')])
+        self.assertEqual(self.calls, [1])
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(run_due_jobs(), [])
+
+    def test_delayed_job_waits(self):
+        enqueue('test.record', {'value': 1}, delay=60)
+        self.assertEqual(run_due_jobs(), [])
+
+    def test_claimed_job_hidden_until_visibility_timeout(self):
+        job = enqueue('test.record', {'value': 1})
+        self.assertTrue(claim(job.pk))
+        # another worker can't take it while the first one holds it
+        self.assertIsNone(run_job(job.pk))
+        self.assertEqual(run_due_jobs(), [])
+
+        # the first worker died: the job becomes visible again
+        Job.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(run_due_jobs(), [(job.pk, 'done')])
+        self.assertEqual(self.calls, [1])
+
+    def test_failures_back_off_then_give_up(self):
+        job = enqueue('test.record', {'value': 2, 'fail': True}, max_attempts=3)
+        for attempt in range(1, 4):
+            Job.objects.update(run_at=timezone.now())
+            before = timezone.now()
+            job_status = run_job(job.pk)
+            job.refresh_from_db()
+            self.assertEqual(job.attempts, attempt)
+            if attempt < 3:
+                self.assertEqual(job_status, 'queued')
+                self.assertGreaterEqual(job.run_at, before + timedelta(seconds=10 * 2 ** (attempt - 1)))
+        self.assertEqual(job_status, 'failed')
+        self.assertIn('ValueError: bad 2', job.last_error)
+        self.assertEqual(self.failures, [(job.last_error, {'value': 2, 'fail': True})])
+        self.assertEqual(run_due_jobs(), [])
+
+    def test_unknown_job_fails_without_retry(self):
+        job = enqueue('test.missing')
+        self.assertEqual(run_job(job.pk), 'failed')
+        self.assertIn('No handler', Job.objects.get().last_error)
+
+    def test_worker_command_once(self):
+        enqueue('test.record', {'value': 1})
+        enqueue('test.record', {'value': 2})
+        out = io.StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+        self.assertEqual(sorted(self.calls), [1, 2])
+        self.assertEqual(out.getvalue().count(': done'), 2)
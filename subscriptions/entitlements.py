@@ -0,0 +1,91 @@
+from utils.cache import LRUTTLCache
+from .models import Subscription
+from .plans import get_plan
+
+GiB = 1024 ** 3
+MiB = 1024 ** 2
+
+# None means unlimited
+TIER_LIMITS = {
+    'free': {'max_storage_bytes': 5 * GiB, 'max_file_size': 100 * MiB, 'max_shares': 20},
+    'pro': {'max_storage_bytes': 100 * GiB, 'max_file_size': 2 * GiB, 'max_shares': 1000},
+    'premium': {'max_storage_bytes': 1024 * GiB, 'max_file_size': 10 * GiB, 'max_shares': None},
+}
+
+# Dropped on subscription changes in this process; other processes catch up within the TTL
+_entitlements_cache = LRUTTLCache(maxsize=10000, ttl=300)
+
+
+class PlanLimitExceeded(Exception):
+    """An action would go over the user's plan limits."""
+
+    def __init__(self, message, status_code=403):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Entitlements:
+    """What a user's plan allows them to do."""
+
+    def __init__(self, tier, max_storage_bytes=None, max_file_size=None, max_shares=None):
+        self.tier = tier
+        self.max_storage_bytes = max_storage_bytes
+        self.max_file_size = max_file_size
+        self.max_shares = max_shares
+
+    def remaining_bytes(self, used_bytes):
+        if self.max_storage_bytes is None:
+            return None
+        return max(self.max_storage_bytes - used_bytes, 0)
+
+    def check_file_sizes(self, sizes):
+        if self.max_file_size is not None and any(size > self.max_file_size for size in sizes):
+            raise PlanLimitExceeded(
+                f"Files on the {self.tier} plan can be at most {self.max_file_size} bytes",
+                status_code=413
+            )
+
+    def check_storage(self, incoming_bytes, used_bytes):
+        remaining = self.remaining_bytes(used_bytes)
+        if remaining is not None and incoming_bytes > remaining:
+            raise PlanLimitExceeded(
+                f"Upload exceeds your {self.tier} plan storage limit ({remaining} bytes left)",
+                status_code=413
+            )
+
+    def check_upload(self, sizes, used_bytes):
+        """Raise PlanLimitExceeded unless files of `sizes` bytes fit the plan."""
+        self.check_file_sizes(sizes)
+        self.check_storage(sum(sizes), used_bytes)
+
+    def check_share(self, share_count):
+        if self.max_shares is not None and share_count >= self.max_shares:
+            raise PlanLimitExceeded(f"The {self.tier} plan allows at most {self.max_shares} shares")
+
+
+def entitlements_for_tier(tier):
+    return Entitlements(tier, **TIER_LIMITS.get(tier, TIER_LIMITS['free']))
+
+
+def get_entitlements(user_id):
+    """A user's entitlements; one query on a cache miss, none otherwise.
+
+    Users without an active subscription get the free tier.
+    """
+    key = str(user_id)
+    entitlements = _entitlements_cache.get(key)
+    if entitlements is None:
+        row = Subscription.objects.filter(
+            user_id=key, status=Subscription.Status.ACTIVE
+        ).values_list('plan_id', flat=True).first()
+        plan = get_plan(row) if row is not None else None
+        entitlements = entitlements_for_tier(plan.tier if plan else 'free')
+        _entitlements_cache.set(key, entitlements)
+    return entitlements
+
+
+def invalidate_entitlements(user_id=None):
+    if user_id is None:
+        _entitlements_cache.clear()
+    else:
+        _entitlements_cache.delete(str(user_id))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from subscriptions.services import dedupe_subscriptions
+
+
+class Command(BaseCommand):
+    help = "Keep one subscription per user (the newest active one); run before applying the unique user_id constraint"
+
+    def handle(self, *args, **options):
+        user_ids = dedupe_subscriptions()
+        self.stdout.write(self.style.SUCCESS(f"Removed duplicate subscriptions of {len(user_ids)} users"))
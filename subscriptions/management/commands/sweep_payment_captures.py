@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from subscriptions.payments import capture_order, due_captures
+
+
+class Command(BaseCommand):
+    help = "Capture queued PayPal orders that are due for a retry or were left mid-capture by a dead worker"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+                            help="Keep sweeping every N seconds instead of running once")
+
+    def handle(self, *args, **options):
+        while True:
+            order_ids = due_captures()
+            for order_id in order_ids:
+                status = capture_order(order_id)
+                self.stdout.write(f"{order_id}: {status}")
+            self.stdout.write(self.style.SUCCESS(f"Swept {len(order_ids)} payment orders"))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
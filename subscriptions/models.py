@@ -1,4 +1,6 @@
 # models.py
+import uuid
+
 from django.db import models
 
 class SubscriptionPlan(models.Model):
@@ -25,7 +27,7 @@ class Subscription(models.Model):
         EXPIRED = 'expired', 'Expired'
     
     # Use CharField for Supabase user_id instead of ForeignKey
-    user_id = models.CharField(max_length=255, db_index=True)
+    user_id = models.CharField(max_length=255, unique=True)
     plan = models.ForeignKey(SubscriptionPlan, on_delete=models.CASCADE)
     status = models.CharField(
         max_length=20, 
@@ -37,8 +39,39 @@ class Subscription(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def __str__(self):
+        return f"{self.user_id} - {self.plan.name}"
+
+class PaymentOrder(models.Model):
+    """State of a PayPal checkout order, keyed by the PayPal order id.
+
+    Capture runs in the background; this row makes it idempotent across
+    client retries and worker restarts and is what the client polls.
+    """
+    class Status(models.TextChoices):
+        CREATED = 'created', 'Created'
+        QUEUED = 'queued', 'Queued'
+        CAPTURING = 'capturing', 'Capturing'
+        COMPLETED = 'completed', 'Completed'
+        FAILED = 'failed', 'Failed'
+
+    order_id = models.CharField(max_length=64, primary_key=True)
+    user_id = models.CharField(max_length=255, db_index=True)
+    plan = models.ForeignKey(SubscriptionPlan, on_delete=models.PROTECT)
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.CREATED)
+    # Sent as PayPal-Request-Id so a repeated capture returns the original result
+    request_id = models.UUIDField(default=uuid.uuid4, editable=False)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    capture_id = models.CharField(max_length=64, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
     class Meta:
-        unique_together = ['user_id', 'plan']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='paymentorder_status_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.user_id} - {self.plan.name}"
\ No newline at end of file
+        return f"{self.order_id} ({self.status})"
@@ -0,0 +1,121 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import PaymentOrder, Subscription
+from .paypal_service import PayPalError, PayPalService
+
+# A capture still marked in progress after this long is assumed to have
+# died with its worker and is picked up again by the sweeper
+CAPTURE_LEASE = timedelta(minutes=2)
+MAX_CAPTURE_ATTEMPTS = 5
+RETRY_BACKOFF = 15  # seconds, doubled after every failed attempt
+
+_executor = ThreadPoolExecutor(max_workers=settings.PAYPAL_CAPTURE_WORKERS, thread_name_prefix='paypal-capture')
+
+
+def queue_capture(order):
+    """Mark an approved order for capture. Returns True if this call queued it."""
+    orders = PaymentOrder.objects.filter(order_id=order.order_id)
+    queued = {'status': PaymentOrder.Status.QUEUED, 'next_attempt_at': timezone.now(), 'error': ''}
+    if orders.filter(status=PaymentOrder.Status.CREATED).update(**queued):
+        return True
+    # PayPal answers a repeated PayPal-Request-Id with the cached result, so a
+    # capture that failed is retried under a new id (and a fresh attempt budget).
+    # An order PayPal did capture after all is refused as ORDER_ALREADY_CAPTURED,
+    # which capture_order() settles from the order itself.
+    return bool(orders.filter(status=PaymentOrder.Status.FAILED).update(
+        request_id=uuid.uuid4(), attempts=0, **queued
+    ))
+
+
+def enqueue_capture(order_id):
+    """Run the capture on the in-process worker pool."""
+    _executor.submit(_run_capture, order_id)
+
+
+def _run_capture(order_id):
+    try:
+        capture_order(order_id)
+    except Exception as e:
+        print(f"💥 Capture worker error for {order_id}: {str(e)}")
+    finally:
+        close_old_connections()
+
+
+def _claim(order_id):
+    """Atomically take an order for capture so only one worker ever calls PayPal for it."""
+    now = timezone.now()
+    claimable = Q(status=PaymentOrder.Status.QUEUED) | Q(
+        status=PaymentOrder.Status.CAPTURING, updated_at__lt=now - CAPTURE_LEASE
+    )
+    return PaymentOrder.objects.filter(claimable, order_id=order_id).update(
+        status=PaymentOrder.Status.CAPTURING, attempts=F('attempts') + 1, updated_at=now
+    )
+
+
+def capture_order(order_id):
+    """Capture a queued order with PayPal and activate the subscription it pays for.
+
+    Safe to call more than once and from several processes: the order is
+    claimed before PayPal is called, and the capture itself carries the
+    order's PayPal-Request-Id. Returns the order's resulting status.
+    """
+    if not _claim(order_id):
+        return PaymentOrder.objects.values_list('status', flat=True).get(order_id=order_id)
+
+    order = PaymentOrder.objects.select_related('plan').get(order_id=order_id)
+    try:
+        payment = PayPalService.execute_payment(order.order_id, request_id=order.request_id)
+    except PayPalError as e:
+        if e.issue != 'ORDER_ALREADY_CAPTURED':
+            return _capture_failed(order, str(e), retry=e.retryable)
+        # Captured by an earlier attempt whose answer never arrived; the order holds the capture
+        try:
+            payment = PayPalService.get_order(order.order_id)
+        except PayPalError as e:
+            return _capture_failed(order, str(e), retry=e.retryable)
+
+    if payment.get('status') != 'COMPLETED':
+        return _capture_failed(order, f"Payment not completed: {payment.get('status')}", retry=False)
+
+    captures = payment.get('purchase_units', [{}])[0].get('payments', {}).get('captures', [])
+    with transaction.atomic():
+        Subscription.objects.update_or_create(
+            user_id=order.user_id,
+            defaults={'plan': order.plan, 'status': Subscription.Status.ACTIVE},
+        )
+        order.status = PaymentOrder.Status.COMPLETED
+        order.capture_id = captures[0]['id'] if captures else ''
+        order.error = ''
+        order.next_attempt_at = None
+        order.save(update_fields=['status', 'capture_id', 'error', 'next_attempt_at', 'updated_at'])
+    return order.status
+
+
+def _capture_failed(order, error, retry):
+    if retry and order.attempts < MAX_CAPTURE_ATTEMPTS:
+        order.status = PaymentOrder.Status.QUEUED
+        order.next_attempt_at = timezone.now() + timedelta(seconds=RETRY_BACKOFF * 2 ** (order.attempts - 1))
+    else:
+        order.status = PaymentOrder.Status.FAILED
+        order.next_attempt_at = None
+    order.error = error
+    order.save(update_fields=['status', 'next_attempt_at', 'error', 'updated_at'])
+    return order.status
+
+
+def due_captures(limit=100):
+    """Order ids the sweeper should (re)try: queued and due, or stuck mid-capture."""
+    now = timezone.now()
+    return list(
+        PaymentOrder.objects.filter(
+            Q(status=PaymentOrder.Status.QUEUED, next_attempt_at__lte=now)
+            | Q(status=PaymentOrder.Status.CAPTURING, updated_at__lt=now - CAPTURE_LEASE)
+        ).order_by('next_attempt_at').values_list('order_id', flat=True)[:limit]
+    )
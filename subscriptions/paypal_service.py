@@ -1,56 +1,140 @@
 # subscriptions/paypal_service.py
+import threading
+import time
+
 import requests
-import base64
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.conf import settings
 
+# Refresh the token this many seconds before PayPal says it expires
+TOKEN_REFRESH_MARGIN = 300
+REQUEST_TIMEOUT = 30
+
+
+# Statuses worth re-sending a request for, and how often
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+STATUS_RETRIES = 2
+BACKOFF_FACTOR = 0.5
+
+
+def _build_session():
+    """Shared keep-alive session for PayPal.
+
+    Connection errors are retried for every request (nothing reached
+    PayPal). Error statuses are only retried here for GETs; POSTs are
+    re-sent by PayPalService._post, and only when they are idempotent.
+    """
+    retry = Retry(
+        total=3,
+        connect=3,
+        read=0,  # never resend a request PayPal may already have processed
+        status=STATUS_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=16, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return min(int(retry_after), 30)
+    return BACKOFF_FACTOR * 2 ** attempt
+
+
+class PayPalError(Exception):
+    """A PayPal API call failed. `status_code` is None for network errors."""
+
+    def __init__(self, message, status_code=None, issue=None):
+        super().__init__(message)
+        self.status_code = status_code
+        # PayPal's error detail code, e.g. ORDER_ALREADY_CAPTURED
+        self.issue = issue
+
+    @property
+    def retryable(self):
+        return self.status_code is None or self.status_code == 429 or self.status_code >= 500
+
+
+def _error_issue(response):
+    """First `details[].issue` of a PayPal error response, if it has one."""
+    try:
+        return response.json()["details"][0]["issue"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
 class PayPalService:
+    session = _build_session()
+
+    _token = None
+    _token_refresh_at = 0.0
+    _token_lock = threading.Lock()
+
+    @staticmethod
+    def base_url():
+        if settings.PAYPAL_API_BASE:
+            return settings.PAYPAL_API_BASE.rstrip("/")
+        if settings.PAYPAL_MODE == "sandbox":
+            return "https://api.sandbox.paypal.com"
+        return "https://api.paypal.com"
+
     @staticmethod
     def get_access_token():
-        """Get PayPal access token with better error handling"""
+        """Return a cached PayPal access token, fetching a new one shortly before it expires.
+
+        Only one thread fetches a token at a time; the others wait for it and
+        reuse the result instead of each doing their own OAuth round trip.
+        """
+        token = PayPalService._token
+        if token and time.monotonic() < PayPalService._token_refresh_at:
+            return token
+
+        with PayPalService._token_lock:
+            # Another thread may have refreshed it while we waited
+            if PayPalService._token and time.monotonic() < PayPalService._token_refresh_at:
+                return PayPalService._token
+            token, expires_in = PayPalService._fetch_access_token()
+            PayPalService._token = token
+            PayPalService._token_refresh_at = time.monotonic() + expires_in - min(TOKEN_REFRESH_MARGIN, expires_in / 2)
+            return token
+
+    @staticmethod
+    def invalidate_access_token():
+        with PayPalService._token_lock:
+            PayPalService._token = None
+            PayPalService._token_refresh_at = 0.0
+
+    @staticmethod
+    def _fetch_access_token():
+        """Client-credentials OAuth request. Returns (access_token, expires_in seconds)."""
         try:
             print("🔑 Getting PayPal access token...")
-            print(f"Client ID: {settings.PAYPAL_CLIENT_ID[:10]}...")
-            print(f"Mode: {settings.PAYPAL_MODE}")
-            print(f"Secret: {settings.PAYPAL_CLIENT_SECRET[:10]}...")
-
-            # Encode credentials
-            auth_string = f"{settings.PAYPAL_CLIENT_ID}:{settings.PAYPAL_CLIENT_SECRET}"
-            encoded_auth = base64.b64encode(auth_string.encode()).decode()
-            
-            # Determine API endpoint
-            if settings.PAYPAL_MODE == "sandbox":
-                base_url = "https://api.sandbox.paypal.com"
-            else:
-                base_url = "https://api.paypal.com"
-            
-            # Request access token
-            headers = {
-                "Authorization": f"Basic {encoded_auth}",
-                "Content-Type": "application/x-www-form-urlencoded"
-            }
-            
-            data = {"grant_type": "client_credentials"}
-            
-            print(f"🌐 Sending request to: {base_url}/v1/oauth2/token")
-            
-            response = requests.post(
-                f"{base_url}/v1/oauth2/token",
-                headers=headers,
-                data=data,
-                timeout=30
+            # Asking for a token twice is harmless
+            response = PayPalService._post(
+                f"{PayPalService.base_url()}/v1/oauth2/token",
+                idempotent=True,
+                auth=(settings.PAYPAL_CLIENT_ID, settings.PAYPAL_CLIENT_SECRET),
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                data={"grant_type": "client_credentials"},
             )
-            
-            print(f"📡 Response status: {response.status_code}")
-            
+
             if response.status_code == 200:
                 token_data = response.json()
                 print("✅ Access token received successfully")
-                return token_data["access_token"]
+                return token_data["access_token"], int(token_data.get("expires_in", 3600))
             else:
                 error_detail = response.text
                 print(f"❌ PayPal auth failed: {response.status_code} - {error_detail}")
-                
+
                 # More specific error messages
                 if "invalid_client" in error_detail:
                     raise Exception("Invalid PayPal credentials. Please check your Client ID and Secret.")
@@ -58,38 +142,85 @@ class PayPalService:
                     raise Exception("Unauthorized access. Check if your sandbox account is active.")
                 else:
                     raise Exception(f"PayPal authentication failed: {error_detail}")
-                
+
         except requests.exceptions.RequestException as e:
             print(f"🌐 Network error: {str(e)}")
             raise Exception(f"Network error: {str(e)}")
         except Exception as e:
             print(f"💥 Unexpected error: {str(e)}")
             raise Exception(f"Failed to get access token: {str(e)}")
-    
+
+    @staticmethod
+    def _post(url, idempotent=False, **kwargs):
+        """POST through the shared session.
+
+        Only idempotent requests (the token request, or calls carrying a
+        PayPal-Request-Id) are re-sent after a retryable error status; PayPal
+        may already have acted on any other request that got one.
+        """
+        attempts = 1 + (STATUS_RETRIES if idempotent else 0)
+        for attempt in range(attempts):
+            response = PayPalService.session.post(url, timeout=REQUEST_TIMEOUT, **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                return response
+            time.sleep(_retry_delay(response, attempt))
+
     @staticmethod
-    def create_payment(plan_id, user_id, return_url, cancel_url):
+    def _api_post(path, payload, headers=None):
+        """POST to the PayPal REST API with the cached token, retrying once if it was revoked."""
+        idempotent = bool(headers and headers.get("PayPal-Request-Id"))
+        for attempt in range(2):
+            response = PayPalService._post(
+                f"{PayPalService.base_url()}{path}",
+                idempotent=idempotent,
+                headers={
+                    "Authorization": f"Bearer {PayPalService.get_access_token()}",
+                    "Content-Type": "application/json",
+                    "Prefer": "return=representation",
+                    **(headers or {})
+                },
+                json=payload,
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            PayPalService.invalidate_access_token()
+
+    @staticmethod
+    def _api_get(path):
+        """GET from the PayPal REST API with the cached token, retrying once if it was revoked."""
+        for attempt in range(2):
+            response = PayPalService.session.get(
+                f"{PayPalService.base_url()}{path}",
+                timeout=REQUEST_TIMEOUT,
+                headers={"Authorization": f"Bearer {PayPalService.get_access_token()}"},
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            PayPalService.invalidate_access_token()
+
+    @staticmethod
+    def get_order(order_id):
+        """Current state of an order (v2), including its captures."""
+        try:
+            response = PayPalService._api_get(f"/v2/checkout/orders/{order_id}")
+        except requests.exceptions.RequestException as e:
+            raise PayPalError(f"Network error: {str(e)}")
+        if response.status_code != 200:
+            raise PayPalError(f"Order lookup failed: {response.text}", response.status_code, _error_issue(response))
+        return response.json()
+
+    @staticmethod
+    def create_payment(plan_id, user_id, return_url, cancel_url, request_id=None):
         """Create PayPal payment using direct API"""
-        from .models import SubscriptionPlan
-        
+        from .plans import get_plan
+
         try:
             print("💰 Creating PayPal payment...")
-            plan = SubscriptionPlan.objects.get(id=plan_id)
+            plan = get_plan(plan_id)
+            if plan is None:
+                raise Exception("Plan not found")
             print(f"📦 Plan: {plan.name} - ₱{plan.price}")
-            
-            access_token = PayPalService.get_access_token()
-            
-            # Determine API endpoint
-            if settings.PAYPAL_MODE == "sandbox":
-                base_url = "https://api.sandbox.paypal.com"
-            else:
-                base_url = "https://api.paypal.com"
-            
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-                "Prefer": "return=representation"
-            }
-            
+
             payload = {
                 "intent": "CAPTURE",
                 "purchase_units": [{
@@ -107,30 +238,22 @@ class PayPalService:
                     "cancel_url": cancel_url
                 }
             }
-            
-            print(f"🌐 Creating payment at: {base_url}/v2/checkout/orders")
-            print(f"📦 Payload: {json.dumps(payload, indent=2)}")
-            
-            response = requests.post(
-                f"{base_url}/v2/checkout/orders",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
+
+            headers = {"PayPal-Request-Id": str(request_id)} if request_id else None
+            response = PayPalService._api_post("/v2/checkout/orders", payload, headers=headers)
+
             print(f"📡 Payment creation response: {response.status_code}")
-            
-            if response.status_code == 201:
+
+            if response.status_code in (200, 201):
                 payment_data = response.json()
                 print(f"✅ Payment created: {payment_data['id']}")
-                print(f"🔗 Status: {payment_data['status']}")
-                
+
                 # Find approval URL
                 approval_link = next(
-                    link for link in payment_data["links"] 
+                    link for link in payment_data["links"]
                     if link["rel"] == "approve"
                 )
-                
+
                 return {
                     'id': payment_data['id'],
                     'status': payment_data['status'],
@@ -140,50 +263,40 @@ class PayPalService:
                 error_detail = response.text
                 print(f"❌ Payment creation failed: {response.status_code} - {error_detail}")
                 raise Exception(f"Payment creation failed: {error_detail}")
-                
+
         except Exception as e:
             print(f"💥 Error in create_payment: {str(e)}")
             raise Exception(f"Failed to create payment: {str(e)}")
-    
+
     @staticmethod
-    def execute_payment(order_id):
-        """Execute payment using direct API (v2)"""
+    def execute_payment(order_id, request_id=None):
+        """Capture an approved order (v2).
+
+        With `request_id` (sent as PayPal-Request-Id) repeating the call
+        returns the original capture instead of capturing again.
+        """
         try:
             print(f"🔄 Executing payment for order: {order_id}")
-            access_token = PayPalService.get_access_token()
-            
-            if settings.PAYPAL_MODE == "sandbox":
-                base_url = "https://api.sandbox.paypal.com"
-            else:
-                base_url = "https://api.paypal.com"
-            
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-                "Prefer": "return=representation"
-            }
-            
-            print(f"🌐 Capturing payment at: {base_url}/v2/checkout/orders/{order_id}/capture")
-            
-            response = requests.post(
-                f"{base_url}/v2/checkout/orders/{order_id}/capture",
-                headers=headers,
-                json={},
-                timeout=30
-            )
-            
+
+            headers = {"PayPal-Request-Id": str(request_id)} if request_id else None
+            response = PayPalService._api_post(f"/v2/checkout/orders/{order_id}/capture", {}, headers=headers)
+
             print(f"📡 Payment execution response: {response.status_code}")
-            
-            if response.status_code == 201:
+
+            if response.status_code in (200, 201):
                 payment_data = response.json()
-                print("✅ Payment executed successfully")
-                print(f"💰 Status: {payment_data['status']}")
+                print(f"✅ Payment executed successfully: {payment_data['status']}")
                 return payment_data
             else:
                 error_detail = response.text
                 print(f"❌ Payment execution failed: {response.status_code} - {error_detail}")
-                raise Exception(f"Payment execution failed: {error_detail}")
-                
+                raise PayPalError(f"Payment execution failed: {error_detail}", response.status_code, _error_issue(response))
+
+        except PayPalError:
+            raise
+        except requests.exceptions.RequestException as e:
+            print(f"🌐 Network error: {str(e)}")
+            raise PayPalError(f"Network error: {str(e)}")
         except Exception as e:
             print(f"💥 Error in execute_payment: {str(e)}")
-            raise Exception(f"Failed to execute payment: {str(e)}")
\ No newline at end of file
+            raise PayPalError(f"Failed to execute payment: {str(e)}")
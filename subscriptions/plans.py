@@ -0,0 +1,96 @@
+import hashlib
+import json
+import threading
+import time
+
+from django.db import transaction
+
+from .models import SubscriptionPlan
+
+# Other processes only see plan changes through this expiry; the process
+# that saved the plan drops its copy right away through the signals
+CATALOG_TTL = 60
+
+_lock = threading.Lock()
+_catalog = None
+_generation = 0
+
+
+class PlanCatalog:
+    """Immutable snapshot of every subscription plan, loaded with one query."""
+
+    def __init__(self, plans):
+        from .serializers import SubscriptionPlanSerializer
+
+        self.plans = {plan.id: plan for plan in plans}
+        self.active = [plan for plan in plans if plan.is_active]
+        self.free = next((plan for plan in plans if plan.tier == 'free'), None)
+        self.active_data = SubscriptionPlanSerializer(self.active, many=True).data
+        self.active_data_by_id = {item['id']: item for item in self.active_data}
+        all_data = SubscriptionPlanSerializer(plans, many=True).data
+        self.version = hashlib.md5(json.dumps(all_data, sort_keys=True, default=str).encode()).hexdigest()
+        self.loaded_at = time.monotonic()
+
+    @property
+    def etag(self):
+        return f'"{self.version}"'
+
+
+def get_catalog():
+    """Current plan catalog; costs no queries until it expires or a plan changes."""
+    catalog = _catalog
+    if catalog is not None and time.monotonic() - catalog.loaded_at < CATALOG_TTL:
+        return catalog
+    return _load()
+
+
+def _load():
+    global _catalog
+    with _lock:
+        if _catalog is not None and time.monotonic() - _catalog.loaded_at < CATALOG_TTL:
+            return _catalog
+        generation = _generation
+        catalog = PlanCatalog(list(SubscriptionPlan.objects.order_by('id')))
+        # Don't keep a snapshot that a plan change raced with
+        if generation == _generation:
+            _catalog = catalog
+        return catalog
+
+
+def invalidate_catalog():
+    global _catalog, _generation
+    _generation += 1
+    _catalog = None
+
+
+def plan_changed():
+    """Drop the cached catalog now and again once the change is committed."""
+    invalidate_catalog()
+    transaction.on_commit(invalidate_catalog)
+
+
+def get_plan(plan_id, active_only=False):
+    """Plan by id from the catalog, or None."""
+    try:
+        plan = get_catalog().plans.get(int(plan_id))
+    except (TypeError, ValueError):
+        return None
+    if plan is None or (active_only and not plan.is_active):
+        return None
+    return plan
+
+
+def get_free_plan():
+    """The free plan, created with the defaults the first time it is needed."""
+    plan = get_catalog().free
+    if plan is None:
+        plan, _ = SubscriptionPlan.objects.get_or_create(
+            tier='free',
+            defaults={
+                'name': 'Free Plan',
+                'price': 0.00,
+                'interval_days': 36500,
+                'features': ['Basic features'],
+            }
+        )
+    return plan
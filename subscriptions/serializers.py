@@ -1,6 +1,6 @@
 # serializers.py
 from rest_framework import serializers
-from .models import SubscriptionPlan, Subscription
+from .models import PaymentOrder, SubscriptionPlan, Subscription
 
 class SubscriptionPlanSerializer(serializers.ModelSerializer):
     class Meta:
@@ -28,4 +28,10 @@ class UserSubscriptionSerializer(serializers.Serializer):
     id = serializers.CharField()
     username = serializers.CharField(required=False)
     email = serializers.EmailField(required=False)
-    subscription = SubscriptionSerializer()
\ No newline at end of file
+    subscription = SubscriptionSerializer()
+
+class PaymentOrderSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PaymentOrder
+        fields = ['order_id', 'user_id', 'plan_id', 'status', 'attempts', 'error', 'created_at', 'updated_at']
+        read_only_fields = fields
@@ -0,0 +1,48 @@
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Value, When
+
+from .models import Subscription
+from .plans import get_free_plan
+
+
+def get_or_create_subscription(user_id):
+    """A user's subscription with its plan, starting them on the free plan if they have none.
+
+    One query when the subscription exists. Concurrent first requests are
+    safe: the unique user_id makes the losing INSERT fall back to a get.
+    """
+    subscription, _ = Subscription.objects.select_related('plan').get_or_create(
+        user_id=user_id,
+        defaults={'plan': get_free_plan()}
+    )
+    return subscription
+
+
+def change_plan(subscription, plan):
+    """Move a subscription onto `plan` and make it active."""
+    subscription.plan = plan
+    subscription.status = Subscription.Status.ACTIVE
+    subscription.save(update_fields=['plan', 'status', 'updated_at'])
+    return subscription
+
+
+def dedupe_subscriptions():
+    """Delete all but one subscription row per user, ahead of the unique user_id constraint.
+
+    Keeps the newest active row, or the newest row if none is active.
+    Returns the user ids that had duplicates.
+    """
+    user_ids = list(
+        Subscription.objects.order_by().values('user_id')
+        .annotate(rows=Count('id')).filter(rows__gt=1)
+        .values_list('user_id', flat=True)
+    )
+    for user_id in user_ids:
+        with transaction.atomic():
+            rows = Subscription.objects.select_for_update().filter(user_id=user_id)
+            keep = rows.order_by(
+                Case(When(status=Subscription.Status.ACTIVE, then=Value(0)), default=Value(1), output_field=IntegerField()),
+                '-created_at', '-id',
+            ).values_list('id', flat=True).first()
+            rows.exclude(id=keep).delete()
+    return user_ids
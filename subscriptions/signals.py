@@ -0,0 +1,19 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .entitlements import invalidate_entitlements
+from .models import Subscription, SubscriptionPlan
+from .plans import plan_changed
+
+
+@receiver([post_save, post_delete], sender=SubscriptionPlan)
+def invalidate_plan_catalog(sender, instance, **kwargs):
+    plan_changed()
+    invalidate_entitlements()
+
+
+@receiver([post_save, post_delete], sender=Subscription)
+def invalidate_user_entitlements(sender, instance, **kwargs):
+    invalidate_entitlements(instance.user_id)
+    transaction.on_commit(lambda: invalidate_entitlements(instance.user_id))
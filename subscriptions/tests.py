@@ -1,3 +1,404 @@
-from django.test import TestCase
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from .entitlements import get_entitlements
+from .models import PaymentOrder, Subscription, SubscriptionPlan
+from .payments import capture_order, due_captures
+from .paypal_service import PayPalService
+from .plans import get_free_plan, get_plan, invalidate_catalog
+
+
+class FakePayPal(BaseHTTPRequestHandler):
+    """Just enough of the PayPal REST API for PayPalService, counting what it receives."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        state = self.server.state
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with state['lock']:
+            state['connections'].add(self.client_address)
+            state['requests'].append(self.path)
+            failures = state['fail'].get(self.path)
+            if failures:
+                state['fail'][self.path] = failures[1:]
+
+        if failures:
+            return self.send_json(failures[0], {'name': 'INTERNAL_SERVICE_ERROR'})
+
+        if self.path == '/v1/oauth2/token':
+            with state['lock']:
+                state['tokens'] += 1
+                token = f"token-{state['tokens']}"
+                state['valid_tokens'].add(token)
+            return self.send_json(200, {'access_token': token, 'expires_in': state['expires_in']})
+
+        if self.headers.get('Authorization', '').removeprefix('Bearer ') not in state['valid_tokens']:
+            return self.send_json(401, {'error': 'invalid_token'})
+
+        if self.path == '/v2/checkout/orders':
+            with state['lock']:
+                state['orders'] += 1
+                order_id = f"ORDER-{state['orders']}"
+            return self.send_json(201, {
+                'id': order_id,
+                'status': 'CREATED',
+                'links': [{'rel': 'approve', 'href': f'https://paypal.test/approve/{order_id}'}],
+            })
+        if self.path.endswith('/capture'):
+            order_id = self.path.split('/')[-2]
+            request_id = self.headers.get('PayPal-Request-Id')
+            with state['lock']:
+                state['request_ids'].append(request_id)
+                if request_id and request_id in state['captures']:
+                    return self.send_json(200, state['captures'][request_id])
+                if order_id in state['captured']:
+                    return self.send_json(422, {'name': 'UNPROCESSABLE_ENTITY', 'details': [{'issue': 'ORDER_ALREADY_CAPTURED'}]})
+                state['captured'].add(order_id)
+                body = {
+                    'id': order_id,
+                    'status': 'COMPLETED',
+                    'purchase_units': [{'payments': {'captures': [{'id': f'CAPTURE-{order_id}'}]}}],
+                }
+                state['captures'][request_id] = body
+            return self.send_json(201, body)
+        self.send_json(404, {})
+
+    def do_GET(self):
+        state = self.server.state
+        with state['lock']:
+            state['connections'].add(self.client_address)
+            state['requests'].append(self.path)
+        if self.headers.get('Authorization', '').removeprefix('Bearer ') not in state['valid_tokens']:
+            return self.send_json(401, {'error': 'invalid_token'})
+        if self.path.startswith('/v2/checkout/orders/'):
+            order_id = self.path.split('/')[-1]
+            if order_id not in state['captured']:
+                return self.send_json(200, {'id': order_id, 'status': 'APPROVED'})
+            return self.send_json(200, {
+                'id': order_id,
+                'status': 'COMPLETED',
+                'purchase_units': [{'payments': {'captures': [{'id': f'CAPTURE-{order_id}'}]}}],
+            })
+        self.send_json(404, {})
+
+
+class FakePayPalTestCase(TestCase):
+    """Points PayPalService at a FakePayPal server running in a thread."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakePayPal)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.settings_override = override_settings(
+            PAYPAL_API_BASE=f'http://127.0.0.1:{cls.server.server_port}',
+            PAYPAL_CLIENT_ID='client',
+            PAYPAL_CLIENT_SECRET='secret',
+        )
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.plan = SubscriptionPlan.objects.create(name='Pro', tier='pro', price=199)
+
+    def setUp(self):
+        self.server.state = self.state = {
+            'lock': threading.Lock(),
+            'connections': set(),
+            'requests': [],
+            'fail': {},
+            'tokens': 0,
+            'orders': 0,
+            'valid_tokens': set(),
+            'expires_in': 32400,
+            'request_ids': [],
+            'captures': {},
+            'captured': set(),
+        }
+        PayPalService.invalidate_access_token()
+        PayPalService.session.close()
+        invalidate_catalog()
+
+
+class PayPalServiceTests(FakePayPalTestCase):
+
+    def checkout(self):
+        payment = PayPalService.create_payment(self.plan.id, 'user-1', 'http://app/return', 'http://app/cancel')
+        return PayPalService.execute_payment(payment['id'])
+
+    def test_token_reused_across_calls(self):
+        for _ in range(3):
+            self.assertEqual(self.checkout()['status'], 'COMPLETED')
+        self.assertEqual(self.state['requests'].count('/v1/oauth2/token'), 1)
+
+    def test_connections_are_reused(self):
+        self.checkout()
+        self.checkout()
+        self.assertEqual(len(self.state['requests']), 5)
+        self.assertEqual(len(self.state['connections']), 1)
+
+    def test_token_refreshed_before_expiry(self):
+        self.state['expires_in'] = 600
+        with mock.patch('subscriptions.paypal_service.time.monotonic', return_value=1000.0):
+            self.assertEqual(PayPalService.get_access_token(), 'token-1')
+        # Still 5 minutes before PayPal's expiry, but inside the refresh margin
+        with mock.patch('subscriptions.paypal_service.time.monotonic', return_value=1301.0):
+            self.assertEqual(PayPalService.get_access_token(), 'token-2')
+
+    def test_concurrent_expiry_fetches_one_token(self):
+        barrier = threading.Barrier(10)
+        tokens = []
+
+        def worker():
+            barrier.wait()
+            tokens.append(PayPalService.get_access_token())
+
+        threads = [threading.Thread(target=worker) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ['token-1'] * 10)
+        self.assertEqual(self.state['tokens'], 1)
+
+    def test_revoked_token_is_replaced(self):
+        PayPalService.get_access_token()
+        self.state['valid_tokens'].clear()
+        self.assertEqual(PayPalService.execute_payment('ORDER-1')['status'], 'COMPLETED')
+        self.assertEqual(self.state['tokens'], 2)
+
+    def test_transient_errors_are_retried(self):
+        self.state['fail']['/v2/checkout/orders'] = [503]
+        with mock.patch('subscriptions.paypal_service.time.sleep'):
+            payment = PayPalService.create_payment(self.plan.id, 'user-1', 'http://app/return', 'http://app/cancel',
+                                                   request_id=uuid.uuid4())
+        self.assertEqual(payment['id'], 'ORDER-1')
+        self.assertEqual(self.state['requests'].count('/v2/checkout/orders'), 2)
+
+    def test_non_idempotent_posts_are_not_resent(self):
+        self.state['fail']['/v2/checkout/orders'] = [502]
+        with mock.patch('subscriptions.paypal_service.time.sleep'), self.assertRaises(Exception):
+            PayPalService.create_payment(self.plan.id, 'user-1', 'http://app/return', 'http://app/cancel')
+        self.assertEqual(self.state['requests'].count('/v2/checkout/orders'), 1)
+
+    def test_auth_failure_is_not_cached(self):
+        self.state['fail']['/v1/oauth2/token'] = [401]
+        with self.assertRaises(Exception):
+            PayPalService.get_access_token()
+        self.assertEqual(PayPalService.get_access_token(), 'token-1')
+
+
+class PaymentCaptureTests(FakePayPalTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user_id = str(uuid.uuid4())
+        self.free = SubscriptionPlan.objects.create(name='Free Plan', tier='free', price=0)
+        Subscription.objects.create(user_id=self.user_id, plan=self.free)
+
+    def create_order(self):
+        response = self.client.post('/api/subscriptions/create-payment/', {'user_id': self.user_id, 'plan_id': self.plan.id})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['payment_id']
+
+    def execute(self, order_id, run_worker=True):
+        with mock.patch('subscriptions.views.enqueue_capture', side_effect=capture_order if run_worker else None), \
+                self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/subscriptions/execute-payment/', {'order_id': order_id})
+
+    def test_execute_returns_before_capture(self):
+        order_id = self.create_order()
+        response = self.execute(order_id, run_worker=False)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], PaymentOrder.Status.QUEUED)
+        self.assertNotIn(f'/v2/checkout/orders/{order_id}/capture', self.state['requests'])
+
+        status = self.client.get(f'/api/subscriptions/payment-status/{order_id}/')
+        self.assertEqual(status.status_code, 202)
+        self.assertEqual(status.data['status'], PaymentOrder.Status.QUEUED)
+
+    def test_capture_activates_plan_from_the_order(self):
+        order_id = self.create_order()
+        self.execute(order_id)
+        response = self.client.get(f'/api/subscriptions/payment-status/{order_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], PaymentOrder.Status.COMPLETED)
+        self.assertEqual(response.data['subscription']['plan']['id'], self.plan.id)
+        self.assertEqual(PaymentOrder.objects.get(order_id=order_id).capture_id, f'CAPTURE-{order_id}')
+
+    def test_repeated_execute_captures_once(self):
+        order_id = self.create_order()
+        for _ in range(3):
+            response = self.execute(order_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.state['request_ids']), 1)
+        self.assertEqual(PaymentOrder.objects.get(order_id=order_id).attempts, 1)
+
+    def test_retried_capture_reuses_request_id(self):
+        order_id = self.create_order()
+        self.state['fail'][f'/v2/checkout/orders/{order_id}/capture'] = [500, 500, 500]
+        self.execute(order_id)
+        order = PaymentOrder.objects.get(order_id=order_id)
+        self.assertEqual(order.status, PaymentOrder.Status.QUEUED)
+        self.assertIsNotNone(order.next_attempt_at)
+
+        PaymentOrder.objects.filter(order_id=order_id).update(next_attempt_at=order.created_at)
+        self.assertEqual(due_captures(), [order_id])
+        self.assertEqual(capture_order(order_id), PaymentOrder.Status.COMPLETED)
+        self.assertEqual(set(self.state['request_ids']), {str(order.request_id)})
+        self.assertEqual(Subscription.objects.get(user_id=self.user_id).plan, self.plan)
+
+    def test_declined_capture_fails(self):
+        order_id = self.create_order()
+        self.state['fail'][f'/v2/checkout/orders/{order_id}/capture'] = [422]
+        self.execute(order_id)
+        response = self.client.get(f'/api/subscriptions/payment-status/{order_id}/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['status'], PaymentOrder.Status.FAILED)
+        self.assertEqual(Subscription.objects.get(user_id=self.user_id).plan, self.free)
+
+    def test_failed_capture_retried_under_new_request_id(self):
+        order_id = self.create_order()
+        self.state['fail'][f'/v2/checkout/orders/{order_id}/capture'] = [422]
+        self.execute(order_id)
+        failed = PaymentOrder.objects.get(order_id=order_id)
+        self.assertEqual(failed.status, PaymentOrder.Status.FAILED)
+        self.execute(order_id)
+        order = PaymentOrder.objects.get(order_id=order_id)
+        self.assertEqual(order.status, PaymentOrder.Status.COMPLETED)
+        self.assertNotEqual(order.request_id, failed.request_id)
+        self.assertEqual(self.state['request_ids'], [str(order.request_id)])
+
+    def test_capture_that_succeeded_unseen_is_completed_from_the_order(self):
+        order_id = self.create_order()
+        self.state['fail'][f'/v2/checkout/orders/{order_id}/capture'] = [500, 500, 500]
+        with mock.patch('subscriptions.payments.MAX_CAPTURE_ATTEMPTS', 1):
+            self.execute(order_id)
+        self.assertEqual(PaymentOrder.objects.get(order_id=order_id).status, PaymentOrder.Status.FAILED)
+        # PayPal did capture it; only the answer was lost
+        self.state['captured'].add(order_id)
+
+        self.execute(order_id)
+        order = PaymentOrder.objects.get(order_id=order_id)
+        self.assertEqual(order.status, PaymentOrder.Status.COMPLETED)
+        self.assertEqual(order.capture_id, f'CAPTURE-{order_id}')
+        self.assertIn(f'/v2/checkout/orders/{order_id}', self.state['requests'])
+        self.assertEqual(Subscription.objects.get(user_id=self.user_id).plan, self.plan)
+
+
+class PlanCatalogTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.free = SubscriptionPlan.objects.create(name='Free Plan', tier='free', price=0)
+        cls.pro = SubscriptionPlan.objects.create(name='Pro', tier='pro', price=199)
+        cls.retired = SubscriptionPlan.objects.create(name='Old Pro', tier='pro', price=99, is_active=False)
+
+    def setUp(self):
+        invalidate_catalog()
+        self.client = APIClient()
+
+    def test_lookups_are_free_once_loaded(self):
+        get_plan(self.pro.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_free_plan(), self.free)
+            self.assertEqual(get_plan(self.pro.id), self.pro)
+            self.assertIsNone(get_plan(self.retired.id, active_only=True))
+            self.assertIsNone(get_plan('nope'))
+            self.client.get('/api/subscriptions/subscription-plans/')
+
+    def test_plan_list_is_active_plans_with_etag(self):
+        response = self.client.get('/api/subscriptions/subscription-plans/')
+        self.assertEqual([plan['id'] for plan in response.data], [self.free.id, self.pro.id])
+        self.assertIn('max-age', response['Cache-Control'])
+
+        cached = self.client.get('/api/subscriptions/subscription-plans/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        detail = self.client.get(f'/api/subscriptions/subscription-plans/{self.retired.id}/')
+        self.assertEqual(detail.status_code, 404)
+
+    def test_saving_a_plan_invalidates(self):
+        etag = self.client.get('/api/subscriptions/subscription-plans/')['ETag']
+        self.pro.price = 249
+        self.pro.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            pass
+        response = self.client.get('/api/subscriptions/subscription-plans/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[1]['price'], '249.00')
+
+        self.retired.delete()
+        self.assertIsNone(get_plan(self.retired.id))
+
+
+class SubscriptionQueryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.free = SubscriptionPlan.objects.create(name='Free Plan', tier='free', price=0)
+        cls.pro = SubscriptionPlan.objects.create(name='Pro', tier='pro', price=199)
+        cls.user_id = str(uuid.uuid4())
+        Subscription.objects.create(user_id=cls.user_id, plan=cls.pro)
+
+    def setUp(self):
+        invalidate_catalog()
+        get_free_plan()
+        self.client = APIClient()
+
+    def test_me_and_current_are_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/subscriptions/user-profiles/me/?user_id={self.user_id}')
+        self.assertEqual(response.data['subscription']['plan']['tier'], 'pro')
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/subscriptions/subscriptions/current/?user_id={self.user_id}')
+
+    def test_first_request_creates_one_free_subscription(self):
+        user_id = str(uuid.uuid4())
+        first = self.client.get(f'/api/subscriptions/subscriptions/current/?user_id={user_id}')
+        second = self.client.get(f'/api/subscriptions/user-profiles/me/?user_id={user_id}')
+        self.assertEqual(first.data['plan']['id'], self.free.id)
+        self.assertEqual(second.data['subscription']['id'], first.data['id'])
+        self.assertEqual(Subscription.objects.filter(user_id=user_id).count(), 1)
+
+    def test_upgrade_and_downgrade(self):
+        user_id = str(uuid.uuid4())
+        response = self.client.post('/api/subscriptions/subscriptions/upgrade/', {'user_id': user_id, 'plan_id': self.pro.id})
+        self.assertEqual(response.data['plan']['id'], self.pro.id)
+        response = self.client.post('/api/subscriptions/subscriptions/downgrade/', {'user_id': user_id})
+        self.assertEqual(response.data['plan']['id'], self.free.id)
+        self.assertEqual(Subscription.objects.get(user_id=user_id).plan, self.free)
+
+    def test_entitlements_follow_plan_changes(self):
+        user_id = str(uuid.uuid4())
+        self.assertEqual(get_entitlements(user_id).tier, 'free')
+        with self.assertNumQueries(0):
+            get_entitlements(user_id)
+        self.client.post('/api/subscriptions/subscriptions/upgrade/', {'user_id': user_id, 'plan_id': self.pro.id})
+        self.assertEqual(get_entitlements(user_id).tier, 'pro')
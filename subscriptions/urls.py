@@ -13,4 +13,5 @@ urlpatterns = [
     path('', include(router.urls)),
      path('create-payment/', views.SubscriptionViewSet.as_view({'post': 'create_payment'}), name='create-payment'),
     path('execute-payment/', views.SubscriptionViewSet.as_view({'post': 'execute_payment'}), name='execute-payment'),
+    path('payment-status/<str:order_id>/', views.SubscriptionViewSet.as_view({'get': 'payment_status'}), name='payment-status'),
 ]
\ No newline at end of file
@@ -1,14 +1,20 @@
-from rest_framework import viewsets, status
+from rest_framework import viewsets, status, serializers
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import SubscriptionPlan, Subscription
+from rest_framework.reverse import reverse
+from .models import PaymentOrder, SubscriptionPlan, Subscription
 from .serializers import (
+    PaymentOrderSerializer,
     SubscriptionPlanSerializer,
     SubscriptionSerializer,
     UserSubscriptionSerializer
 )
+from .payments import enqueue_capture, queue_capture
+from .plans import CATALOG_TTL, get_catalog, get_free_plan, get_plan
+from .services import change_plan, get_or_create_subscription
 from .paypal_service import PayPalService
 from django.conf import settings
+from django.db import transaction
 
 
 class SubscriptionPlanViewSet(viewsets.ReadOnlyModelViewSet):
@@ -16,6 +22,28 @@ class SubscriptionPlanViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = SubscriptionPlanSerializer
     permission_classes = []
 
+    def list(self, request, *args, **kwargs):
+        catalog = get_catalog()
+        return self._cached_response(request, catalog, catalog.active_data)
+
+    def retrieve(self, request, *args, **kwargs):
+        catalog = get_catalog()
+        try:
+            data = catalog.active_data_by_id[int(kwargs['pk'])]
+        except (KeyError, ValueError):
+            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return self._cached_response(request, catalog, data)
+
+    def _cached_response(self, request, catalog, data):
+        """Serve catalog data with the catalog version as ETag."""
+        if request.headers.get('If-None-Match') == catalog.etag:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(data)
+        response['ETag'] = catalog.etag
+        response['Cache-Control'] = f'public, max-age={CATALOG_TTL}'
+        return response
+
 class SubscriptionViewSet(viewsets.ModelViewSet):
     serializer_class = SubscriptionSerializer
     permission_classes = []
@@ -34,10 +62,8 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
         
         # Auto-assign free plan if none provided
         if not serializer.validated_data.get('plan'):
-            free_plan = SubscriptionPlan.objects.filter(tier='free').first()
-            if free_plan:
-                serializer.save(user_id=user_id, plan=free_plan)
-                return
+            serializer.save(user_id=user_id, plan=get_free_plan())
+            return
         
         serializer.save(user_id=user_id)
     
@@ -52,20 +78,7 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        try:
-            subscription = Subscription.objects.get(user_id=user_id)
-        except Subscription.DoesNotExist:
-            # Auto-create free subscription
-            free_plan = SubscriptionPlan.objects.filter(tier='free').first()
-            if not free_plan:
-                free_plan = SubscriptionPlan.objects.create(
-                    name='Free Plan',
-                    tier='free',
-                    price=0.00,
-                    interval_days=36500,
-                    features=['Basic features']
-                )
-            subscription = Subscription.objects.create(user_id=user_id, plan=free_plan)
+        subscription = get_or_create_subscription(user_id)
         
         serializer = self.get_serializer(subscription)
         return Response(serializer.data)
@@ -88,33 +101,23 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        try:
-            new_plan = SubscriptionPlan.objects.get(id=plan_id, is_active=True)
-            subscription = Subscription.objects.get(user_id=user_id)
-            
-            if new_plan.tier == 'free':
-                return Response(
-                    {'error': 'Cannot upgrade to free plan'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            subscription.plan = new_plan
-            subscription.status = Subscription.Status.ACTIVE
-            subscription.save()
-            
-            serializer = self.get_serializer(subscription)
-            return Response(serializer.data)
-            
-        except SubscriptionPlan.DoesNotExist:
+        new_plan = get_plan(plan_id, active_only=True)
+        if new_plan is None:
             return Response(
                 {'error': 'Plan not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
-        except Subscription.DoesNotExist:
+        
+        if new_plan.tier == 'free':
             return Response(
-                {'error': 'Subscription not found'}, 
-                status=status.HTTP_404_NOT_FOUND
+                {'error': 'Cannot upgrade to free plan'},
+                status=status.HTTP_400_BAD_REQUEST
             )
+        
+        subscription = change_plan(get_or_create_subscription(user_id), new_plan)
+        
+        serializer = self.get_serializer(subscription)
+        return Response(serializer.data)
     
     @action(detail=False, methods=['post'])
     def downgrade(self, request):
@@ -127,24 +130,10 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        free_plan = SubscriptionPlan.objects.filter(tier='free').first()
-        
-        if not free_plan:
-            free_plan = SubscriptionPlan.objects.create(
-                name='Free Plan',
-                tier='free',
-                price=0.00,
-                interval_days=36500,
-                features=['Basic features']
-            )
-        
-        try:
-            subscription = Subscription.objects.get(user_id=user_id)
-            subscription.plan = free_plan
-            subscription.status = Subscription.Status.ACTIVE
-            subscription.save()
-        except Subscription.DoesNotExist:
-            subscription = Subscription.objects.create(user_id=user_id, plan=free_plan)
+        free_plan = get_free_plan()
+        subscription = get_or_create_subscription(user_id)
+        if subscription.plan_id != free_plan.id or subscription.status != Subscription.Status.ACTIVE:
+            change_plan(subscription, free_plan)
         
         serializer = self.get_serializer(subscription)
         return Response(serializer.data)
@@ -173,6 +162,10 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
                 return_url=return_url,
                 cancel_url=cancel_url
             )
+            PaymentOrder.objects.update_or_create(
+                order_id=payment['id'],
+                defaults={'user_id': user_id, 'plan_id': plan_id}
+            )
             
             return Response({
                 'payment_id': payment['id'],
@@ -189,39 +182,67 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['post'])
     def execute_payment(self, request):
-        """Execute payment after user approval"""
+        """Queue capture of an approved payment; poll payment_status for the outcome.
+
+        Repeating the call for the same order is harmless: an order is only
+        ever captured once.
+        """
         order_id = request.data.get('order_id')
-        user_id = request.data.get('user_id')
-        plan_id = request.data.get('plan_id')
         
-        try:
-            # Execute PayPal payment
-            payment = PayPalService.execute_payment(order_id)
-            
-            if payment['status'] == 'COMPLETED':
-                # Update user subscription
-                new_plan = SubscriptionPlan.objects.get(id=plan_id)
-                
-                subscription = Subscription.objects.get(user_id=user_id)
-                subscription.plan = new_plan
-                subscription.status = Subscription.Status.ACTIVE
-                subscription.save()
-                
-                return Response({
-                    'message': 'Payment successful and subscription upgraded',
-                    'subscription': SubscriptionSerializer(subscription).data
-                })
-            else:
+        if not order_id:
+            return Response(
+                {'error': 'order_id is required'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        order = PaymentOrder.objects.filter(order_id=order_id).first()
+        if order is None:
+            # Orders created before checkout state was tracked
+            user_id = request.data.get('user_id')
+            plan_id = request.data.get('plan_id')
+            if not user_id or get_plan(plan_id) is None:
                 return Response(
-                    {'error': 'Payment not completed'}, 
+                    {'error': 'Unknown order; user_id and a valid plan_id are required'}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
-                
-        except Exception as e:
+            order, _ = PaymentOrder.objects.get_or_create(
+                order_id=order_id,
+                defaults={'user_id': user_id, 'plan_id': plan_id}
+            )
+        
+        if queue_capture(order):
+            transaction.on_commit(lambda: enqueue_capture(order_id))
+            order.refresh_from_db()
+        
+        return self._payment_status_response(request, order)
+
+    @action(detail=False, methods=['get'], url_path=r'payment-status/(?P<order_id>[^/]+)')
+    def payment_status(self, request, order_id=None):
+        """Current state of a payment capture"""
+        try:
+            order = PaymentOrder.objects.get(order_id=order_id)
+        except PaymentOrder.DoesNotExist:
             return Response(
-                {'error': str(e)}, 
-                status=status.HTTP_400_BAD_REQUEST
+                {'error': 'Payment order not found'}, 
+                status=status.HTTP_404_NOT_FOUND
             )
+        return self._payment_status_response(request, order)
+
+    def _payment_status_response(self, request, order):
+        data = PaymentOrderSerializer(order).data
+        data['status_url'] = reverse('subscriptions:payment-status', args=[order.order_id], request=request)
+        
+        if order.status == PaymentOrder.Status.COMPLETED:
+            subscription = Subscription.objects.select_related('plan').filter(user_id=order.user_id).first()
+            data['message'] = 'Payment successful and subscription upgraded'
+            data['subscription'] = SubscriptionSerializer(subscription).data if subscription else None
+            return Response(data)
+        if order.status == PaymentOrder.Status.FAILED:
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+        
+        response = Response(data, status=status.HTTP_202_ACCEPTED)
+        response['Retry-After'] = '2'
+        return response
             
 class UserProfileViewSet(viewsets.GenericViewSet):
     permission_classes = []
@@ -238,28 +259,12 @@ class UserProfileViewSet(viewsets.GenericViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Ensure user has subscription
-        try:
-            Subscription.objects.get(user_id=user_id)
-        except Subscription.DoesNotExist:
-            # Auto-create free subscription
-            free_plan = SubscriptionPlan.objects.filter(tier='free').first()
-            if not free_plan:
-                free_plan = SubscriptionPlan.objects.create(
-                    name='Free Plan',
-                    tier='free',
-                    price=0.00,
-                    interval_days=36500,
-                    features=['Basic features']
-                )
-            Subscription.objects.create(user_id=user_id, plan=free_plan)
-        
         # Create mock user data for response
         user_data = {
             'id': user_id,
             'username': f'user_{user_id}',
             'email': f'user_{user_id}@example.com',
-            'subscription': Subscription.objects.get(user_id=user_id)
+            'subscription': get_or_create_subscription(user_id)
         }
         
         serializer = self.get_serializer(user_data)
@@ -0,0 +1,46 @@
+import base64
+
+from django.conf import settings
+
+from utils.utils import STREAM_KEY, unwrap_key, wrap_key
+
+# Built-in master key, used before FILE_MASTER_KEYS was configured
+LEGACY_KEY_ID = 'legacy'
+
+
+class UnknownKeyId(Exception):
+    pass
+
+
+def master_keys():
+    """Configured master keys by id, always including the built-in legacy key."""
+    keys = {LEGACY_KEY_ID: STREAM_KEY}
+    for key_id, encoded in settings.FILE_MASTER_KEYS.items():
+        keys[key_id] = base64.urlsafe_b64decode(encoded)
+    return keys
+
+
+def master_key(key_id):
+    try:
+        return master_keys()[key_id]
+    except KeyError:
+        raise UnknownKeyId(f"No master key with id {key_id!r} is configured")
+
+
+def current_key_id():
+    return settings.FILE_MASTER_KEY_ID or LEGACY_KEY_ID
+
+
+def wrap_data_key(data_key, key_id=None):
+    """Wrap a data key under a master key. Returns (key_id, wrapped)."""
+    key_id = key_id or current_key_id()
+    return key_id, wrap_key(data_key, master_key(key_id))
+
+
+def unwrap_data_key(key_id, wrapped):
+    return unwrap_key(wrapped, master_key(key_id))
+
+
+def rewrap_data_key(key_id, wrapped, new_key_id):
+    """Move a wrapped data key to another master key; the data it protects is untouched."""
+    return wrap_data_key(unwrap_data_key(key_id, wrapped), new_key_id)
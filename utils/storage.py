@@ -0,0 +1,298 @@
+import asyncio
+import base64
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+
+from utils.supabase_client import url, service_key
+from utils.utils import rechunk
+
+DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024
+# Supabase's resumable (TUS) endpoint requires 6 MiB chunks
+RESUMABLE_CHUNK_SIZE = 6 * 1024 * 1024
+RESUMABLE_MAX_RETRIES = 3
+TUS_VERSION = "1.0.0"
+
+# Raw HTTP access to the Supabase Storage API for the operations the
+# storage3 client does not expose (ranged and streamed reads), created on
+# first use like the Supabase clients
+_sync_client = None
+_sync_client_lock = threading.Lock()
+
+
+def storage_http():
+    global _sync_client
+    if _sync_client is None:
+        with _sync_client_lock:
+            if _sync_client is None:
+                _sync_client = httpx.Client(
+                    base_url=f"{url}/storage/v1/",
+                    headers={"apikey": service_key, "Authorization": f"Bearer {service_key}"},
+                    timeout=httpx.Timeout(30.0, connect=10.0),
+                )
+    return _sync_client
+
+# Async views share one connection pool per event loop (an AsyncClient
+# cannot be used from a loop other than the one it first ran on)
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def async_storage_http():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            base_url=f"{url}/storage/v1/",
+            headers={"apikey": service_key, "Authorization": f"Bearer {service_key}"},
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=settings.STORAGE_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.STORAGE_MAX_CONNECTIONS,
+            ),
+        )
+    return client
+
+
+class StorageObjectNotFound(Exception):
+    pass
+
+
+class StorageRangeNotSupported(Exception):
+    pass
+
+
+class StorageObjectExists(Exception):
+    pass
+
+
+def _object_path(bucket, path):
+    return f"object/{bucket}/{path}"
+
+
+def _check(response):
+    text = response.text.lower()
+    if response.status_code in (400, 404) and "not found" in text:
+        raise StorageObjectNotFound(response.text)
+    if response.status_code == 409 or (response.status_code == 400 and "already exists" in text):
+        raise StorageObjectExists(response.text)
+    response.raise_for_status()
+
+
+def _tus_metadata(**values):
+    return ",".join(f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in values.items())
+
+
+# ---------------------------------------------------------------------
+# Request building and response parsing shared by the sync and async
+# functions below, which differ only in how they send the requests.
+# ---------------------------------------------------------------------
+def _upload_request(bucket, path, content, content_type):
+    """(url, request kwargs) storing a whole object in one POST."""
+    return _object_path(bucket, path), {
+        "content": content,
+        "headers": {"Content-Type": content_type, "x-upsert": "false"},
+    }
+
+
+def _resumable_request(bucket, path, length, content_type):
+    """(url, request kwargs) creating a TUS upload of `length` bytes."""
+    return "upload/resumable", {
+        "headers": {
+            "Tus-Resumable": TUS_VERSION,
+            "Upload-Length": str(length),
+            "Upload-Metadata": _tus_metadata(bucketName=bucket, objectName=path, contentType=content_type),
+            "x-upsert": "false",
+        },
+    }
+
+
+def _upload_url(response):
+    _check(response)
+    return response.headers["location"]
+
+
+def _chunk_request(chunk, chunk_start, offset):
+    """Request kwargs sending the part of `chunk` (starting at `chunk_start`) from `offset` on."""
+    return {
+        "content": chunk[offset - chunk_start:],
+        "headers": {
+            "Tus-Resumable": TUS_VERSION,
+            "Upload-Offset": str(offset),
+            "Content-Type": "application/offset+octet-stream",
+        },
+    }
+
+
+def _upload_offset(response):
+    _check(response)
+    return int(response.headers["upload-offset"])
+
+
+def _head_headers(length):
+    return {"Range": f"bytes=0-{length - 1}"}
+
+
+def _parse_head(response, length):
+    """(first `length` bytes, total object size) from a ranged GET response."""
+    _check(response)
+    content_range = response.headers.get("content-range")
+    if content_range and "/" in content_range:
+        total = int(content_range.rsplit("/", 1)[1])
+    else:
+        total = len(response.content)
+    return response.content[:length], total
+
+
+def _range_window(position, end, range_size):
+    """(Range headers, expected length) of the next ranged read from `position`."""
+    window_end = position + range_size - 1
+    if end is not None:
+        window_end = min(window_end, end)
+    return {"Range": f"bytes={position}-{window_end}"}, window_end - position + 1
+
+
+def _check_range_response(response, path, position):
+    """Raise for a failed ranged read; the error body must have been read."""
+    if response.is_error:
+        _check(response)
+    if response.status_code != 206 and position:
+        raise StorageRangeNotSupported(f"Range request for {path} returned {response.status_code}")
+
+
+def upload_stream(bucket, path, chunks, length, content_type="application/octet-stream"):
+    """Upload an iterable of byte strings of known total `length` without buffering the whole object.
+
+    Objects that fit in one resumable chunk go up in a single request; larger
+    ones use the TUS resumable endpoint, sending one 6 MiB chunk at a time and
+    resuming from the server's offset if a chunk fails mid-transfer. Raises
+    StorageObjectExists if `path` is already taken.
+    """
+    client = storage_http()
+    if length <= RESUMABLE_CHUNK_SIZE:
+        upload_path, request = _upload_request(bucket, path, b"".join(chunks), content_type)
+        _check(client.post(upload_path, **request))
+        return path
+
+    resumable_path, request = _resumable_request(bucket, path, length, content_type)
+    upload_url = _upload_url(client.post(resumable_path, **request))
+
+    offset = 0
+    for chunk in rechunk(chunks, RESUMABLE_CHUNK_SIZE):
+        chunk_start, chunk_end = offset, offset + len(chunk)
+        failures = 0
+        while offset < chunk_end:
+            try:
+                offset = _upload_offset(client.patch(upload_url, **_chunk_request(chunk, chunk_start, offset)))
+            except (httpx.TransportError, httpx.HTTPStatusError):
+                failures += 1
+                if failures > RESUMABLE_MAX_RETRIES:
+                    raise
+                # Ask the server how much of this chunk it already has
+                offset = _upload_offset(client.head(upload_url, headers={"Tus-Resumable": TUS_VERSION}))
+                if not chunk_start <= offset <= chunk_end:
+                    raise
+    return path
+
+
+def read_object_head(bucket, path, length):
+    """Return (first `length` bytes, total object size) using a single ranged request."""
+    return _parse_head(storage_http().get(_object_path(bucket, path), headers=_head_headers(length)), length)
+
+
+def iter_object(bucket, path, start=0, end=None, range_size=DOWNLOAD_RANGE_SIZE):
+    """Yield the bytes of an object from `start` to `end` (inclusive) in successive ranged requests."""
+    client = storage_http()
+    position = start
+    while end is None or position <= end:
+        headers, expected = _range_window(position, end, range_size)
+        received = 0
+        with client.stream("GET", _object_path(bucket, path), headers=headers) as response:
+            if response.status_code == 416:
+                return
+            if response.is_error:
+                response.read()
+            _check_range_response(response, path, position)
+            for chunk in response.iter_bytes():
+                received += len(chunk)
+                yield chunk
+            if response.status_code != 206:
+                # Range was ignored and the whole object was sent.
+                return
+        position += received
+        if received < expected:
+            return
+
+
+# ---------------------------------------------------------------------
+# Async variants for the ASGI views. Reading and encrypting the source
+# chunks runs in a thread, the HTTP requests on the event loop.
+# ---------------------------------------------------------------------
+async def aupload_stream(bucket, path, chunks, length, content_type="application/octet-stream"):
+    """Async upload_stream(); `chunks` is a regular iterable, pulled from a worker thread."""
+    client = async_storage_http()
+    if length <= RESUMABLE_CHUNK_SIZE:
+        content = await asyncio.to_thread(b"".join, chunks)
+        upload_path, request = _upload_request(bucket, path, content, content_type)
+        _check(await client.post(upload_path, **request))
+        return path
+
+    resumable_path, request = _resumable_request(bucket, path, length, content_type)
+    upload_url = _upload_url(await client.post(resumable_path, **request))
+
+    blocks = rechunk(chunks, RESUMABLE_CHUNK_SIZE)
+    offset = 0
+    while True:
+        chunk = await asyncio.to_thread(next, blocks, None)
+        if chunk is None:
+            break
+        chunk_start, chunk_end = offset, offset + len(chunk)
+        failures = 0
+        while offset < chunk_end:
+            try:
+                offset = _upload_offset(await client.patch(upload_url, **_chunk_request(chunk, chunk_start, offset)))
+            except (httpx.TransportError, httpx.HTTPStatusError):
+                failures += 1
+                if failures > RESUMABLE_MAX_RETRIES:
+                    raise
+                offset = _upload_offset(await client.head(upload_url, headers={"Tus-Resumable": TUS_VERSION}))
+                if not chunk_start <= offset <= chunk_end:
+                    raise
+    return path
+
+
+async def adownload_object(bucket, path):
+    """Whole object in one request (legacy whole-file encrypted objects)."""
+    response = await async_storage_http().get(_object_path(bucket, path))
+    _check(response)
+    return response.content
+
+
+async def aread_object_head(bucket, path, length):
+    """Async read_object_head()."""
+    response = await async_storage_http().get(_object_path(bucket, path), headers=_head_headers(length))
+    return _parse_head(response, length)
+
+
+async def aiter_object(bucket, path, start=0, end=None, range_size=DOWNLOAD_RANGE_SIZE):
+    """Async iter_object()."""
+    client = async_storage_http()
+    position = start
+    while end is None or position <= end:
+        headers, expected = _range_window(position, end, range_size)
+        received = 0
+        async with client.stream("GET", _object_path(bucket, path), headers=headers) as response:
+            if response.status_code == 416:
+                return
+            if response.is_error:
+                await response.aread()
+            _check_range_response(response, path, position)
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                yield chunk
+            if response.status_code != 206:
+                return
+        position += received
+        if received < expected:
+            return
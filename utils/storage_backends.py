@@ -0,0 +1,292 @@
+"""Pluggable object storage for encrypted file content.
+
+STORAGE_BACKEND picks where objects live: "supabase" (the default),
+"local" (files under STORAGE_ROOT, read through the storage-object view
+when presigned) or "memory" (per-process, for tests and offline
+benchmarks). A dotted path to another StorageBackend subclass works too.
+
+Paths are keys inside a bucket. Ranges are inclusive, like HTTP ranges.
+"""
+import abc
+import asyncio
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+from utils import storage as supabase_storage
+from utils.storage import StorageObjectExists, StorageObjectNotFound
+from utils.supabase_client import get_supabase
+
+# Bytes per chunk yielded by local and in-memory reads
+READ_CHUNK_SIZE = 1024 * 1024
+PRESIGN_SALT = 'utils.storage_backends.presign'
+
+
+class StorageBackend(abc.ABC):
+    """Interface every backend implements; the async variants default to running the sync ones in a thread."""
+
+    @abc.abstractmethod
+    def upload_stream(self, bucket, path, chunks, length, content_type='application/octet-stream'):
+        """Store an iterable of byte strings of known total `length`. Raises StorageObjectExists if `path` is taken."""
+
+    @abc.abstractmethod
+    def download_range(self, bucket, path, start=0, end=None):
+        """Yield the object's bytes `start`..`end` (inclusive; None means to the end)."""
+
+    @abc.abstractmethod
+    def stat(self, bucket, path):
+        """Size of the object in bytes. Raises StorageObjectNotFound."""
+
+    @abc.abstractmethod
+    def delete(self, bucket, paths):
+        """Remove objects; paths that don't exist are ignored."""
+
+    @abc.abstractmethod
+    def presign(self, bucket, path, expires_in=3600):
+        """URL that serves the stored (encrypted) object for `expires_in` seconds without credentials."""
+
+    def public_url(self, bucket, path):
+        """Lasting URL of an object, or None if the backend only hands out presigned ones."""
+        return None
+
+    def read_head(self, bucket, path, length):
+        """(first `length` bytes, total size) of an object."""
+        size = self.stat(bucket, path)
+        head = b"".join(self.download_range(bucket, path, 0, min(length, size) - 1)) if size else b""
+        return head, size
+
+    def download(self, bucket, path):
+        return b"".join(self.download_range(bucket, path))
+
+    async def aupload_stream(self, bucket, path, chunks, length, content_type='application/octet-stream'):
+        return await asyncio.to_thread(self.upload_stream, bucket, path, chunks, length, content_type)
+
+    async def adownload_range(self, bucket, path, start=0, end=None):
+        chunks = await asyncio.to_thread(lambda: iter(self.download_range(bucket, path, start, end)))
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def aread_head(self, bucket, path, length):
+        return await asyncio.to_thread(self.read_head, bucket, path, length)
+
+    async def adownload(self, bucket, path):
+        return b"".join([chunk async for chunk in self.adownload_range(bucket, path)])
+
+    async def adelete(self, bucket, paths):
+        return await asyncio.to_thread(self.delete, bucket, paths)
+
+    def local_path(self, bucket, path):
+        """Filesystem path of a stored object, if the backend keeps objects as files."""
+        return None
+
+
+class SupabaseStorageBackend(StorageBackend):
+    """Supabase Storage over its HTTP API (see utils.storage)."""
+
+    def upload_stream(self, bucket, path, chunks, length, content_type='application/octet-stream'):
+        return supabase_storage.upload_stream(bucket, path, chunks, length, content_type)
+
+    def download_range(self, bucket, path, start=0, end=None):
+        return supabase_storage.iter_object(bucket, path, start=start, end=end)
+
+    def stat(self, bucket, path):
+        return supabase_storage.read_object_head(bucket, path, 1)[1]
+
+    def read_head(self, bucket, path, length):
+        return supabase_storage.read_object_head(bucket, path, length)
+
+    def delete(self, bucket, paths):
+        if paths:
+            self._client().storage.from_(bucket).remove(list(paths))
+
+    def presign(self, bucket, path, expires_in=3600):
+        return self._client().storage.from_(bucket).create_signed_url(path, expires_in)['signedURL']
+
+    def public_url(self, bucket, path):
+        return self._client().storage.from_(bucket).get_public_url(path)
+
+    async def aupload_stream(self, bucket, path, chunks, length, content_type='application/octet-stream'):
+        return await supabase_storage.aupload_stream(bucket, path, chunks, length, content_type)
+
+    def adownload_range(self, bucket, path, start=0, end=None):
+        return supabase_storage.aiter_object(bucket, path, start=start, end=end)
+
+    async def aread_head(self, bucket, path, length):
+        return await supabase_storage.aread_object_head(bucket, path, length)
+
+    async def adownload(self, bucket, path):
+        return await supabase_storage.adownload_object(bucket, path)
+
+    def _client(self):
+        return get_supabase()
+
+
+def _iter_mapped(file_obj, start, end):
+    size = os.fstat(file_obj.fileno()).st_size
+    end = size - 1 if end is None else min(end, size - 1)
+    if start > end:
+        return
+    # Reads come straight from the page cache, no read() buffer copies
+    with mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for offset in range(start, end + 1, READ_CHUNK_SIZE):
+            yield mapped[offset:min(offset + READ_CHUNK_SIZE, end + 1)]
+
+
+class LocalStorageBackend(StorageBackend):
+    """Objects as files under STORAGE_ROOT/<bucket>/<path>."""
+
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or settings.STORAGE_ROOT)
+
+    def local_path(self, bucket, path):
+        full_path = os.path.normpath(os.path.join(self.root, bucket, path))
+        if not full_path.startswith(os.path.join(self.root, bucket) + os.sep):
+            raise ValueError(f"Invalid storage path: {path}")
+        return full_path
+
+    def upload_stream(self, bucket, path, chunks, length, content_type='application/octet-stream'):
+        full_path = self.local_path(bucket, path)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(full_path):
+            raise StorageObjectExists(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+            try:
+                # Publishes the complete file atomically and fails if a concurrent upload won
+                os.link(temp_path, full_path)
+            except FileExistsError:
+                raise StorageObjectExists(path)
+        finally:
+            os.unlink(temp_path)
+        return path
+
+    def download_range(self, bucket, path, start=0, end=None):
+        try:
+            file_obj = open(self.local_path(bucket, path), 'rb')
+        except FileNotFoundError:
+            raise StorageObjectNotFound(path)
+
+        def chunks():
+            with file_obj:
+                yield from _iter_mapped(file_obj, start, end)
+        return chunks()
+
+    def stat(self, bucket, path):
+        try:
+            return os.stat(self.local_path(bucket, path)).st_size
+        except FileNotFoundError:
+            raise StorageObjectNotFound(path)
+
+    def delete(self, bucket, paths):
+        for path in paths:
+            try:
+                os.unlink(self.local_path(bucket, path))
+            except FileNotFoundError:
+                pass
+
+    def presign(self, bucket, path, expires_in=3600):
+        return presigned_url(bucket, path, expires_in)
+
+
+class MemoryStorageBackend(StorageBackend):
+    """Objects in a dict of this process. Nothing is shared between processes or kept across restarts."""
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.objects.clear()
+
+    def _get(self, bucket, path):
+        try:
+            return self.objects[(bucket, path)]
+        except KeyError:
+            raise StorageObjectNotFound(path)
+
+    def upload_stream(self, bucket, path, chunks, length, content_type='application/octet-stream'):
+        content = b"".join(chunks)
+        with self._lock:
+            if (bucket, path) in self.objects:
+                raise StorageObjectExists(path)
+            self.objects[(bucket, path)] = content
+        return path
+
+    def download_range(self, bucket, path, start=0, end=None):
+        content = self._get(bucket, path)
+        end = len(content) - 1 if end is None else min(end, len(content) - 1)
+        view = memoryview(content)
+        return (bytes(view[offset:min(offset + READ_CHUNK_SIZE, end + 1)])
+                for offset in range(start, end + 1, READ_CHUNK_SIZE))
+
+    def stat(self, bucket, path):
+        return len(self._get(bucket, path))
+
+    def delete(self, bucket, paths):
+        with self._lock:
+            for path in paths:
+                self.objects.pop((bucket, path), None)
+
+    def presign(self, bucket, path, expires_in=3600):
+        return presigned_url(bucket, path, expires_in)
+
+
+def presigned_url(bucket, path, expires_in):
+    """Link to the storage-object view, valid for `expires_in` seconds."""
+    token = signing.dumps({'b': bucket, 'p': path, 'e': int(time.time()) + expires_in}, salt=PRESIGN_SALT)
+    return f"{reverse('storage-object', args=[bucket, path])}?token={token}"
+
+
+def check_presigned(bucket, path, token):
+    """True if `token` was issued by presigned_url() for this object and hasn't expired."""
+    try:
+        claims = signing.loads(token or '', salt=PRESIGN_SALT)
+    except signing.BadSignature:
+        return False
+    return claims.get('b') == bucket and claims.get('p') == path and claims.get('e', 0) >= time.time()
+
+
+BACKENDS = {
+    'supabase': SupabaseStorageBackend,
+    'local': LocalStorageBackend,
+    'memory': MemoryStorageBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_storage():
+    """The configured StorageBackend, created on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = settings.STORAGE_BACKEND
+                backend_class = BACKENDS.get(name) or import_string(name)
+                _backend = backend_class()
+    return _backend
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting in ('STORAGE_BACKEND', 'STORAGE_ROOT'):
+        _backend = None
@@ -1,5 +1,9 @@
+import asyncio
 import os
-from supabase import create_client, Client
+import threading
+import weakref
+
+from supabase import acreate_client, create_client, AsyncClient, Client
 from dotenv import load_dotenv
 
 load_dotenv()  # para mabasa yung .env file
@@ -8,4 +12,27 @@ url: str = os.getenv("SUPABASE_PROJECT_URL")
 anon_key: str = os.getenv("SUPABASE_ANON_KEY")
 service_key: str = os.getenv("SUPABASE_SERVICE_KEY")
 
-supabase: Client = create_client(url, service_key)  # use service_key for backend ops
+# Clients are created on first use, so commands that never talk to
+# Supabase (tests, benchmarks) run without the SUPABASE_* settings
+_client = None
+_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_supabase() -> Client:
+    """Sync Supabase client, using the service key for backend ops."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = create_client(url, service_key)
+    return _client
+
+
+async def get_async_supabase() -> AsyncClient:
+    """Async Supabase client for async views, one per event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = await acreate_client(url, service_key)
+    return client
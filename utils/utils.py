@@ -1,23 +1,309 @@
+import base64
+import os
+import struct
+
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 ENCRYPTION_KEY = b"XWv6Zz0K2bMiDzI9v6tCBf9tnokSmxzqQ9LTH2qZb0M="
 fernet = Fernet(ENCRYPTION_KEY)
 
-def encrypt_file(file_path):
-    """Encrypt the uploaded file in place."""
-    with open(file_path, 'rb') as file:
-        original_data = file.read()
+# ---------------------------------------------------------------------
+# Chunked encryption format (v1)
+#
+#   header:  MAGIC (4) | chunk_size (uint32 BE) | nonce_prefix (8)
+#   frames:  AES-256-GCM(chunk) + 16 byte tag, one per chunk_size bytes
+#
+# Each frame uses nonce = nonce_prefix | frame index (uint32 BE) and the
+# header plus a "last frame" flag as associated data, so frames cannot be
+# reordered, dropped or truncated without failing authentication. Every
+# frame except the last holds exactly chunk_size bytes of plaintext, which
+# keeps the layout seekable.
+# ---------------------------------------------------------------------
+STREAM_MAGIC = b"FGE\x01"
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_HEADER_SIZE = 16
+STREAM_TAG_SIZE = 16
+
+_HEADER = struct.Struct(">4sI8s")
+_FRAME_INDEX = struct.Struct(">I")
+
+STREAM_KEY = HKDF(
+    algorithm=hashes.SHA256(),
+    length=32,
+    salt=None,
+    info=b"fileguard-stream-v1",
+).derive(base64.urlsafe_b64decode(ENCRYPTION_KEY))
+
+
+def _pop_blocks(buffer, size):
+    """Remove and yield every complete `size`-byte block at the front of `buffer`."""
+    while len(buffer) >= size:
+        yield bytes(buffer[:size])
+        del buffer[:size]
+
+
+def rechunk(chunks, size):
+    """Regroup an iterable of byte strings into blocks of exactly `size` bytes (last may be short)."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        yield from _pop_blocks(buffer, size)
+    if buffer:
+        yield bytes(buffer)
+
+
+def _frame_nonce(nonce_prefix, index):
+    return nonce_prefix + _FRAME_INDEX.pack(index)
+
+
+def _frame_aad(header, last):
+    return header + (b"\x01" if last else b"\x00")
+
+
+def is_stream_format(data):
+    """Return True if `data` starts with the chunked format header."""
+    return data[:len(STREAM_MAGIC)] == STREAM_MAGIC
+
+
+def encrypted_size(plain_size, chunk_size=STREAM_CHUNK_SIZE):
+    """Size in bytes of the chunked ciphertext for `plain_size` bytes of plaintext."""
+    frames = max(1, -(-plain_size // chunk_size))
+    return STREAM_HEADER_SIZE + plain_size + frames * STREAM_TAG_SIZE
+
+
+def plaintext_size(encrypted_size, chunk_size=STREAM_CHUNK_SIZE):
+    """Size in bytes of the plaintext stored in a chunked ciphertext of `encrypted_size` bytes."""
+    body = encrypted_size - STREAM_HEADER_SIZE
+    frames = max(1, -(-body // (chunk_size + STREAM_TAG_SIZE)))
+    return body - frames * STREAM_TAG_SIZE
+
+
+def parse_header(header):
+    """Return (chunk_size, nonce_prefix) from a chunked format header."""
+    if len(header) < STREAM_HEADER_SIZE or not is_stream_format(header):
+        raise ValueError("Not a chunked encrypted file.")
+    _, chunk_size, nonce_prefix = _HEADER.unpack(header[:STREAM_HEADER_SIZE])
+    return chunk_size, nonce_prefix
+
+
+def encrypt_stream(chunks, key=STREAM_KEY, chunk_size=STREAM_CHUNK_SIZE):
+    """Encrypt an iterable of plaintext byte strings, yielding the header and then one frame per chunk."""
+    aesgcm = AESGCM(key)
+    nonce_prefix = os.urandom(8)
+    header = _HEADER.pack(STREAM_MAGIC, chunk_size, nonce_prefix)
+    yield header
+
+    # Hold one block back so the final frame can be flagged as such.
+    index = 0
+    pending = b""
+    for block in rechunk(chunks, chunk_size):
+        if index or pending:
+            yield aesgcm.encrypt(_frame_nonce(nonce_prefix, index), pending, _frame_aad(header, False))
+            index += 1
+        pending = block
+    yield aesgcm.encrypt(_frame_nonce(nonce_prefix, index), pending, _frame_aad(header, True))
+
+
+class _FrameDecryptor:
+    """Frame authentication shared by decrypt_frames() and adecrypt_frames().
+
+    Each frame is held back until the next one arrives, so that whichever
+    frame turns out to be the last is authenticated as the final frame.
+    """
+
+    def __init__(self, header, first_index=0, last_index=None, key=STREAM_KEY):
+        chunk_size, self.nonce_prefix = parse_header(header)
+        self.frame_size = chunk_size + STREAM_TAG_SIZE
+        self.header = header
+        self.aesgcm = AESGCM(key)
+        self.index = first_index
+        self.last_index = last_index
+        self.pending = None
+
+    def _decrypt(self, frame, last):
+        return self.aesgcm.decrypt(_frame_nonce(self.nonce_prefix, self.index), frame, _frame_aad(self.header, last))
+
+    def push(self, frame):
+        """Take the next frame; returns the plaintext of the previous one, or None for the first."""
+        previous, self.pending = self.pending, frame
+        if previous is None:
+            return None
+        plaintext = self._decrypt(previous, self.index == self.last_index)
+        self.index += 1
+        return plaintext
+
+    def finish(self):
+        """Plaintext of the frame held back, which must be the final one."""
+        if self.pending is None:
+            raise ValueError("Encrypted file is truncated.")
+        return self._decrypt(self.pending, self.last_index is None or self.index == self.last_index)
+
+
+class _RangeWindow:
+    """Trims decrypted frames to an inclusive plaintext byte range (see decrypt_range)."""
+
+    def __init__(self, header, start, end, encrypted_size):
+        chunk_size, _ = parse_header(header)
+        self.first_index = start // chunk_size
+        self.final_index = max(1, -(-(encrypted_size - STREAM_HEADER_SIZE) // (chunk_size + STREAM_TAG_SIZE))) - 1
+        self.skip = start % chunk_size
+        self.remaining = end - start + 1
+
+    def take(self, chunk):
+        """Return (the part of `chunk` inside the range, whether the range is complete)."""
+        if self.skip:
+            chunk, self.skip = chunk[self.skip:], max(0, self.skip - len(chunk))
+        if len(chunk) >= self.remaining:
+            return chunk[:self.remaining], True
+        self.remaining -= len(chunk)
+        return chunk, False
 
-    encrypted_data = fernet.encrypt(original_data)
 
-    with open(file_path, 'wb') as encrypted_file:
-        encrypted_file.write(encrypted_data)
+def decrypt_frames(header, frames, first_index=0, last_index=None, key=STREAM_KEY):
+    """Decrypt consecutive ciphertext frames starting at `first_index`, yielding plaintext chunks.
+
+    `frames` is an iterable of raw ciphertext byte strings of any size. When
+    `last_index` is given, the frame with that index is authenticated as the
+    final frame of the file.
+    """
+    decryptor = _FrameDecryptor(header, first_index, last_index, key)
+    for frame in rechunk(frames, decryptor.frame_size):
+        plaintext = decryptor.push(frame)
+        if plaintext is not None:
+            yield plaintext
+    yield decryptor.finish()
+
+
+def ciphertext_range(start, end, chunk_size=STREAM_CHUNK_SIZE):
+    """Map an inclusive plaintext byte range to the inclusive ciphertext range of the frames covering it."""
+    frame_size = chunk_size + STREAM_TAG_SIZE
+    first_index, last_index = start // chunk_size, end // chunk_size
+    return STREAM_HEADER_SIZE + first_index * frame_size, STREAM_HEADER_SIZE + (last_index + 1) * frame_size - 1
+
+
+def decrypt_range(header, frames, start, end, encrypted_size, key=STREAM_KEY):
+    """Yield plaintext bytes `start`..`end` (inclusive) from the frames fetched via `ciphertext_range`."""
+    window = _RangeWindow(header, start, end, encrypted_size)
+    for chunk in decrypt_frames(header, frames, window.first_index, window.final_index, key=key):
+        chunk, done = window.take(chunk)
+        yield chunk
+        if done:
+            return
+
+
+async def arechunk(chunks, size):
+    """rechunk() over an async iterable."""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        for block in _pop_blocks(buffer, size):
+            yield block
+    if buffer:
+        yield bytes(buffer)
+
+
+async def adecrypt_frames(header, frames, first_index=0, last_index=None, key=STREAM_KEY):
+    """decrypt_frames() over an async iterable of ciphertext, for async views."""
+    decryptor = _FrameDecryptor(header, first_index, last_index, key)
+    async for frame in arechunk(frames, decryptor.frame_size):
+        plaintext = decryptor.push(frame)
+        if plaintext is not None:
+            yield plaintext
+    yield decryptor.finish()
+
+
+async def adecrypt_range(header, frames, start, end, encrypted_size, key=STREAM_KEY):
+    """decrypt_range() over an async iterable of ciphertext, for async views."""
+    window = _RangeWindow(header, start, end, encrypted_size)
+    async for chunk in adecrypt_frames(header, frames, window.first_index, window.final_index, key=key):
+        chunk, done = window.take(chunk)
+        yield chunk
+        if done:
+            return
+
+
+def decrypt_stream(chunks, key=STREAM_KEY):
+    """Decrypt an iterable of ciphertext byte strings, yielding plaintext chunks.
+
+    Chunked files are decrypted frame by frame in constant memory. Legacy
+    whole-file Fernet tokens are detected by their header and decrypted in
+    one piece.
+    """
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= STREAM_HEADER_SIZE:
+            break
+
+    if not is_stream_format(head):
+        yield fernet.decrypt(head + b"".join(chunks))
+        return
+
+    header, rest = head[:STREAM_HEADER_SIZE], head[STREAM_HEADER_SIZE:]
+
+    def frames():
+        if rest:
+            yield rest
+        yield from chunks
+
+    yield from decrypt_frames(header, frames(), key=key)
+
+
+# ---------------------------------------------------------------------
+# Data keys
+#
+# Content stored once for many files (deduplicated blobs) is encrypted
+# under its own random data key. The data key is kept in the database
+# wrapped (AES-256-GCM) under one of the master keys in utils.keyring,
+# next to that key's id:  nonce (12) | ciphertext + tag.
+# ---------------------------------------------------------------------
+DATA_KEY_SIZE = 32
+_WRAP_NONCE_SIZE = 12
+_WRAP_AAD = b"fileguard-data-key-v1"
+
+
+def generate_data_key():
+    return os.urandom(DATA_KEY_SIZE)
+
+
+def wrap_key(data_key, key=STREAM_KEY):
+    nonce = os.urandom(_WRAP_NONCE_SIZE)
+    return nonce + AESGCM(key).encrypt(nonce, data_key, _WRAP_AAD)
+
+
+def unwrap_key(wrapped, key=STREAM_KEY):
+    wrapped = bytes(wrapped)
+    return AESGCM(key).decrypt(wrapped[:_WRAP_NONCE_SIZE], wrapped[_WRAP_NONCE_SIZE:], _WRAP_AAD)
+
+
+def _read_chunks(file_obj, size=STREAM_CHUNK_SIZE):
+    while True:
+        chunk = file_obj.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def encrypt_file(file_path):
+    """Encrypt the uploaded file in place."""
+    encrypted_path = f"{file_path}.enc"
+    with open(file_path, 'rb') as file, open(encrypted_path, 'wb') as encrypted_file:
+        for block in encrypt_stream(_read_chunks(file)):
+            encrypted_file.write(block)
+    os.replace(encrypted_path, file_path)
 
 
 def decrypt_file(file_path):
     """Return decrypted bytes of the file."""
     with open(file_path, 'rb') as enc_file:
-        encrypted_data = enc_file.read()
+        return b"".join(decrypt_stream(_read_chunks(enc_file)))
 
-    decrypted_data = fernet.decrypt(encrypted_data)
-    return decrypted_data
+
+def decrypt_file_stream(file_path):
+    """Yield decrypted chunks of the file without loading it into memory."""
+    with open(file_path, 'rb') as enc_file:
+        yield from decrypt_stream(_read_chunks(enc_file))